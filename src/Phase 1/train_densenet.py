@@ -1,5 +1,7 @@
 # Here is the imports
 import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Phase 2")) # shared recordbase package
 os.environ['TF_GPU_THREAD_MODE'] = 'gpu_private'
 FLAGS = ["no_full_train"] # tensorboard, mixed_precision, no_pretrain, no_finetune, qubvel, no_full_train
 from tensorflow import keras
@@ -19,6 +21,9 @@ from tensorflow.keras import backend as K
 from tensorflow.keras.applications import EfficientNetB4, DenseNet121
 import efficientnet.tfkeras as eff
 from tensorflow.keras.utils import plot_model
+from recordbase.manifest import load_manifest, steps_per_epoch, shuffle_buffer_size
+from recordbase.strata import weighted_record_dataset
+from recordbase.augment import augment_batch
 
 DATASET_PATH = "./final_recordbase"
 TRAIN_DIR = "train"
@@ -29,10 +34,12 @@ RECORD_ENCODING_TYPE = "ZLIB" # none if no encoding is used
 
 # Pipeline parameters
 BUFFER_SIZE = None # set buffer size to default value, change if you have bottleneck
-SHUFFLE_SIZE = 256 # because dataset is too large huge shuffle sizes may cause problems with ram
+SHUFFLE_SIZE = None # None picks the largest buffer fitting into SHUFFLE_MEMORY_MB from the record base manifest
+SHUFFLE_MEMORY_MB = 1024 # because dataset is too large huge shuffle sizes may cause problems with ram
+AUGMENT_BACKEND = "tf" # tf: in-graph recordbase.augment, albumentations: aug_fn in tf.numpy_function
+AUGMENT_PARAMS = {"rotate_limit": 40, "flip": True} # same transforms as aug_fn
+GROUP_WEIGHTS = None # e.g. {'inme_yok': 0.5, 'inme_var': 0.5}, mixing weights of a base grouped by stratify_records.py
 BATCH_SIZE = 16 # Highly dependent on d-gpu and system ram
-STEPS_PER_EPOCH = 6486//BATCH_SIZE # 4977 IMPORTANT this value should be equal to file_amount/batch_size because we can't find file_amount from tf.Dataset you should note it yourself
-VAL_STEPS_PER_EPOCH = 150//BATCH_SIZE # 1659 same as steps per epoch
 MODEL_WEIGHTS_PATH = None #'./models/21_09-22_51-eff_2_stage/best.h5' # if not none model will be contiune training with these weights
 
 # inme_yok, inme_var
@@ -57,6 +64,15 @@ val_filenames = tf.io.gfile.glob(f"{val_dir}/*.tfrecords")
 random.shuffle(train_filenames) # shuffle tfrecord files order
 random.shuffle(val_filenames)
 
+# record counts come from the manifests next to the shards, run create_manifest.py once for older record bases
+train_manifest = load_manifest(train_filenames)
+val_manifest = load_manifest(val_filenames)
+STEPS_PER_EPOCH = steps_per_epoch(train_manifest, BATCH_SIZE)
+VAL_STEPS_PER_EPOCH = steps_per_epoch(val_manifest, BATCH_SIZE)
+if GROUP_WEIGHTS is not None:
+    print(f"PreTrain: Sampling classes {train_manifest['groups']} with weights {GROUP_WEIGHTS}")
+print(f"PreTrain: {train_manifest['records']} train records ({STEPS_PER_EPOCH} steps), {val_manifest['records']} val records ({VAL_STEPS_PER_EPOCH} steps)")
+
 os.makedirs(f'{MODEL_SAVE_PATH}/{date_name}', exist_ok=True)
 
 # define callbacks for learning rate scheduling and best checkpoints saving
@@ -117,18 +133,31 @@ def prepare_sample(features):
 def prepare_sample_aug(features):
     image = tf.vectorized_map(lambda x: tf.io.parse_tensor(x, out_type = tf.uint8), features["image"])
     label = features["label"]
-    image = tf.vectorized_map(lambda x: tf.numpy_function(func=aug_fn, inp=x, Tout=(tf.uint8)), [image])
+    if AUGMENT_BACKEND == "tf":
+        image, _ = augment_batch(image, **AUGMENT_PARAMS)
+    else:
+        image = tf.vectorized_map(lambda x: tf.numpy_function(func=aug_fn, inp=x, Tout=(tf.uint8)), [image])
     image = tf.vectorized_map(lambda x: tf.numpy_function(func=preprocessing_fn, inp=x, Tout=(tf.float32)), [image])
     return image, label
 
-def get_dataset_optimized(filenames, batch_size, epoch_num, shuffle_size, augment=True):
-    record_dataset = tf.data.TFRecordDataset(filenames, compression_type=RECORD_ENCODING_TYPE, num_parallel_reads=AUTOTUNE)
-    if shuffle_size > 0:
-        record_dataset = record_dataset.shuffle(shuffle_size)
-    record_dataset = (record_dataset
-                    .repeat(epoch_num)
-                    .batch(batch_size=batch_size)
-                    .map(map_func=parse_examples_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE))
+def get_dataset_optimized(filenames, batch_size, epoch_num, shuffle_size, augment=True, group_weights=None):
+    manifest = load_manifest(filenames)
+    if shuffle_size is None:
+        shuffle_size = shuffle_buffer_size(manifest, SHUFFLE_MEMORY_MB)
+    if group_weights is not None:
+        # every class is repeated forever and sampled with its weight, epochs are counted by steps_per_epoch
+        record_dataset = (weighted_record_dataset(filenames, group_weights, RECORD_ENCODING_TYPE, shuffle_size)
+                        .batch(batch_size=batch_size))
+    else:
+        record_dataset = tf.data.TFRecordDataset(filenames, compression_type=RECORD_ENCODING_TYPE, num_parallel_reads=AUTOTUNE)
+        record_dataset = record_dataset.apply(tf.data.experimental.assert_cardinality(manifest["records"]))
+        if shuffle_size > 0:
+            record_dataset = record_dataset.shuffle(shuffle_size)
+        # batch before repeat so every epoch is exactly one pass, steps_per_epoch rounds the last batch up
+        record_dataset = (record_dataset
+                        .batch(batch_size=batch_size)
+                        .repeat(epoch_num))
+    record_dataset = record_dataset.map(map_func=parse_examples_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
     if augment:
         record_dataset = record_dataset.map(map_func=prepare_sample_aug, num_parallel_calls=tf.data.experimental.AUTOTUNE)
     else:
@@ -182,7 +211,7 @@ if(MODEL_WEIGHTS_PATH is not None):
 
 if not "no_pretrain" in FLAGS:
     history = model.fit(
-            get_dataset_optimized(train_filenames, BATCH_SIZE, FIRST_EPOCHS, SHUFFLE_SIZE, augment=False), 
+            get_dataset_optimized(train_filenames, BATCH_SIZE, FIRST_EPOCHS, SHUFFLE_SIZE, augment=False, group_weights=GROUP_WEIGHTS), 
             steps_per_epoch=STEPS_PER_EPOCH, 
             epochs=FIRST_EPOCHS, 
             callbacks=callbacks, 
@@ -207,7 +236,7 @@ if not "no_finetune" in FLAGS:
     )
 
     history = model.fit(
-            get_dataset_optimized(train_filenames, BATCH_SIZE, FINE_TUNE_EPOCHS, SHUFFLE_SIZE, augment=False), 
+            get_dataset_optimized(train_filenames, BATCH_SIZE, FINE_TUNE_EPOCHS, SHUFFLE_SIZE, augment=False, group_weights=GROUP_WEIGHTS), 
             steps_per_epoch=STEPS_PER_EPOCH, 
             epochs=FINE_TUNE_EPOCHS, 
             callbacks=callbacks, 
@@ -231,7 +260,7 @@ if not "no_full_train" in FLAGS:
     model.compile(
     optimizer=optimizer, loss=tf.keras.losses.BinaryCrossentropy(from_logits=False), metrics=["accuracy"])
     history = model.fit(
-            get_dataset_optimized(train_filenames, BATCH_SIZE, FULLY_TRAIN_EPOCHS, SHUFFLE_SIZE, augment=True), 
+            get_dataset_optimized(train_filenames, BATCH_SIZE, FULLY_TRAIN_EPOCHS, SHUFFLE_SIZE, augment=True, group_weights=GROUP_WEIGHTS), 
             steps_per_epoch=STEPS_PER_EPOCH, 
             epochs=FULLY_TRAIN_EPOCHS, 
             callbacks=callbacks, 
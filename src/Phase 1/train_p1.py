@@ -1,17 +1,24 @@
 # Here is the imports
 import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Phase 2")) # shared recordbase package
 os.environ['TF_GPU_THREAD_MODE'] = 'gpu_private'
-FLAGS = ["no_full_train"] # tensorboard, mixed_precision, no_pretrain, no_finetune, qubvel, no_full_train
+FLAGS = ["no_full_train"] # tensorboard, mixed_precision (float16 on GPU), bfloat16 (oneDNN on CPU), no_pretrain, no_finetune, qubvel, no_full_train
+if "bfloat16" in FLAGS:
+    os.environ.setdefault('TF_ENABLE_ONEDNN_OPTS', '1') # bfloat16 kernels of CPUs, read when tensorflow loads
 from tensorflow import keras
 import numpy as np
 import tensorflow as tf
-if "mixed_precision" in FLAGS:
-    print(f"PreTrain: Using Mixed Policy float16")
-    keras.mixed_precision.set_global_policy('mixed_float16')
+from recordbase.distribute import (worker_strategy, num_workers, is_chief, run_stamp, worker_steps, shard_batches,
+                                   distribute_batches)
+STRATEGY = worker_strategy() # multi-worker runs with TF_CONFIG (see launch_workers.py) need it before any other tensorflow op
+from recordbase.precision import precision_policy, set_precision_policy, loss_scale_optimizer, model_policy, cast_model, FLOAT32
+PRECISION = precision_policy(FLAGS)
+if PRECISION != FLOAT32:
+    set_precision_policy(PRECISION)
 AUTOTUNE = tf.data.AUTOTUNE
 import random
 import albumentations as A
-from datetime import datetime
 from tensorflow.keras.callbacks import TensorBoard
 from tensorflow.keras import layers
 from tensorflow.keras.models import load_model
@@ -19,6 +26,14 @@ from tensorflow.keras import backend as K
 from tensorflow.keras.applications import EfficientNetB4
 import efficientnet.tfkeras as eff
 from tensorflow.keras.utils import plot_model
+from recordbase.writer import sort_and_shuffle
+from recordbase.manifest import load_manifest, steps_per_epoch, shuffle_buffer_size
+from recordbase.strata import weighted_record_dataset
+from recordbase.augment import augment_batch
+from recordbase.headcrop import canvas_sizes, image_head_box, bucket_by_canvas, crop_to_canvas, CANVAS_SIZES
+from recordbase.hardexamples import HardExampleSampler, HardExampleCallback, record_id
+from recordbase.resume import epoch_seed
+from recordbase.checkpoints import CheckpointWriter, CheckpointCallback
 
 DATASET_PATH = "./final_recordbase"
 TRAIN_DIR = "train"
@@ -29,23 +44,35 @@ RECORD_ENCODING_TYPE = "ZLIB" # none if no encoding is used
 
 # Pipeline parameters
 BUFFER_SIZE = None # set buffer size to default value, change if you have bottleneck
-SHUFFLE_SIZE = 256 # because dataset is too large huge shuffle sizes may cause problems with ram
-BATCH_SIZE = 16 # Highly dependent on d-gpu and system ram
-STEPS_PER_EPOCH = 6486//BATCH_SIZE # 4977 IMPORTANT this value should be equal to file_amount/batch_size because we can't find file_amount from tf.Dataset you should note it yourself
-VAL_STEPS_PER_EPOCH = 150//BATCH_SIZE # 1659 same as steps per epoch
+SHUFFLE_SIZE = None # None picks the largest buffer fitting into SHUFFLE_MEMORY_MB from the record base manifest
+SHUFFLE_MEMORY_MB = 1024 # because dataset is too large huge shuffle sizes may cause problems with ram
+AUGMENT_BACKEND = "tf" # tf: in-graph recordbase.augment, albumentations: aug_fn in tf.numpy_function
+AUGMENT_PARAMS = {"rotate_limit": 40, "flip": True} # same transforms as aug_fn
+GROUP_WEIGHTS = None # e.g. {'inme_yok': 0.5, 'inme_var': 0.5}, mixing weights of a base grouped by stratify_records.py
+BATCH_SIZE = 16 # Highly dependent on d-gpu and system ram, per worker in multi-worker runs
+SEED = 42 # file order and shuffle seed of multi-worker runs, every worker builds the same batch stream
+HEAD_CROP = False # crop slices to their head, every batch holds slices of one canvas of CANVAS_SIZES
+HARD_EXAMPLES = False # draw slices by their running loss in the following epochs, replaces GROUP_WEIGHTS
+HARD_EXAMPLE_PARAMS = {"momentum": 0.7, "power": 1.0, "min_weight": 0.2, "max_weight": 5.0} # see HardExampleSampler
+CHECKPOINT_EVERY = 1 # epochs between weight snapshots, they are written in the background
+CHECKPOINT_KEEP_BEST = 3 # best snapshots by val_loss kept in MODEL_SAVE_PATH/<run>/checkpoints
+CHECKPOINT_KEEP_LAST = 2 # most recent snapshots kept
+CHECKPOINT_FLOAT16 = False # store the snapshot weights as float16
 MODEL_WEIGHTS_PATH = None #'./models/21_09-22_51-eff_2_stage/best.h5' # if not none model will be contiune training with these weights
 
 # inme_yok, inme_var
 CLASSES = ['inme_yok', 'inme_var']
 LR = 0.0001
 IMG_SIZE = 512
+HEAD_CROP_SIZES = CANVAS_SIZES if HEAD_CROP else None
+INPUT_SHAPE = (None, None, 3) if HEAD_CROP else (IMG_SIZE, IMG_SIZE, 3) # head cropped batches come in several canvas sizes
 FIRST_EPOCHS = 10
 FINE_TUNE_EPOCHS = FIRST_EPOCHS + 30
 FULLY_TRAIN_EPOCHS = FINE_TUNE_EPOCHS + 30 
 MODEL_SAVE_PATH = "./models"
 
 specifier_name = 'eff_final_recordbase'
-date_name = f'{datetime.now().strftime("%d_%m-%H_%M")}-{specifier_name}'
+date_name = f'{run_stamp()}-{specifier_name}'
 
 # Variables
 train_dir = os.path.join(DATASET_PATH, TRAIN_DIR)
@@ -57,18 +84,35 @@ val_filenames = tf.io.gfile.glob(f"{val_dir}/*.tfrecords")
 random.shuffle(train_filenames) # shuffle tfrecord files order
 random.shuffle(val_filenames)
 
+# record counts come from the manifests next to the shards, run create_manifest.py once for older record bases
+train_manifest = load_manifest(train_filenames)
+val_manifest = load_manifest(val_filenames)
+# every worker runs its share of the batches of an epoch
+NUM_WORKERS = num_workers()
+STEPS_PER_EPOCH = worker_steps(steps_per_epoch(train_manifest, BATCH_SIZE), NUM_WORKERS)
+VAL_STEPS_PER_EPOCH = worker_steps(steps_per_epoch(val_manifest, BATCH_SIZE), NUM_WORKERS)
+print(f"PreTrain: {NUM_WORKERS} worker(s), per-worker batch {BATCH_SIZE}, global batch {BATCH_SIZE * STRATEGY.num_replicas_in_sync}")
+if GROUP_WEIGHTS is not None:
+    print(f"PreTrain: Sampling classes {train_manifest['groups']} with weights {GROUP_WEIGHTS}")
+print(f"PreTrain: {train_manifest['records']} train records ({STEPS_PER_EPOCH} steps), {val_manifest['records']} val records ({VAL_STEPS_PER_EPOCH} steps)")
+
 os.makedirs(f'{MODEL_SAVE_PATH}/{date_name}', exist_ok=True)
 
 # define callbacks for learning rate scheduling and best checkpoints saving
 callbacks = [
-    keras.callbacks.ModelCheckpoint(f'{MODEL_SAVE_PATH}/{date_name}/best.h5', save_weights_only=False, save_best_only=True, mode='min'),
-    keras.callbacks.ModelCheckpoint(f'{MODEL_SAVE_PATH}/{date_name}/epoch_{{epoch:02d}}.h5', save_weights_only=False, save_freq=STEPS_PER_EPOCH*10, save_best_only=False, mode='min'),
     #keras.callbacks.ModelCheckpoint(f'{MODEL_SAVE_PATH}/{date_name}/weights_{{epoch:02d}}.h5', save_weights_only=True, save_freq=STEPS_PER_EPOCH*5, save_best_only=False, mode='min'),
     keras.callbacks.ReduceLROnPlateau(),
-    keras.callbacks.CSVLogger(f'./customlogs/{date_name}.csv')
 ]
-
-if "tensorboard" in FLAGS:
+# metrics are all-reduced, every worker sees the same logs and only the chief writes them
+checkpoint_writer = None
+if is_chief():
+    # best.h5 and final.h5 are exported at the end, during training only weight snapshots are written
+    checkpoint_writer = CheckpointWriter(f'{MODEL_SAVE_PATH}/{date_name}', monitor='val_loss', mode='min', best_k=CHECKPOINT_KEEP_BEST,
+                                         last_n=CHECKPOINT_KEEP_LAST, float16=CHECKPOINT_FLOAT16)
+    callbacks.append(CheckpointCallback(checkpoint_writer, CHECKPOINT_EVERY))
+    callbacks.append(keras.callbacks.CSVLogger(f'./customlogs/{date_name}.csv'))
+
+if "tensorboard" in FLAGS and is_chief():
     print(f"PreTrain: Using tensorboard")
     callbacks.append(
         TensorBoard(
@@ -104,9 +148,22 @@ def parse_examples_batch(examples):
     samples = tf.io.parse_example(examples, feature_description)
     return samples
 
-def prepare_sample(features):
+def decode_record(serialized):
+    """uint8 image and label of a single serialized record, head crop decodes every record once before batching"""
+    features = tf.io.parse_single_example(serialized, {
+        'image' : tf.io.FixedLenFeature([], tf.string),
+        'label' : tf.io.FixedLenFeature([], tf.float32)
+    })
+    image = tf.ensure_shape(tf.io.parse_tensor(features["image"], out_type = tf.uint8), (IMG_SIZE, IMG_SIZE, 3))
+    return image, features["label"]
+
+def decode_batch(features):
     image = tf.vectorized_map(lambda x: tf.io.parse_tensor(x, out_type = tf.uint8), features["image"])
-    label = features["label"]
+    return image, features["label"]
+
+def prepare_sample(image, label, head_boxes=None, sizes=None):
+    if head_boxes is not None:
+        image = crop_to_canvas(image, head_boxes, sizes)
     if "qubvel" in FLAGS:
         image = tf.vectorized_map(lambda x: tf.numpy_function(func=preprocessing_fn, inp=x, Tout=(tf.float32)), [image])
     else:
@@ -114,90 +171,158 @@ def prepare_sample(features):
         image = tf.vectorized_map(lambda x: tf.numpy_function(func=normal_preprocess, inp=x, Tout=(tf.float32)), [image])
     return image, label
 
-def prepare_sample_aug(features):
-    image = tf.vectorized_map(lambda x: tf.io.parse_tensor(x, out_type = tf.uint8), features["image"])
-    label = features["label"]
-    image = tf.vectorized_map(lambda x: tf.numpy_function(func=aug_fn, inp=x, Tout=(tf.uint8)), [image])
+def prepare_sample_aug(image, label, head_boxes=None, sizes=None):
+    if head_boxes is not None:
+        image = crop_to_canvas(image, head_boxes, sizes)
+    if AUGMENT_BACKEND == "tf":
+        image, _ = augment_batch(image, **AUGMENT_PARAMS)
+    else:
+        image = tf.vectorized_map(lambda x: tf.numpy_function(func=aug_fn, inp=x, Tout=(tf.uint8)), [image])
     image = tf.vectorized_map(lambda x: tf.numpy_function(func=preprocessing_fn, inp=x, Tout=(tf.float32)), [image])
     return image, label
 
-def get_dataset_optimized(filenames, batch_size, epoch_num, shuffle_size, augment=True):
-    record_dataset = tf.data.TFRecordDataset(filenames, compression_type=RECORD_ENCODING_TYPE, num_parallel_reads=AUTOTUNE)
-    if shuffle_size > 0:
-        record_dataset = record_dataset.shuffle(shuffle_size)
-    record_dataset = (record_dataset
-                    .repeat(epoch_num)
-                    .batch(batch_size=batch_size)
-                    .map(map_func=parse_examples_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE))
-    if augment:
-        record_dataset = record_dataset.map(map_func=prepare_sample_aug, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+def get_dataset_optimized(filenames, batch_size, epoch_num, shuffle_size, augment=True, group_weights=None, head_crop=None, sampler=None,
+                          worker=None, initial_epoch=0):
+    """Batches of epochs initial_epoch to epoch_num, the epochs of model.fit with the same initial_epoch
+
+    With a worker (index, count) the order is seeded by SEED and every worker keeps its share of the batches.
+    """
+    if sampler is not None and group_weights is not None:
+        raise ValueError("Hard example sampling replaces group_weights, use only one of them")
+    seed = None if worker is None else SEED
+    if worker is not None:
+        filenames = sort_and_shuffle(filenames, seed)
+    manifest = load_manifest(filenames)
+    if shuffle_size is None:
+        shuffle_size = shuffle_buffer_size(manifest, SHUFFLE_MEMORY_MB)
+    sizes = None if head_crop is None else canvas_sizes(head_crop, IMG_SIZE, IMG_SIZE)
+
+    def batch_records(dataset):
+        """Batches serialized records, with head_crop the records are decoded once here and batched by canvas
+        as (images, labels, extras, head boxes), the Phase 1 records store no head box"""
+        if sizes is None:
+            return dataset.batch(batch_size=batch_size)
+        dataset = dataset.map(map_func=lambda x, *e: decode_record(x) + e, num_parallel_calls=AUTOTUNE)
+        dataset = dataset.map(map_func=lambda image, *rest: (image,) + rest + (image_head_box(image),), num_parallel_calls=AUTOTUNE)
+        return bucket_by_canvas(dataset, batch_size, sizes)
+
+    def prepare(*batch):
+        """extras are the record ids (sampler) and head boxes (head_crop) of the batch, in that order"""
+        if sizes is None:
+            features, *extras = batch
+            image, label = decode_batch(parse_examples_batch(features))
+        else:
+            image, label, *extras = batch
+        prepare_fn = prepare_sample_aug if augment else prepare_sample
+        image, label = prepare_fn(image, label, extras[-1] if sizes is not None else None, sizes)
+        return (image, label) if sampler is None else (image, label, extras[0])
+
+    if group_weights is not None:
+        # every class is repeated forever and sampled with its weight, epochs are counted by steps_per_epoch
+        record_dataset = batch_records(weighted_record_dataset(filenames, group_weights, RECORD_ENCODING_TYPE, shuffle_size, seed=seed))
+        record_dataset = shard_batches(record_dataset, worker)
     else:
-        record_dataset = record_dataset.map(map_func=prepare_sample, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        record_dataset = tf.data.TFRecordDataset(filenames, compression_type=RECORD_ENCODING_TYPE, num_parallel_reads=AUTOTUNE)
+        record_dataset = record_dataset.apply(tf.data.experimental.assert_cardinality(manifest["records"]))
+        epoch_steps = worker_steps(steps_per_epoch(manifest, batch_size), 1 if worker is None else worker[1])
+
+        def epoch_batches(epoch):
+            dataset = record_dataset
+            if sampler is not None: # draws of every epoch use the weights of the epoch before
+                dataset = sampler.resample(dataset.map(map_func=lambda x: (x, record_id(x)), num_parallel_calls=AUTOTUNE), epoch)
+            if shuffle_size > 0:
+                dataset = dataset.shuffle(shuffle_size, seed=None if seed is None else epoch_seed(seed, epoch))
+            # batch per epoch so every epoch is exactly one pass, steps_per_epoch rounds the last batch up
+            return shard_batches(batch_records(dataset), worker, None if worker is None else epoch_steps)
+        record_dataset = tf.data.Dataset.range(initial_epoch, epoch_num).flat_map(epoch_batches)
+    # record ids and head boxes are carried next to the records of a batch
+    record_dataset = record_dataset.map(map_func=prepare, num_parallel_calls=tf.data.experimental.AUTOTUNE)
     return record_dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
-data_augmentation = tf.keras.Sequential([
-    tf.keras.layers.experimental.preprocessing.RandomFlip('horizontal'),
-    tf.keras.layers.experimental.preprocessing.RandomRotation(0.2)
-])
+# variables of the model and the optimizer are mirrored on every worker
+with STRATEGY.scope():
+    data_augmentation = tf.keras.Sequential([
+        tf.keras.layers.experimental.preprocessing.RandomFlip('horizontal'),
+        tf.keras.layers.experimental.preprocessing.RandomRotation(0.2)
+    ])
 
-inputs = tf.keras.layers.Input(shape=(IMG_SIZE, IMG_SIZE, 3))
+    inputs = tf.keras.layers.Input(shape=INPUT_SHAPE)
 
-x = data_augmentation(inputs)
+    x = data_augmentation(inputs)
 
 
-if "qubvel" in FLAGS:
-    model = eff.EfficientNetB4(
-        include_top=False,
-        weights="noisy-student", # imagenet, noisy-student 
-        #input_tensor=inputs,
-        input_shape=(512, 512, 3)
-    )
-    
-else:    
-    model = EfficientNetB4(
-        include_top=False,
-        weights="imagenet",
-        input_tensor=x,
-        input_shape=(512, 512, 3),
-    )
+    if "qubvel" in FLAGS:
+        model = eff.EfficientNetB4(
+            include_top=False,
+            weights="noisy-student", # imagenet, noisy-student 
+            #input_tensor=inputs,
+            input_shape=INPUT_SHAPE
+        )
+        
+    else:    
+        model = EfficientNetB4(
+            include_top=False,
+            weights="imagenet",
+            input_tensor=x,
+            input_shape=INPUT_SHAPE,
+        )
 
-model.trainable = False
+    model.trainable = False
 
-# Rebuild top
-x = layers.GlobalAveragePooling2D(name="avg_pool")(model.output)
-x = layers.BatchNormalization()(x)
-# possible 20, 31 - block71 expand_conv, block6a_project_conv 
-top_dropout_rate = 0.2
-x = layers.Dropout(top_dropout_rate, name="top_dropout")(x)
-x = layers.Dense(1, name="pred")(x)
-outputs = layers.Activation(activation='sigmoid', dtype='float32', name="result_activ")(x)
+    # Rebuild top
+    x = layers.GlobalAveragePooling2D(name="avg_pool")(model.output)
+    x = layers.BatchNormalization()(x)
+    # possible 20, 31 - block71 expand_conv, block6a_project_conv 
+    top_dropout_rate = 0.2
+    x = layers.Dropout(top_dropout_rate, name="top_dropout")(x)
+    x = layers.Dense(1, name="pred")(x)
+    outputs = layers.Activation(activation='sigmoid', dtype='float32', name="result_activ")(x)
 
-if "qubvel" in FLAGS:
-    model = keras.models.Model(model.input, outputs, name="EfficientNet")
-else:
-    model = keras.models.Model(inputs, outputs, name="EfficientNet")
+    if "qubvel" in FLAGS:
+        model = keras.models.Model(model.input, outputs, name="EfficientNet")
+    else:
+        model = keras.models.Model(inputs, outputs, name="EfficientNet")
 
-optimizer = tf.keras.optimizers.Adam(learning_rate=LR)
+    optimizer = loss_scale_optimizer(tf.keras.optimizers.Adam(learning_rate=LR), PRECISION)
 
-model.compile(
-    optimizer=optimizer, loss=tf.keras.losses.BinaryCrossentropy(from_logits=False), metrics=["accuracy"]
-)
+    model.compile(
+        optimizer=optimizer, loss=tf.keras.losses.BinaryCrossentropy(from_logits=False), metrics=["accuracy"]
+    )
 
 
-if(MODEL_WEIGHTS_PATH is not None):
-    model = load_model(MODEL_WEIGHTS_PATH)
-    for layer in model.layers:
-        layer.trainable = False
+    if(MODEL_WEIGHTS_PATH is not None):
+        model = load_model(MODEL_WEIGHTS_PATH)
+        for layer in model.layers:
+            layer.trainable = False
+        if PRECISION != FLOAT32 and model_policy(model) != PRECISION:
+            # layers keep the dtype they were saved with, the optimizer moments start over
+            model = cast_model(model, PRECISION)
+            model.compile(
+            optimizer=optimizer, loss=tf.keras.losses.BinaryCrossentropy(from_logits=False), metrics=["accuracy"]
+            )
+
+VERBOSE = 1 if is_chief() else 2 # one line per epoch from the other workers
+hard_example_sampler = None
+if HARD_EXAMPLES:
+    if NUM_WORKERS > 1: # every worker would draw from the losses of its own batches, their batch streams would differ
+        raise ValueError("HARD_EXAMPLES needs a single worker, the workers do not share their record losses")
+    print(f"PreTrain: Sampling hard examples with {HARD_EXAMPLE_PARAMS}")
+    # per slice binary cross entropy, the compiled loss without the batch mean
+    hard_example_sampler = HardExampleSampler(lambda y, p: tf.keras.losses.binary_crossentropy(tf.reshape(y, [-1, 1]), tf.reshape(p, [-1, 1])),
+                                              seed=SEED, **HARD_EXAMPLE_PARAMS)
+    hard_example_sampler.attach(model) # kept by the later compile calls, they only reset the train function
+    callbacks.append(HardExampleCallback(hard_example_sampler))
 
 
 if not "no_pretrain" in FLAGS:
     history = model.fit(
-            get_dataset_optimized(train_filenames, BATCH_SIZE, FIRST_EPOCHS, SHUFFLE_SIZE, augment=False), 
+            distribute_batches(STRATEGY, lambda worker: get_dataset_optimized(train_filenames, BATCH_SIZE, FIRST_EPOCHS, SHUFFLE_SIZE, augment=False, group_weights=GROUP_WEIGHTS, head_crop=HEAD_CROP_SIZES, sampler=hard_example_sampler, worker=worker)), 
             steps_per_epoch=STEPS_PER_EPOCH, 
             epochs=FIRST_EPOCHS, 
             callbacks=callbacks, 
-            validation_data=get_dataset_optimized(val_filenames, BATCH_SIZE, FIRST_EPOCHS, 0, augment=False), 
+            validation_data=distribute_batches(STRATEGY, lambda worker: get_dataset_optimized(val_filenames, BATCH_SIZE, FIRST_EPOCHS, 0, augment=False, head_crop=HEAD_CROP_SIZES, worker=worker)), 
             validation_steps=VAL_STEPS_PER_EPOCH,
+            verbose=VERBOSE,
             #initial_epoch=5
         )
 
@@ -215,18 +340,20 @@ if not "no_finetune" in FLAGS:
     #for layer in model.layers[-20:]:
     #    if not isinstance(layer, layers.BatchNormalization):
     #        layer.trainable = True
-    optimizer = tf.keras.optimizers.Adam(learning_rate=LR)
+    with STRATEGY.scope():
+        optimizer = loss_scale_optimizer(tf.keras.optimizers.Adam(learning_rate=LR), PRECISION)
     model.compile(
     optimizer=optimizer, loss=tf.keras.losses.BinaryCrossentropy(from_logits=False), metrics=["accuracy"]
     )
 
     history = model.fit(
-            get_dataset_optimized(train_filenames, BATCH_SIZE, FINE_TUNE_EPOCHS, SHUFFLE_SIZE, augment=False), 
+            distribute_batches(STRATEGY, lambda worker: get_dataset_optimized(train_filenames, BATCH_SIZE, FINE_TUNE_EPOCHS, SHUFFLE_SIZE, augment=False, group_weights=GROUP_WEIGHTS, head_crop=HEAD_CROP_SIZES, sampler=hard_example_sampler, worker=worker, initial_epoch=FIRST_EPOCHS)), 
             steps_per_epoch=STEPS_PER_EPOCH, 
             epochs=FINE_TUNE_EPOCHS, 
             callbacks=callbacks, 
-            validation_data=get_dataset_optimized(val_filenames, BATCH_SIZE, FINE_TUNE_EPOCHS, 0, augment=False), 
+            validation_data=distribute_batches(STRATEGY, lambda worker: get_dataset_optimized(val_filenames, BATCH_SIZE, FINE_TUNE_EPOCHS, 0, augment=False, head_crop=HEAD_CROP_SIZES, worker=worker)), 
             validation_steps=VAL_STEPS_PER_EPOCH,
+            verbose=VERBOSE,
             initial_epoch=FIRST_EPOCHS
         )
 
@@ -241,17 +368,22 @@ if not "no_full_train" in FLAGS:
         else:
             layer.trainable = False
 
-    optimizer = tf.keras.optimizers.Adam(learning_rate=LR)
+    with STRATEGY.scope():
+        optimizer = loss_scale_optimizer(tf.keras.optimizers.Adam(learning_rate=LR), PRECISION)
     model.compile(
     optimizer=optimizer, loss=tf.keras.losses.BinaryCrossentropy(from_logits=False), metrics=["accuracy"])
     history = model.fit(
-            get_dataset_optimized(train_filenames, BATCH_SIZE, FULLY_TRAIN_EPOCHS, SHUFFLE_SIZE, augment=True), 
+            distribute_batches(STRATEGY, lambda worker: get_dataset_optimized(train_filenames, BATCH_SIZE, FULLY_TRAIN_EPOCHS, SHUFFLE_SIZE, augment=True, group_weights=GROUP_WEIGHTS, head_crop=HEAD_CROP_SIZES, sampler=hard_example_sampler, worker=worker, initial_epoch=FINE_TUNE_EPOCHS)), 
             steps_per_epoch=STEPS_PER_EPOCH, 
             epochs=FULLY_TRAIN_EPOCHS, 
             callbacks=callbacks, 
-            validation_data=get_dataset_optimized(val_filenames, BATCH_SIZE, FULLY_TRAIN_EPOCHS, 0, augment=False), 
+            validation_data=distribute_batches(STRATEGY, lambda worker: get_dataset_optimized(val_filenames, BATCH_SIZE, FULLY_TRAIN_EPOCHS, 0, augment=False, head_crop=HEAD_CROP_SIZES, worker=worker)), 
             validation_steps=VAL_STEPS_PER_EPOCH,
+            verbose=VERBOSE,
             initial_epoch=FINE_TUNE_EPOCHS
         )
 
-model.save(f'{MODEL_SAVE_PATH}/{date_name}/final.h5')
\ No newline at end of file
+if is_chief():
+    model.save(f'{MODEL_SAVE_PATH}/{date_name}/final.h5')
+    checkpoint_writer.export(model, f'{MODEL_SAVE_PATH}/{date_name}/best.h5')
+    checkpoint_writer.close()
\ No newline at end of file
@@ -0,0 +1,76 @@
+# Compares the in-graph augmentation (recordbase.augment) with the albumentations aug_fn path of the
+# training scripts (tf.numpy_function inside tf.vectorized_map). Reports images/sec of every transform
+# on synthetic batches through a tf.data map with num_parallel_calls=AUTOTUNE.
+import time
+import numpy as np
+import tensorflow as tf
+import albumentations as A
+from recordbase.augment import augment_batch
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+# Benchmark parameters
+IMG_SIZE = 512
+BATCH_SIZE = 8
+LABEL_DEPTH = 3 # one-hot channels of the masks
+BATCHES = 64 # batches per measurement
+REPEATS = 3 # every measurement is repeated and the best run is reported
+
+# transform name: (recordbase.augment parameters, equivalent albumentations transform)
+TRANSFORMS = {
+    "rotate": ({"rotate_limit": 40}, A.Rotate(limit=40, p=1)),
+    "flip": ({"flip": True}, A.Flip(p=1)),
+    "shift_scale_rotate": ({"rotate_limit": 45, "shift_limit": 0.0625, "scale_limit": 0.1}, A.ShiftScaleRotate(p=1)),
+    "elastic": ({"elastic_alpha": 20}, A.ElasticTransform(p=1)),
+    "intensity": ({"brightness": 0.2, "contrast": 0.2}, A.RandomBrightnessContrast(p=1)),
+}
+
+
+def synthetic_batch():
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 256, (BATCH_SIZE, IMG_SIZE, IMG_SIZE, 3), dtype=np.uint8)
+    class_map = rng.integers(0, LABEL_DEPTH, (BATCH_SIZE, IMG_SIZE, IMG_SIZE))
+    masks = np.eye(LABEL_DEPTH, dtype=np.float32)[class_map]
+    return images, masks
+
+
+def albumentations_fn(transform):
+    compose = A.Compose([transform])
+    def aug_fn(image, mask):
+        aug_data = compose(image=image, mask=mask)
+        return aug_data["image"], aug_data["mask"].astype(np.float32)
+    def batch_fn(image, label):
+        return tf.vectorized_map(lambda x: tf.numpy_function(func=aug_fn, inp=x, Tout=(tf.uint8, tf.float32)), [image, label])
+    return batch_fn
+
+
+def tf_fn(params):
+    return lambda image, label: augment_batch(image, label, p=1.0, **params)
+
+
+def images_per_sec(batch, fn):
+    dataset = (tf.data.Dataset.from_tensors(batch)
+                .repeat(BATCHES)
+                .map(fn, num_parallel_calls=AUTOTUNE)
+                .prefetch(AUTOTUNE))
+    for _ in dataset.take(2): # traces the map function
+        pass
+    best = 0
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        for _ in dataset:
+            pass
+        best = max(best, BATCHES * BATCH_SIZE / (time.perf_counter() - start))
+    return best
+
+
+if __name__ == '__main__':
+    batch = synthetic_batch()
+    results = []
+    for name, (params, transform) in TRANSFORMS.items():
+        results.append((name, images_per_sec(batch, albumentations_fn(transform)), images_per_sec(batch, tf_fn(params))))
+        print(f"Info: Measured {name}")
+
+    print(f"\n{'transform':<20}{'albumentations img/s':>22}{'tf img/s':>10}{'speedup':>9}")
+    for name, albumentations, in_graph in results:
+        print(f"{name:<20}{albumentations:>22.1f}{in_graph:>10.1f}{in_graph / albumentations:>8.1f}x")
@@ -0,0 +1,115 @@
+# Benchmarks the memory and speed of the segmentation models with and without activation recomputation
+# (recompute=True of sm.Unet, sm.FPN, sm.Linknet and sm.custom.Double_Unet). Every model, mode and batch size
+# trains a few steps on random slices in its own process and reports the peak memory (GPU allocator peak,
+# or peak RSS on CPU) and the step time. Batches running out of memory are reported, so the largest batch
+# of every mode shows what recomputation buys on the machine.
+import os
+import json
+import time
+import resource
+import multiprocessing
+import numpy as np
+
+RESULTS_PATH = "./logs/memory_benchmark.json"
+
+# Benchmark parameters
+MODELS = ["Unet", "FPN", "Linknet", "Double_Unet"]
+BACKBONE = 'efficientnetb3' # same as train_model.py
+INPUT_SIZE = 512 # square slices
+CLASSES = 4
+BATCH_SIZES = [2, 4, 8, 16, 32] # a mode stops at its first batch size running out of memory
+WARMUP_STEPS = 2 # tracing and allocator warm up, not timed
+STEPS = 10 # timed training steps
+JIT_COMPILE = False # see train_model.py
+
+def build_model(name, recompute):
+    import segmentation_models as sm
+    sm.set_framework("tf.keras")
+    kwargs = {"classes": CLASSES, "activation": "softmax", "encoder_weights": None, "recompute": recompute}
+    if name == "Double_Unet":
+        return sm.custom.Double_Unet(BACKBONE, input_shape=(INPUT_SIZE, INPUT_SIZE, 3), **kwargs)
+    return getattr(sm, name)(BACKBONE, input_shape=(INPUT_SIZE, INPUT_SIZE, 3), **kwargs)
+
+
+def peak_memory_mib(tf):
+    """Allocator peak of the first GPU, peak RSS of the process without one"""
+    if len(tf.config.list_physical_devices("GPU")) > 0:
+        return tf.config.experimental.get_memory_info("GPU:0")["peak"] / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(name, recompute, batch_size):
+    """Runs in a fresh process so the peak memory belongs to this model, mode and batch only"""
+    import tensorflow as tf
+    from recordbase.engine import attach_train_step
+    model = build_model(name, recompute)
+    model.compile(optimizer=tf.keras.optimizers.Adam(1e-4), loss="categorical_crossentropy")
+    if JIT_COMPILE:
+        attach_train_step(model, jit_compile=True)
+    model_mib = peak_memory_mib(tf)
+
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 256, (batch_size, INPUT_SIZE, INPUT_SIZE, 3)).astype(np.float32)
+    labels = np.eye(CLASSES, dtype=np.float32)[rng.integers(0, CLASSES, (batch_size, INPUT_SIZE, INPUT_SIZE))]
+    images, labels = tf.constant(images), tf.constant(labels)
+    try:
+        for _ in range(WARMUP_STEPS):
+            model.train_on_batch(images, labels)
+        times = []
+        for _ in range(STEPS):
+            start = time.perf_counter()
+            model.train_on_batch(images, labels)
+            times.append(time.perf_counter() - start)
+    except tf.errors.ResourceExhaustedError:
+        return {"model": name, "recompute": recompute, "batch_size": batch_size, "oom": True}
+    times = np.array(times)
+    peak_mib = peak_memory_mib(tf)
+    return {"model": name, "recompute": recompute, "batch_size": batch_size, "oom": False,
+            "step_ms": float(np.median(times) * 1000), "images_per_sec": float(batch_size / np.median(times)),
+            "model_mib": model_mib, "peak_mib": peak_mib, "activation_mib": peak_mib - model_mib}
+
+
+if __name__ == '__main__':
+    results = []
+    # spawn, every run needs its own tf runtime and allocator
+    context = multiprocessing.get_context("spawn")
+    for name in MODELS:
+        for recompute in [False, True]:
+            for batch_size in BATCH_SIZES:
+                with context.Pool(1) as pool:
+                    result = pool.apply(measure, (name, recompute, batch_size))
+                results.append(result)
+                mode = "recompute" if recompute else "plain"
+                if result["oom"]:
+                    print(f"Info: {name} {mode} batch {batch_size}: out of memory")
+                    break
+                print(f"Info: {name} {mode} batch {batch_size}: {result['step_ms']:.0f} ms/step, "
+                      f"peak {result['peak_mib']:.0f} MiB ({result['activation_mib']:.0f} MiB activations)")
+
+    print(f"\n{'model':>12}{'mode':>11}{'batch':>7}{'ms/step':>9}{'img/s':>8}{'peak MiB':>10}{'act. MiB':>10}")
+    for r in results:
+        mode = "recompute" if r["recompute"] else "plain"
+        if r["oom"]:
+            print(f"{r['model']:>12}{mode:>11}{r['batch_size']:>7}{'out of memory':>17}")
+        else:
+            print(f"{r['model']:>12}{mode:>11}{r['batch_size']:>7}{r['step_ms']:>9.0f}{r['images_per_sec']:>8.1f}"
+                  f"{r['peak_mib']:>10.0f}{r['activation_mib']:>10.0f}")
+
+    # largest batch and step time overhead of every model, compared at the largest batch both modes ran
+    print()
+    for name in MODELS:
+        runs = {mode: {r["batch_size"]: r for r in results if r["model"] == name and r["recompute"] == mode and not r["oom"]}
+                for mode in [False, True]}
+        if len(runs[False]) == 0 or len(runs[True]) == 0:
+            print(f"{name}: no batch size ran in both modes")
+            continue
+        common = max(set(runs[False]) & set(runs[True]))
+        overhead = runs[True][common]["step_ms"] / runs[False][common]["step_ms"] - 1
+        memory = runs[False][common]["activation_mib"] / max(runs[True][common]["activation_mib"], 1e-6)
+        print(f"{name}: largest batch {max(runs[False])} plain, {max(runs[True])} recompute; at batch {common} "
+              f"recompute is {overhead * 100:+.0f}% step time with {memory:.1f}x less activation memory")
+
+    os.makedirs(os.path.dirname(RESULTS_PATH), exist_ok=True)
+    with open(RESULTS_PATH, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Info: Wrote {RESULTS_PATH}")
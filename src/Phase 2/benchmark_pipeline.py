@@ -0,0 +1,239 @@
+# Benchmarks the reading pipeline of train_model.py (get_dataset_optimized) without a model, over a grid of
+# pipeline settings. Every setting runs in its own process and reports images/sec, p50/p99 batch latency,
+# peak RSS and the time of every stage. Stage times come from timing growing prefixes of the pipeline
+# (read, +shuffle, +parse, +decode, +augment, +preprocess), the stage adding the most time starves the model.
+import os
+import json
+import time
+import shutil
+import resource
+import itertools
+import multiprocessing
+import numpy as np
+import tensorflow as tf
+from recordbase.reader import (detect_schema, parse_examples_batch, decode_image_batch, decode_label_batch, drop_stale_records,
+                               decode_class_map_batch, class_map_to_onehot, expand_channels)
+from recordbase.cache import apply_cache, CACHE_OFF, CACHE_RAM
+from recordbase.manifest import load_manifest
+from recordbase.augment import augment_batch
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+# Dataset Constants
+DATASET_PATH = "./final_recordbase"
+SPLIT_DIR = "train"
+RECORD_ENCODING_TYPE = "ZLIB" # encoding of the source record base
+
+OUT_PATH = "./outdata/pipeline_benchmark/"
+RESULTS_PATH = "./logs/pipeline_benchmark.json"
+KEEP_OUTPUT = False # remove sample shards and caches when done
+
+# Benchmark parameters
+SAMPLE_RECORDS = 512 # records copied from the record base into one sample shard per compression
+REPEATS = 3 # timed passes over the sample after a warm up pass
+DECODE_BATCH = 32 # same as train_model.py
+BACKBONE = 'efficientnetb3' # numpy preprocessing of train_model.py when IN_MODEL_PREPROCESSING is off
+AUGMENT_PARAMS = {"rotate_limit": 20} # same as train_model.py
+
+# settings of train_model.py, every GRID value is measured against these
+BASE_CONFIG = {
+    "parallel_reads": AUTOTUNE, # num_parallel_reads of the TFRecordDataset
+    "map_parallelism": AUTOTUNE, # num_parallel_calls of every map
+    "batch_size": 2,
+    "shuffle_size": 1000, # records in the shuffle buffer, 0 disables shuffling
+    "compression": "ZLIB",
+    "augment": False,
+    "cache": CACHE_OFF,
+    "preprocess": "model", # model: uint8 batches (IN_MODEL_PREPROCESSING), numpy: numpy_function backbone preprocessing
+}
+GRID = {
+    "parallel_reads": [1, AUTOTUNE],
+    "map_parallelism": [1, AUTOTUNE],
+    "batch_size": [2, 8, 16],
+    "shuffle_size": [0, 1000],
+    "compression": ["ZLIB", None],
+    "augment": [False, True],
+    "cache": [CACHE_OFF, CACHE_RAM],
+    "preprocess": ["model", "numpy"],
+}
+FULL_GRID = False # False varies one setting at a time around BASE_CONFIG, True measures every combination
+
+def grid_configs(base, grid, full):
+    if full:
+        return [dict(base, **dict(zip(grid, values))) for values in itertools.product(*grid.values())]
+    configs = [dict(base)]
+    for key, values in grid.items():
+        configs += [dict(base, **{key: value}) for value in values if value != base[key]]
+    return configs
+
+
+def write_samples(filenames, compression_type, sample_records, out_dir):
+    """Copies the first live records of the base into one sample shard per compression, the records are not re-encoded
+
+    Return:
+        dict: {compression: shard path}
+    """
+    manifest = load_manifest(filenames)
+    dataset = tf.data.TFRecordDataset(sorted(filenames), compression_type=compression_type)
+    records = [r.numpy() for r in drop_stale_records(dataset, manifest["stale_hashes"]).take(sample_records)]
+    paths = {}
+    for compression in set(GRID["compression"] + [BASE_CONFIG["compression"]]):
+        path = os.path.join(out_dir, f"sample_{compression or 'none'}.tfrecords")
+        options = tf.io.TFRecordOptions(compression_type=compression) if compression else None
+        with tf.io.TFRecordWriter(path, options=options) as writer:
+            for record in records:
+                writer.write(record)
+        paths[compression] = path
+    print(f"Info: Wrote {len(records)} sample records in {len(paths)} compression(s)")
+    return paths
+
+
+def numpy_preprocessing(image, label, preprocess_input):
+    """The tf.numpy_function preprocessing of train_model.py, one call per sample"""
+    image = tf.vectorized_map(lambda x: tf.numpy_function(func=lambda y: preprocess_input(y.astype(np.float32)), inp=[x], Tout=tf.float32), image)
+    return image, label
+
+
+def decode_compact(serialized, schema, depth):
+    """uint8 images and class maps, the cached form of train_model.py"""
+    features = parse_examples_batch(serialized, schema)
+    return decode_image_batch(features, schema, expand=False), decode_class_map_batch(features, schema, depth)
+
+
+def build_pipeline(path, config, depth, stages, cache_dir):
+    """Pipeline of get_dataset_optimized for one config, only the stages up to the last one in stages
+
+    The cached pipeline caches decoded samples, there read, parse and decode are a single "read" stage.
+    """
+    calls = config["map_parallelism"]
+    schema = detect_schema(path, config["compression"])
+    dataset = tf.data.TFRecordDataset([path], compression_type=config["compression"], num_parallel_reads=config["parallel_reads"])
+    if config["cache"] != CACHE_OFF:
+        dataset = (dataset
+                    .batch(DECODE_BATCH)
+                    .map(lambda x: decode_compact(x, schema, depth), num_parallel_calls=calls)
+                    .unbatch())
+        dataset = apply_cache(dataset, config["cache"], [path], {"schema": schema, "depth": depth}, cache_dir)
+        if "shuffle" in stages and config["shuffle_size"] > 0:
+            dataset = dataset.shuffle(config["shuffle_size"])
+        dataset = (dataset
+                    .batch(config["batch_size"])
+                    .map(lambda x, y: (expand_channels(x) if x.shape[-1] == 1 else x, class_map_to_onehot(y, depth)), num_parallel_calls=calls))
+    else:
+        if "shuffle" in stages and config["shuffle_size"] > 0:
+            dataset = dataset.shuffle(config["shuffle_size"])
+        dataset = dataset.batch(config["batch_size"])
+        if "parse" in stages:
+            dataset = dataset.map(lambda x: parse_examples_batch(x, schema), num_parallel_calls=calls)
+        if "decode" in stages:
+            dataset = dataset.map(lambda x: (decode_image_batch(x, schema), decode_label_batch(x, schema)), num_parallel_calls=calls)
+    if "augment" in stages and config["augment"]:
+        dataset = dataset.map(lambda x, y: augment_batch(x, y, **AUGMENT_PARAMS), num_parallel_calls=calls)
+    if "preprocess" in stages and config["preprocess"] == "numpy":
+        import segmentation_models as sm
+        sm.set_framework("tf.keras")
+        preprocess_input = sm.get_preprocessing(BACKBONE)
+        dataset = dataset.map(lambda x, y: numpy_preprocessing(x, y, preprocess_input), num_parallel_calls=calls)
+    return dataset.prefetch(AUTOTUNE)
+
+
+def batch_size_of(element):
+    return int(tf.shape(tf.nest.flatten(element)[0])[0])
+
+
+def time_pipeline(dataset):
+    """Warm up pass (tracing, cache fill), then REPEATS timed passes
+
+    Return:
+        tuple: (images per second, per batch latencies in seconds)
+    """
+    for _ in dataset:
+        pass
+    images, latencies = 0, []
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        last = time.perf_counter()
+        for element in dataset:
+            now = time.perf_counter()
+            latencies.append(now - last)
+            images += batch_size_of(element)
+            last = time.perf_counter()
+    return images / (time.perf_counter() - start), np.array(latencies)
+
+
+def pipeline_stages(config):
+    """Stages that change the pipeline of config, in pipeline order"""
+    stages = ["read"]
+    if config["shuffle_size"] > 0:
+        stages.append("shuffle")
+    if config["cache"] == CACHE_OFF:
+        stages += ["parse", "decode"]
+    if config["augment"]:
+        stages.append("augment")
+    if config["preprocess"] == "numpy":
+        stages.append("preprocess")
+    return stages
+
+
+def measure_config(path, config, depth, cache_dir):
+    """Runs in a fresh process so the peak RSS belongs to this config only"""
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    stages = pipeline_stages(config)
+    images_per_sec, latencies = time_pipeline(build_pipeline(path, config, depth, stages, cache_dir))
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    # ms per image of every prefix, a stage costs the difference to the prefix before it
+    stage_ms, previous = {}, 0.0
+    for i, stage in enumerate(stages):
+        prefix_ips = images_per_sec if i == len(stages) - 1 else time_pipeline(build_pipeline(path, config, depth, stages[:i + 1], cache_dir))[0]
+        prefix_ms = 1000 / prefix_ips
+        stage_ms[stage] = max(0.0, prefix_ms - previous)
+        previous = prefix_ms
+    return {"config": config, "images_per_sec": images_per_sec,
+            "p50_ms": float(np.percentile(latencies, 50) * 1000), "p99_ms": float(np.percentile(latencies, 99) * 1000),
+            "base_rss_mib": base_rss, "peak_rss_mib": peak_rss, "stage_ms": stage_ms,
+            "bottleneck": max(stage_ms, key=stage_ms.get)}
+
+
+def format_value(value):
+    return "autotune" if value == AUTOTUNE else str(value)
+
+
+if __name__ == '__main__':
+    filenames = sorted(tf.io.gfile.glob(f"{os.path.join(DATASET_PATH, SPLIT_DIR)}/*.tfrecords"))
+    assert len(filenames) > 0, f"No records found in {os.path.join(DATASET_PATH, SPLIT_DIR)}"
+    os.makedirs(OUT_PATH, exist_ok=True)
+    schema = detect_schema(filenames[0], RECORD_ENCODING_TYPE)
+    depth = schema["label_depth"] or len(load_manifest(filenames)["class_pixels"])
+    paths = write_samples(filenames, RECORD_ENCODING_TYPE, SAMPLE_RECORDS, OUT_PATH)
+
+    configs = grid_configs(BASE_CONFIG, GRID, FULL_GRID)
+    varied = [key for key in GRID if len({format_value(c[key]) for c in configs}) > 1]
+    results = []
+    # spawn, a forked child would share the tf runtime of the parent
+    context = multiprocessing.get_context("spawn")
+    for i, config in enumerate(configs):
+        with context.Pool(1) as pool:
+            result = pool.apply(measure_config, (paths[config["compression"]], config, depth, os.path.join(OUT_PATH, f"cache_{i}")))
+        results.append(result)
+        print(f"Info: [{i + 1}/{len(configs)}] {', '.join(f'{k}={format_value(config[k])}' for k in varied)}: "
+              f"{result['images_per_sec']:.1f} img/s, bottleneck {result['bottleneck']}")
+
+    header = "".join(f"{key:>16}" for key in varied)
+    print(f"\n{header}{'img/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'RSS MiB':>9}  stage ms/img")
+    for r in results:
+        stages = ", ".join(f"{stage} {ms:.2f}" for stage, ms in r["stage_ms"].items())
+        settings = "".join(f"{format_value(r['config'][key]):>16}" for key in varied)
+        print(f"{settings}"
+              f"{r['images_per_sec']:>9.1f}{r['p50_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['peak_rss_mib']:>9.0f}  {stages}")
+    fastest = max(results, key=lambda r: r["images_per_sec"])
+    settings = ", ".join(f"{k}={format_value(fastest['config'][k])}" for k in varied)
+    print(f"\nFastest: {settings} ({fastest['images_per_sec']:.1f} img/s)")
+
+    os.makedirs(os.path.dirname(RESULTS_PATH), exist_ok=True)
+    with open(RESULTS_PATH, "w") as f:
+        json.dump([dict(r, config={k: format_value(v) for k, v in r["config"].items()}) for r in results], f, indent=2)
+    print(f"Info: Wrote {RESULTS_PATH}")
+
+    if not KEEP_OUTPUT:
+        shutil.rmtree(OUT_PATH)
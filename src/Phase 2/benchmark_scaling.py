@@ -0,0 +1,101 @@
+# Scaling efficiency of multi-worker training from 1 to N workers. Every worker count of WORKER_COUNTS starts
+# this script on local workers with launch_workers.py; with a TF_CONFIG the script is a worker and trains
+# the Unet of train_model.py under recordbase.distribute.worker_strategy on random slices, PER_WORKER_BATCH
+# per worker. The chief reports the images per second of the global batch, the efficiency of n workers is
+# throughput(n) / (n * throughput(1)). Local workers share the cores of the machine, so on one machine this
+# measures the all-reduce and input overhead; run the worker part with a TF_CONFIG per node to measure
+# the scaling across nodes.
+import os
+import sys
+import json
+import time
+import numpy as np
+from launch_workers import launch
+
+RESULTS_PATH = "./logs/scaling_benchmark.json"
+RESULT_ENV = "SCALING_RESULT" # file the chief of a worker count writes its result to
+
+# Benchmark parameters
+WORKER_COUNTS = [1, 2, 4]
+BACKBONE = 'efficientnetb3' # same as train_model.py
+INPUT_SIZE = 256 # square slices, smaller than the records so a CPU step stays short
+CLASSES = 3
+PER_WORKER_BATCH = 4 # weak scaling, the global batch grows with the workers
+WARMUP_STEPS = 3 # tracing and the first all-reduces, not timed
+STEPS = 20 # timed training steps
+
+def run_worker(result_path):
+    """One worker of a run, the chief writes the result of the run to result_path"""
+    from recordbase.distribute import worker_strategy, num_workers, is_chief, distribute_batches
+    strategy = worker_strategy()
+    import tensorflow as tf
+    import segmentation_models as sm
+    sm.set_framework("tf.keras")
+
+    class StepTimer(tf.keras.callbacks.Callback):
+        def __init__(self):
+            super(StepTimer, self).__init__()
+            self.times = []
+
+        def on_train_batch_begin(self, batch, logs=None):
+            self.start = time.perf_counter()
+
+        def on_train_batch_end(self, batch, logs=None):
+            if batch >= WARMUP_STEPS:
+                self.times.append(time.perf_counter() - self.start)
+
+    def dataset_fn(worker):
+        rng = np.random.default_rng(0 if worker is None else worker[0])
+        images = rng.integers(0, 256, (PER_WORKER_BATCH, INPUT_SIZE, INPUT_SIZE, 3)).astype(np.uint8)
+        labels = np.eye(CLASSES, dtype=np.float32)[rng.integers(0, CLASSES, (PER_WORKER_BATCH, INPUT_SIZE, INPUT_SIZE))]
+        return tf.data.Dataset.from_tensors((images, labels)).repeat()
+
+    with strategy.scope():
+        model = sm.Unet(BACKBONE, input_shape=(INPUT_SIZE, INPUT_SIZE, 3), classes=CLASSES, activation="softmax",
+                        encoder_weights=None, input_preprocessing=True)
+        model.compile(optimizer=tf.keras.optimizers.Adam(1e-4), loss="categorical_crossentropy")
+    timer = StepTimer()
+    model.fit(distribute_batches(strategy, dataset_fn), steps_per_epoch=WARMUP_STEPS + STEPS, epochs=1, callbacks=[timer], verbose=0)
+
+    if is_chief():
+        step = float(np.median(timer.times))
+        global_batch = PER_WORKER_BATCH * strategy.num_replicas_in_sync
+        with open(result_path, "w") as f:
+            json.dump({"workers": num_workers(), "per_worker_batch": PER_WORKER_BATCH, "global_batch": global_batch,
+                       "step_ms": step * 1000, "images_per_sec": global_batch / step}, f)
+
+
+if __name__ == '__main__':
+    if "TF_CONFIG" in os.environ:
+        run_worker(os.environ[RESULT_ENV])
+        sys.exit(0)
+
+    results = []
+    os.makedirs(os.path.dirname(RESULTS_PATH), exist_ok=True)
+    for workers in WORKER_COUNTS:
+        result_path = os.path.join(os.path.dirname(RESULTS_PATH), f"scaling_{workers}.json")
+        code = launch(os.path.abspath(__file__), workers, env={RESULT_ENV: os.path.abspath(result_path)})
+        if code != 0:
+            print(f"Info: {workers} worker(s) failed with exit code {code}")
+            continue
+        with open(result_path) as f:
+            result = json.load(f)
+        os.remove(result_path)
+        results.append(result)
+        print(f"Info: {workers} worker(s): global batch {result['global_batch']}, {result['step_ms']:.0f} ms/step, "
+              f"{result['images_per_sec']:.1f} img/s")
+
+    single = next((r for r in results if r["workers"] == 1), None)
+    print(f"\n{'workers':>8}{'batch/worker':>14}{'global batch':>14}{'ms/step':>9}{'img/s':>9}{'speedup':>9}{'efficiency':>12}")
+    for r in results:
+        if single is not None:
+            r["speedup"] = r["images_per_sec"] / single["images_per_sec"]
+            r["efficiency"] = r["speedup"] / r["workers"]
+        speedup = f"{r['speedup']:.2f}x" if "speedup" in r else "-"
+        efficiency = f"{r['efficiency']:.0%}" if "efficiency" in r else "-"
+        print(f"{r['workers']:>8}{r['per_worker_batch']:>14}{r['global_batch']:>14}{r['step_ms']:>9.0f}{r['images_per_sec']:>9.1f}"
+              f"{speedup:>9}{efficiency:>12}")
+
+    with open(RESULTS_PATH, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Info: Wrote {RESULTS_PATH}")
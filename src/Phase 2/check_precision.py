@@ -0,0 +1,109 @@
+# Parity check of the losses and metrics in reduced precision. Every loss and metric of segmentation_models,
+# hetorex and keras_unet_collection used by the training scripts gets the same random batch as float32
+# predictions and as float16 / bfloat16 predictions, the loss values and the gradients w.r.t. the logits
+# must match within the tolerance of the dtype and stay finite. float16 gradients go through the loss
+# scaling of recordbase.precision like in training. Exits with 1 if any check fails.
+import sys
+import numpy as np
+import tensorflow as tf
+import segmentation_models as sm
+sm.set_framework("tf.keras")
+from hetorex import loss_functions
+from keras_unet_collection import losses as kuc_losses
+from recordbase.precision import loss_scale_optimizer, MIXED_FLOAT16, MIXED_BFLOAT16
+
+# Check parameters
+BATCH_SIZE = 2
+INPUT_SIZE = 64
+CLASSES = 3 # iskemik, kanama, background
+LOGIT_SCALE = 8.0 # large logits saturate the probabilities to 0 and 1, where epsilon clipping and log break in float16
+SEED = 42
+# (loss rtol, gradient rtol) of every policy, float16 keeps 11 bits of mantissa, bfloat16 8
+TOLERANCES = {MIXED_FLOAT16: (1e-2, 5e-2), MIXED_BFLOAT16: (5e-2, 1.5e-1)}
+ATOL = 1e-4
+
+def keras_lovasz_softmax(y_true, y_pred):
+    """The lovasz loss of train_model.py"""
+    y_true = tf.expand_dims(tf.argmax(y_true, axis=-1), -1)
+    y_true = tf.cast(y_true, y_pred.dtype)
+    return loss_functions.lovasz_softmax(y_pred, y_true)
+
+
+def check_cases():
+    """{name: (loss or metric, differentiable)}"""
+    return {
+        "sm.DiceLoss": (sm.losses.DiceLoss(), True),
+        "sm.JaccardLoss": (sm.losses.JaccardLoss(), True),
+        "sm.CategoricalFocalLoss": (sm.losses.CategoricalFocalLoss(), True),
+        "sm.BinaryFocalLoss": (sm.losses.BinaryFocalLoss(), True),
+        "sm.CategoricalCELoss": (sm.losses.CategoricalCELoss(), True),
+        "sm.BinaryCELoss": (sm.losses.BinaryCELoss(), True),
+        "sm.IOUScore": (sm.metrics.IOUScore(threshold=0.5), False),
+        "sm.FScore": (sm.metrics.FScore(threshold=0.5), False),
+        "sm.Precision": (sm.metrics.Precision(threshold=0.5), False),
+        "sm.Recall": (sm.metrics.Recall(threshold=0.5), False),
+        "hetorex.Multiclass_combo_loss": (loss_functions.Multiclass_combo_loss(), True),
+        "hetorex.lovasz_softmax": (keras_lovasz_softmax, True),
+        "kuc.dice": (kuc_losses.dice, True),
+        "kuc.tversky": (kuc_losses.tversky, True),
+        "kuc.focal_tversky": (kuc_losses.focal_tversky, True),
+        "kuc.multiclass_focal_tversky": (kuc_losses.multiclass_focal_tversky(), True),
+        "kuc.iou_seg": (kuc_losses.iou_seg, True),
+    }
+
+
+def loss_and_gradient(fn, y_true, logits, dtype, differentiable, optimizer=None):
+    """Loss of the softmax of logits in dtype and its float32 gradient w.r.t. the logits, None for metrics"""
+    with tf.GradientTape() as tape:
+        tape.watch(logits)
+        y_pred = tf.cast(tf.nn.softmax(logits), dtype)
+        loss = fn(tf.cast(y_true, dtype), y_pred)
+        scaled = optimizer.get_scaled_loss(loss) if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer) else loss
+    if not differentiable:
+        return float(loss), None
+    gradient = tape.gradient(scaled, logits)
+    if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+        gradient = optimizer.get_unscaled_gradients([gradient])[0]
+    return float(loss), tf.cast(gradient, tf.float32).numpy()
+
+
+def check(name, fn, differentiable, y_true, logits, policy):
+    """Compares a loss in the compute dtype of policy to float32
+
+    Return:
+        dict: values, relative errors and whether the check passed
+    """
+    dtype = tf.keras.mixed_precision.Policy(policy).compute_dtype
+    loss_rtol, gradient_rtol = TOLERANCES[policy]
+    reference, reference_gradient = loss_and_gradient(fn, y_true, logits, tf.float32, differentiable)
+    optimizer = loss_scale_optimizer(tf.keras.optimizers.SGD(), policy)
+    value, gradient = loss_and_gradient(fn, y_true, logits, dtype, differentiable, optimizer)
+    loss_error = abs(value - reference) / max(abs(reference), ATOL)
+    passed = np.isfinite(value) and abs(value - reference) <= ATOL + loss_rtol * abs(reference)
+    gradient_error = None
+    if differentiable:
+        gradient_error = float(np.linalg.norm(gradient - reference_gradient) / max(np.linalg.norm(reference_gradient), ATOL))
+        passed = passed and bool(np.all(np.isfinite(gradient))) and gradient_error <= gradient_rtol
+    return {"name": name, "policy": policy, "reference": reference, "value": value,
+            "loss_error": loss_error, "gradient_error": gradient_error, "passed": bool(passed)}
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(SEED)
+    labels = rng.integers(0, CLASSES, (BATCH_SIZE, INPUT_SIZE, INPUT_SIZE))
+    y_true = tf.constant(np.eye(CLASSES, dtype=np.float32)[labels])
+    logits = tf.constant(rng.normal(size=(BATCH_SIZE, INPUT_SIZE, INPUT_SIZE, CLASSES)).astype(np.float32) * LOGIT_SCALE)
+
+    results = []
+    for policy in TOLERANCES:
+        for name, (fn, differentiable) in check_cases().items():
+            results.append(check(name, fn, differentiable, y_true, logits, policy))
+
+    print(f"{'loss':>30}{'policy':>16}{'float32':>12}{'reduced':>12}{'loss err':>10}{'grad err':>10}")
+    for r in results:
+        gradient_error = "-" if r["gradient_error"] is None else f"{r['gradient_error']:.2e}"
+        print(f"{r['name']:>30}{r['policy']:>16}{r['reference']:>12.5f}{r['value']:>12.5f}{r['loss_error']:>10.2e}{gradient_error:>10}"
+              f"{'' if r['passed'] else '  FAILED'}")
+    failed = [r for r in results if not r["passed"]]
+    print(f"\nInfo: {len(results) - len(failed)}/{len(results)} checks passed")
+    sys.exit(1 if failed else 0)
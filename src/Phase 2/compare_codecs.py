@@ -0,0 +1,121 @@
+# Compares the image codecs of the record schema on a sample of an existing record base.
+# Reports on-disk size, image decode throughput and end-to-end images/sec of the reading pipeline.
+import os
+import time
+import shutil
+import numpy as np
+import tensorflow as tf
+from recordbase.schema import parse_single_image_class_map, IMAGE_CODECS
+from recordbase.reader import detect_schema, parse_examples_batch, decode_image_batch, decode_label_batch
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+# Dataset Constants
+DATASET_PATH = "./final_recordbase"
+SPLIT_DIR = "train"
+RECORD_ENCODING_TYPE = "ZLIB" # encoding of the source record base
+
+OUT_PATH = "./outdata/codec_compare/"
+KEEP_OUTPUT = False # remove written shards when done
+
+# Benchmark parameters
+SAMPLE_SIZE = 512 # amount of records taken from the record base
+BATCH_SIZE = 8
+REPEATS = 3 # every measurement is repeated and the best run is reported
+CODECS = IMAGE_CODECS
+COMPRESSION_TYPES = ["ZLIB", None]
+
+
+def load_samples(filenames, compression_type, sample_size):
+    """Reads sample_size records as (image, uint8 class map) numpy pairs, images keep their stored channels"""
+    schema = detect_schema(filenames[0], compression_type)
+    dataset = (tf.data.TFRecordDataset(filenames, compression_type=compression_type)
+                .take(sample_size)
+                .batch(1)
+                .map(lambda x: parse_examples_batch(x, schema)))
+    samples = []
+    for features in dataset:
+        image = decode_image_batch(features, schema, expand=False)[0].numpy()
+        label = decode_label_batch(features, schema)[0].numpy()
+        if label.shape[-1] == 1:
+            class_map = label[..., 0].astype(np.uint8)
+        else:
+            class_map = np.argmax(label, axis=-1).astype(np.uint8)
+        samples.append((image, class_map))
+    return samples, label.shape[-1]
+
+
+def write_variant(samples, depth, codec, compression_type, out_dir):
+    path = os.path.join(out_dir, f"{codec}_{compression_type or 'none'}.tfrecords")
+    options = tf.io.TFRecordOptions(compression_type=compression_type) if compression_type else None
+    encode_start = time.perf_counter()
+    with tf.io.TFRecordWriter(path, options=options) as writer:
+        for image, class_map in samples:
+            writer.write(parse_single_image_class_map(image, class_map, depth, codec=codec).SerializeToString())
+    encode_time = time.perf_counter() - encode_start
+    return path, encode_time
+
+
+def best_images_per_sec(dataset, image_count):
+    best = 0
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        for _ in dataset:
+            pass
+        best = max(best, image_count / (time.perf_counter() - start))
+    return best
+
+
+def decode_throughput(path, compression_type):
+    """Images/sec of decoding only, the encoded payloads are read into memory first"""
+    schema = detect_schema(path, compression_type)
+    parsed = (tf.data.TFRecordDataset(path, compression_type=compression_type)
+                .batch(BATCH_SIZE)
+                .map(lambda x: parse_examples_batch(x, schema))
+                .cache())
+    image_count = 0
+    for features in parsed: # fills the cache
+        image_count += int(tf.shape(next(iter(features.values())))[0])
+    decoded = parsed.map(lambda x: decode_image_batch(x, schema), num_parallel_calls=AUTOTUNE).prefetch(AUTOTUNE)
+    return best_images_per_sec(decoded, image_count)
+
+
+def end_to_end_throughput(path, compression_type, image_count):
+    """Images/sec of reading, parsing and decoding both image and label, same as the training pipeline"""
+    schema = detect_schema(path, compression_type)
+    dataset = (tf.data.TFRecordDataset([path], compression_type=compression_type, num_parallel_reads=AUTOTUNE)
+                .batch(BATCH_SIZE)
+                .map(lambda x: parse_examples_batch(x, schema), num_parallel_calls=AUTOTUNE)
+                .map(lambda x: (decode_image_batch(x, schema), decode_label_batch(x, schema)), num_parallel_calls=AUTOTUNE)
+                .prefetch(AUTOTUNE))
+    return best_images_per_sec(dataset, image_count)
+
+
+if __name__ == '__main__':
+    filenames = sorted(tf.io.gfile.glob(f"{os.path.join(DATASET_PATH, SPLIT_DIR)}/*.tfrecords"))
+    assert len(filenames) > 0, f"No records found in {os.path.join(DATASET_PATH, SPLIT_DIR)}"
+    samples, depth = load_samples(filenames, RECORD_ENCODING_TYPE, SAMPLE_SIZE)
+    print(f"Info: Loaded {len(samples)} samples from {len(filenames)} shard(s)")
+    os.makedirs(OUT_PATH, exist_ok=True)
+
+    results = []
+    for codec in CODECS:
+        for compression_type in COMPRESSION_TYPES:
+            path, encode_time = write_variant(samples, depth, codec, compression_type, OUT_PATH)
+            results.append({
+                "variant": f"{codec}+{compression_type or 'none'}",
+                "mib": tf.io.gfile.stat(path).length / 2**20,
+                "encode": len(samples) / encode_time,
+                "decode": decode_throughput(path, compression_type),
+                "end_to_end": end_to_end_throughput(path, compression_type, len(samples)),
+            })
+
+    print(f"\n{'variant':<12}{'size MiB':>10}{'KiB/img':>10}{'write img/s':>13}{'decode img/s':>14}{'e2e img/s':>11}")
+    for r in results:
+        print(f"{r['variant']:<12}{r['mib']:>10.1f}{r['mib'] * 1024 / len(samples):>10.1f}"
+              f"{r['encode']:>13.1f}{r['decode']:>14.1f}{r['end_to_end']:>11.1f}")
+    fastest = max(results, key=lambda r: r["end_to_end"])
+    print(f"\nFastest end-to-end: {fastest['variant']}")
+
+    if not KEEP_OUTPUT:
+        shutil.rmtree(OUT_PATH)
@@ -0,0 +1,36 @@
+# Packs image/label png directories into memory mapped array bases (see recordbase.arrays).
+# Arrays need as much disk as the decoded images, but samples are read with random access and no decoding.
+import os
+import tensorflow as tf
+from recordbase.schema import RGB
+from recordbase.writer import sort_and_shuffle
+from recordbase.arrays import write_array_base
+from recordbase.splits import load_split
+
+# Dataset Constants
+SPLIT_MANIFEST = None # './data/dataset1/splits.json' written by split_dataset.py, used instead of the SPLITS directories
+DATASET_PATH = "./data/dataset1"
+SPLITS = {"train": ("train", "train_label"), "val": ("val", "val_label")} # split name: (image dir, label dir)
+IMG_EXT = "png"
+
+OUT_PATH = "./outdata/arrays/"
+
+CLASS_VALUES = [1, 2]
+IMAGE_CHANNELS = RGB # rgb or gray
+SHUFFLE_SEED = None # storage order does not matter for random access, None keeps sorted order
+
+if __name__ == '__main__':
+    os.makedirs(OUT_PATH, exist_ok=True)
+    for split, (img_dir, label_dir) in SPLITS.items():
+        if SPLIT_MANIFEST is not None:
+            pairs = load_split(SPLIT_MANIFEST, split)
+        else:
+            img_path = os.path.join(DATASET_PATH, img_dir)
+            label_path = os.path.join(DATASET_PATH, label_dir)
+            img_filenames = sort_and_shuffle(tf.io.gfile.glob(f"{img_path}/*.{IMG_EXT}"), seed=SHUFFLE_SEED)
+            pairs = [(i, i.replace(img_path, label_path)) for i in img_filenames]
+        if len(pairs) == 0:
+            print(f"Info: No images in split {split}, skipping")
+            continue
+        print(f"Starting to pack split **{split}**")
+        write_array_base(pairs, CLASS_VALUES, OUT_PATH, filename=split, channels=IMAGE_CHANNELS)
@@ -0,0 +1,20 @@
+# Writes the per slice box index (see recordbase.boxes) of a record base that was written without one.
+# Every split directory gets its own index, needed by PATCH_SIZE of train_model.py.
+import os
+import tensorflow as tf
+from recordbase.boxes import build_box_index, box_index_path
+
+# Dataset Constants
+DATASET_PATH = "./final_recordbase"
+SPLIT_DIRS = ["train", "val", "test"] # missing directories are skipped
+RECORD_ENCODING_TYPE = "ZLIB" # none if no encoding is used
+
+if __name__ == '__main__':
+    for split in SPLIT_DIRS:
+        split_dir = os.path.join(DATASET_PATH, split)
+        filenames = tf.io.gfile.glob(f"{split_dir}/*.tfrecords")
+        if len(filenames) == 0:
+            print(f"Info: No records in {split_dir}, skipping")
+            continue
+        print(f"Info: Indexing {len(filenames)} shard(s) of split **{split}**")
+        build_box_index(filenames, RECORD_ENCODING_TYPE, box_index_path(split_dir, split))
@@ -0,0 +1,20 @@
+# Writes the manifest of a record base that was created before the writers emitted manifests
+# (prepare_dataset notebooks, phase 1 record bases). Every split directory gets its own manifest.
+import os
+import tensorflow as tf
+from recordbase.manifest import build_manifest, manifest_path
+
+# Dataset Constants
+DATASET_PATH = "./final_recordbase"
+SPLIT_DIRS = ["train", "val", "test"] # missing directories are skipped
+RECORD_ENCODING_TYPE = "ZLIB" # none if no encoding is used
+
+if __name__ == '__main__':
+    for split in SPLIT_DIRS:
+        split_dir = os.path.join(DATASET_PATH, split)
+        filenames = tf.io.gfile.glob(f"{split_dir}/*.tfrecords")
+        if len(filenames) == 0:
+            print(f"Info: No records in {split_dir}, skipping")
+            continue
+        print(f"Info: Counting {len(filenames)} shard(s) of split **{split}**")
+        build_manifest(filenames, RECORD_ENCODING_TYPE, manifest_path(split_dir, split))
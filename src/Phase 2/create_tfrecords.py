@@ -2,10 +2,16 @@ import tensorflow as tf
 import os 
 import numpy as np
 import cv2
-import tqdm
-import random
+import functools
+from recordbase.schema import segmentation_example, CLASS_MAP, RAW, GRAY
+from recordbase.writer import sort_and_shuffle
+from recordbase.incremental import incremental_build, compact, remove_build, index_path
+from recordbase.strata import group_pairs, group_filename, lesion_group, LESION, NO_LESION
+from recordbase.splits import load_split, read_split_manifest
+from recordbase.boxes import index_split_boxes
 
 # Dataset Constants
+SPLIT_MANIFEST = None # './data/dataset1/splits.json' written by split_dataset.py, used instead of the split directories
 SPLIT_DATASET = False
 DATASET_SPLIT = ["train", "val", "test"]
 DATASET_PATH = "./data/dataset1"
@@ -21,35 +27,18 @@ IMG_EXT = "png"
 OUT_PATH = "./outdata/tfrecord/"
 
 CLASS_VALUES = [1, 2]
+LABEL_FORMAT = CLASS_MAP # uint8 class index map, use ONEHOT for the old float one-hot mask records
+IMAGE_CODEC = RAW # raw, png or bmp - run compare_codecs.py on your record base to pick the fastest one
+IMAGE_CHANNELS = GRAY # gray stores one channel and readers broadcast it to 3, rgb stores 3 copies
 
 MAX_FILES = 200
 
-def image_feature(value):
-    """Returns a bytes_list from a string / byte."""
-    return tf.train.Feature(
-        bytes_list=tf.train.BytesList(value=[serialize_array(value)])
-    )
-
-def bytes_feature(value):
-    """Returns a bytes_list from a string / byte."""
-    if isinstance(value, type(tf.constant(0))):
-        value = value.numpy()
-    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
-
-
-def float_feature(value):
-    """Returns a float_list from a float / double."""
-    return tf.train.Feature(float_list=tf.train.FloatList(value=[value]))
-
-
-def int64_feature(value):
-    """Returns an int64_list from a bool / enum / int / uint."""
-    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
-
-
-def float_feature_list(value):
-    """Returns a list of float_list from a float / double."""
-    return tf.train.Feature(float_list=tf.train.FloatList(value=value))
+ENCODING_TYPE = "ZLIB" # zlib, gzip or none, should match RECORD_ENCODING_TYPE of the training scripts
+NUM_WORKERS = os.cpu_count() # every worker writes whole shards, 0 writes everything on the main process
+SHUFFLE_SEED = 42 # file to shard assignment only depends on this seed, None keeps sorted order
+BUILD_MODE = "full" # full: encode everything, incremental: only encode new/changed pairs into delta shards, compact: merge delta shards
+STRATIFY = False # write lesion and no_lesion slices into separate shard groups, see GROUP_WEIGHTS of train_model.py
+BOX_INDEX = True # write the per slice box index next to the shards, needed by PATCH_SIZE of train_model.py
 
 def parse_tfrecord_fn(example):
     feature_description = {
@@ -66,76 +55,52 @@ def parse_tfrecord_fn(example):
     example["bbox"] = tf.sparse.to_dense(example["bbox"])
     return example
 
-# non keras
-def serialize_array(array):
-  array = tf.io.serialize_tensor(array).numpy()
-  return array
-
-def parse_single_image(image, label):
-  
-  #define the dictionary -- the structure -- of our single example
-  data = {
-        'image/height' : int64_feature(image.shape[0]),
-        'image/width' : int64_feature(image.shape[1]),
-        'image/depth' : int64_feature(image.shape[2]),
-        'image/raw_image' : image_feature(image),
-        'label/raw' : image_feature(label)
-    }
-  #create an Example, wrapping the single features
-  out = tf.train.Example(features=tf.train.Features(feature=data))
-  return out
-
-def write_image_batches_to_tfr(img_path, label_path, filename:str="batch", max_files:int=100, out_dir:str="/data/tfrecord/"):
-    img_filenames = tf.io.gfile.glob(f"./data/dataset1/data/*.png")
-    print(img_filenames)
-    random.shuffle(img_filenames)
+def write_image_batches_to_tfr(img_path, label_path, filename:str="batch", max_files:int=100, out_dir:str="/data/tfrecord/", num_workers:int=NUM_WORKERS, mode:str=BUILD_MODE, stratify:bool=STRATIFY):
+    img_filenames = sort_and_shuffle(tf.io.gfile.glob(f"{img_path}/*.{IMG_EXT}"), seed=SHUFFLE_SEED)
     label_filenames = []
     for i in img_filenames:
         label_filenames.append(i.replace(img_path, label_path))
-    # determine the number of shards (single TFRecord files) we need:
     assert len(img_filenames) == len(label_filenames)
-    splits = (len(img_filenames)//max_files) + 1 #determine how many tfr shards are needed
-    if len(img_filenames)%max_files == 0:
-        splits-=1
-    print(f"\nUsing {splits} shard(s) for {len(img_filenames)} files, with up to {max_files} samples per shard")
-    os.makedirs(out_dir, exist_ok=True)
-    file_count = 0
-    for i in tqdm.tqdm(range(splits)):
-        current_shard_name = f"{out_dir}tfrecord_{i+1}in{splits}_{filename}.tfrecords"
-        writer = tf.io.TFRecordWriter(current_shard_name)
-
-        current_shard_count = 0
-        while current_shard_count < max_files: #as long as our shard is not full
-            #get the index of the file that we want to parse now
-            index = i*max_files+current_shard_count
-            if index == len(img_filenames): #when we have consumed the whole data, preempt generation
-                break
-            
-            #img = None
-            #with open(img_filenames[index], 'rb') as file_reader:
-            #    img = file_reader.read()
-            img = cv2.imread(img_filenames[index])
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-
-            mask = cv2.imread(label_filenames[index], 0)
-            masks = [(mask == v) for v in CLASS_VALUES]
-            mask = np.stack(masks, axis=-1).astype('float')
-            # add background if mask is not binary
-            if mask.shape[-1] != 1:
-                background = 1 - mask.sum(axis=-1, keepdims=True)
-                mask = np.concatenate((mask, background), axis=-1)
-
-            #create the required Example representation
-            out = parse_single_image(image=img, label=mask)
-            
-            writer.write(out.SerializeToString())
-            current_shard_count+=1
-            file_count += 1
-        writer.close()
-    print(f"\nWrote {file_count} elements to TFRecord")
+    return write_pairs_to_tfr(list(zip(img_filenames, label_filenames)), filename, max_files, out_dir, num_workers, mode, stratify)
+
+def write_pairs_to_tfr(pairs, filename:str="batch", max_files:int=100, out_dir:str="/data/tfrecord/", num_workers:int=NUM_WORKERS, mode:str=BUILD_MODE, stratify:bool=STRATIFY):
+    config = {"class_values": CLASS_VALUES, "label_format": LABEL_FORMAT, "image_codec": IMAGE_CODEC, "compression_type": ENCODING_TYPE, "channels": IMAGE_CHANNELS}
+    manifest_info = {"label_format": LABEL_FORMAT, "image_codec": IMAGE_CODEC, "class_values": CLASS_VALUES, "image_channels": IMAGE_CHANNELS}
+    if stratify and mode == "compact":
+        # compaction only copies serialized records, the groups of the existing indices are kept without reading any label
+        groups = [group for group in (LESION, NO_LESION) if tf.io.gfile.exists(index_path(out_dir, group_filename(group, filename)))]
+        return {group: write_split(None, group_filename(group, filename), max_files, out_dir, num_workers, mode,
+                                   config, dict(manifest_info, group=group))
+                for group in groups}
+    if stratify:
+        groups = group_pairs(pairs, functools.partial(lesion_group, class_values=CLASS_VALUES))
+        return {group: write_split(items, group_filename(group, filename), max_files, out_dir, num_workers, mode,
+                                   config, dict(manifest_info, group=group))
+                for group, items in groups.items()}
+    return write_split(pairs, filename, max_files, out_dir, num_workers, mode, config, manifest_info)
+
+def write_split(pairs, filename, max_files, out_dir, num_workers, mode, config, manifest_info):
+    if mode == "compact":
+        index = compact(config, max_files, filename=filename, out_dir=out_dir, compression_type=ENCODING_TYPE, **manifest_info)
+    else:
+        if mode == "full": # base and delta shards of previous builds would still be globbed by the training scripts
+            removed = remove_build(out_dir, filename)
+            if removed > 0:
+                print(f"Info: Removed {removed} shard(s) of the previous build of {filename}")
+        print(f"\nUp to {max_files} samples per shard for {len(pairs)} files of {filename} on {max(num_workers, 1)} process(es), {mode} build")
+        example_fn = functools.partial(segmentation_example, class_values=CLASS_VALUES, label_format=LABEL_FORMAT, codec=IMAGE_CODEC, channels=IMAGE_CHANNELS)
+        index = incremental_build(pairs, example_fn, config, max_files, filename=filename,
+                                  out_dir=out_dir, compression_type=ENCODING_TYPE, num_workers=num_workers, **manifest_info)
+    if BOX_INDEX:
+        index_split_boxes(out_dir, filename, ENCODING_TYPE)
+    return index
 
 if __name__ == '__main__':
-    if SPLIT_DATASET:
+    if SPLIT_MANIFEST is not None:
+        for split in read_split_manifest(SPLIT_MANIFEST)["splits"]:
+            print(f"Starting to process split **{split}** of {SPLIT_MANIFEST}")
+            write_pairs_to_tfr(load_split(SPLIT_MANIFEST, split), filename=split, max_files=MAX_FILES, out_dir=os.path.join(OUT_PATH, split))
+    elif SPLIT_DATASET:
         for split in DATASET_SPLIT:
             print(f"Starting to process split **{split}**")
             split_img = os.path.join(DATASET_PATH, split)
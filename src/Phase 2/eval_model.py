@@ -22,6 +22,8 @@ import random
 import albumentations as A
 from datetime import datetime
 from tensorflow.keras.callbacks import TensorBoard
+from recordbase.reader import detect_schema, parse_examples_batch, decode_image_batch, decode_label_batch, drop_stale_records
+from recordbase.manifest import load_manifest
 # segmentation_models could also use `tf.keras` if you do not have Keras installed
 # or you could switch to other framework using `sm.set_framework('tf.keras')`
 
@@ -34,6 +36,7 @@ RECORD_ENCODING_TYPE = "ZLIB" # none if no encoding is used
 
 # Model Constants
 BACKBONE = 'efficientnetb3'
+IN_MODEL_PREPROCESSING = True # normalize in the model, weights of models trained either way can be loaded
 # unlabelled 0, iskemik 1, hemorajik 2
 CLASSES = ['iskemik', 'kanama']
 MODEL_WEIGHT_PATH = "./models/best_01_27_10_09.h5"
@@ -72,45 +75,43 @@ def preprocessing_fn(image, mask):
     aug = get_preprocessing(sm.get_preprocessing(BACKBONE))(image=image, mask=mask)
     return aug["image"], aug["mask"]
 
-def parse_examples_batch(examples):
-    feature_description = {
-        'image/raw_image' : tf.io.FixedLenFeature([], tf.string),
-        'label/raw' : tf.io.FixedLenFeature([], tf.string)
-    }
-    samples = tf.io.parse_example(examples, feature_description)
-    return samples
-
-def prepare_sample(features):
-    image = tf.vectorized_map(lambda x: tf.io.parse_tensor(x, out_type = tf.uint8), features["image/raw_image"])
-    label = tf.vectorized_map(lambda x: tf.io.parse_tensor(x, out_type = tf.float32), features["label/raw"])
+def prepare_sample(features, schema):
+    image = decode_image_batch(features, schema)
+    label = decode_label_batch(features, schema)
+    if IN_MODEL_PREPROCESSING: # uint8 images, the model applies the backbone preprocessing
+        return image, label
     image, label = tf.vectorized_map(lambda x: tf.numpy_function(func=preprocessing_fn, inp=x, Tout=(tf.float32, tf.float32)), [image, label])
     return image, label
 
-def prepare_sample_aug(features):
-    image = tf.vectorized_map(lambda x: tf.io.parse_tensor(x, out_type = tf.uint8), features["image/raw_image"])
-    label = tf.vectorized_map(lambda x: tf.io.parse_tensor(x, out_type = tf.float32), features["label/raw"]) # this was float64
+def prepare_sample_aug(features, schema):
+    image = decode_image_batch(features, schema)
+    label = decode_label_batch(features, schema) # float32 one-hot for both label formats
     image, label = tf.vectorized_map(lambda x: tf.numpy_function(func=aug_fn, inp=x, Tout=(tf.uint8, tf.float32)), [image, label])
+    if IN_MODEL_PREPROCESSING: # uint8 images, the model applies the backbone preprocessing
+        return image, label
     image, label = tf.vectorized_map(lambda x: tf.numpy_function(func=preprocessing_fn, inp=x, Tout=(tf.float32, tf.float32)), [image, label])
     return image, label
 
 def get_dataset_optimized(filenames, batch_size, shuffle_size, augment=True):
+    schema = detect_schema(filenames[0], RECORD_ENCODING_TYPE) # legacy one-hot or uint8 class map records
     record_dataset = tf.data.TFRecordDataset(filenames, compression_type=RECORD_ENCODING_TYPE, num_parallel_reads=AUTOTUNE)
+    record_dataset = drop_stale_records(record_dataset, load_manifest(filenames)["stale_hashes"]) # records replaced by incremental builds
     if shuffle_size > 0:
         record_dataset = record_dataset.shuffle(shuffle_size)
     record_dataset = (record_dataset
                     .batch(batch_size=batch_size)
-                    .map(map_func=parse_examples_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE))
+                    .map(map_func=lambda x: parse_examples_batch(x, schema), num_parallel_calls=tf.data.experimental.AUTOTUNE))
     if augment:
-        record_dataset = record_dataset.map(map_func=prepare_sample_aug, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        record_dataset = record_dataset.map(map_func=lambda x: prepare_sample_aug(x, schema), num_parallel_calls=tf.data.experimental.AUTOTUNE)
     else:
-        record_dataset = record_dataset.map(map_func=prepare_sample, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        record_dataset = record_dataset.map(map_func=lambda x: prepare_sample(x, schema), num_parallel_calls=tf.data.experimental.AUTOTUNE)
     return record_dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
 n_classes = 1 if len(CLASSES) == 1 else (len(CLASSES) + 1)  # case for binary and multiclass segmentation
 activation = 'sigmoid' if n_classes == 1 else 'softmax'
 
 #create model
-model = sm.Unet(BACKBONE, classes=n_classes, activation=activation)
+model = sm.Unet(BACKBONE, classes=n_classes, activation=activation, input_preprocessing=IN_MODEL_PREPROCESSING)
 
 # define optomizer
 optim = keras.optimizers.Adam(LR)
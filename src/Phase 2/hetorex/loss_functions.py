@@ -2,12 +2,20 @@ import tensorflow as tf
 from keras import backend as K
 
 
+def upcast(*tensors):
+    '''
+    Casts float16 / bfloat16 tensors to float32, epsilon clipping, log and pow are not safe in them
+    '''
+    return [tf.cast(t, tf.float32) if t.dtype in (tf.float16, tf.bfloat16) else t for t in map(tf.convert_to_tensor, tensors)]
+
+
 def Multiclass_combo_loss(ce_w = 0.5, ce_d_w = 0.5, e = K.epsilon(), smooth = 1):
     '''
     ce_w values smaller than 0.5 penalize false positives more while values larger than 0.5 penalize false negatives more
     ce_d_w is level of contribution of the cross-entropy loss in the total loss.
     '''
     def Combo_loss(y_true, y_pred):
+        y_true, y_pred = upcast(y_true, y_pred)
         y_true = K.permute_dimensions(y_true, (3,1,2,0))
         y_pred = K.permute_dimensions(y_pred, (3,1,2,0))
 
@@ -47,6 +55,7 @@ def lovasz_softmax(probas, labels, classes='present', per_image=False, ignore=No
       ignore: void class labels
       order: use BHWC or BCHW
     """
+    probas, = upcast(probas)
     if per_image:
         def treat_image(prob_lab):
             prob, lab = prob_lab
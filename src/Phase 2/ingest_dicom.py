@@ -0,0 +1,61 @@
+# Streams DICOM slices straight into sharded records: parallel reading, batched windowing and
+# writing in one pass, without the png round trip of dicom_to_png.ipynb and create_tfrecords.py.
+# Runs incrementally, slices that are already in the record base are not read again.
+import os
+import functools
+import tensorflow as tf
+from recordbase.dicom import dicom_examples, BRAIN_WINDOW
+from recordbase.schema import CLASS_MAP, RAW, GRAY
+from recordbase.writer import sort_and_shuffle
+from recordbase.incremental import incremental_build
+from recordbase.boxes import index_split_boxes
+
+# Dataset Constants
+DICOM_PATH = "./dicoms/train"
+DICOM_EXT = "dcm"
+LABEL_PATH = "./dicoms/train_label" # label png of a slice has the same name as its dicom with png extension, None for unlabelled studies
+MISSING_LABEL_AS_BACKGROUND = True # slices without a label png only contain background
+OUT_PATH = "./outdata/tfrecord/"
+SPLIT_NAME = "train"
+
+CLASS_VALUES = [1, 2]
+WINDOW = BRAIN_WINDOW # window level, window width
+IMAGE_CHANNELS = GRAY # gray, rgb (3 copies of WINDOW) or multi_window (brain, subdural, bone windows)
+IMAGE_CODEC = RAW
+
+MAX_FILES = 200
+ENCODING_TYPE = "ZLIB"
+NUM_WORKERS = os.cpu_count() # every worker reads and writes whole shards
+READ_BATCH = 32 # slices windowed together
+SHUFFLE_SEED = 42
+BOX_INDEX = True # write the per slice box index next to the shards, needed by PATCH_SIZE of train_model.py
+
+
+def get_dicom_pairs(dicom_path, label_path):
+    dicom_filenames = sort_and_shuffle(tf.io.gfile.glob(f"{dicom_path}/*.{DICOM_EXT}"), seed=SHUFFLE_SEED)
+    pairs = []
+    for dicom_filename in dicom_filenames:
+        label_filename = None
+        if label_path is not None:
+            stem = os.path.splitext(os.path.basename(dicom_filename))[0]
+            label_filename = os.path.join(label_path, f"{stem}.png")
+            if not os.path.exists(label_filename):
+                if not MISSING_LABEL_AS_BACKGROUND:
+                    raise FileNotFoundError(f"No label for {dicom_filename}")
+                label_filename = None
+        pairs.append((dicom_filename, label_filename))
+    return pairs
+
+
+if __name__ == '__main__':
+    pairs = get_dicom_pairs(DICOM_PATH, LABEL_PATH)
+    print(f"Info: Found {len(pairs)} slices, {sum(1 for _, l in pairs if l is not None)} with labels")
+    config = {"class_values": CLASS_VALUES, "label_format": CLASS_MAP, "image_codec": IMAGE_CODEC,
+              "compression_type": ENCODING_TYPE, "window": list(WINDOW), "channels": IMAGE_CHANNELS}
+    example_fn = functools.partial(dicom_examples, class_values=CLASS_VALUES, window=WINDOW, codec=IMAGE_CODEC, channels=IMAGE_CHANNELS)
+    incremental_build(pairs, example_fn, config, MAX_FILES, filename=SPLIT_NAME, out_dir=OUT_PATH,
+                      compression_type=ENCODING_TYPE, num_workers=NUM_WORKERS, batch_size=READ_BATCH,
+                      label_format=CLASS_MAP, image_codec=IMAGE_CODEC, class_values=CLASS_VALUES, window=list(WINDOW),
+                      image_channels=IMAGE_CHANNELS)
+    if BOX_INDEX:
+        index_split_boxes(OUT_PATH, SPLIT_NAME, ENCODING_TYPE)
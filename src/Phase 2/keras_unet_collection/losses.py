@@ -5,6 +5,16 @@ import numpy as np
 import tensorflow as tf
 import tensorflow.keras.backend as K
 
+def _upcast(y_true, y_pred):
+    '''
+    float32 y_true and y_pred of float16 / bfloat16 predictions, the smoothing constants, 
+    logs and powers of the losses are not safe in them. float32 and float64 inputs are kept.
+    '''
+    y_pred = tf.convert_to_tensor(y_pred)
+    if y_pred.dtype in (tf.float16, tf.bfloat16):
+        y_pred = tf.cast(y_pred, tf.float32)
+    return tf.cast(y_true, y_pred.dtype), y_pred
+
 def _crps_tf(y_true, y_pred, factor=0.05):
     
     '''
@@ -47,8 +57,7 @@ def crps2d_tf(y_true, y_pred, factor=0.05):
         
     '''
     
-    y_pred = tf.convert_to_tensor(y_pred)
-    y_true = tf.cast(y_true, y_pred.dtype)
+    y_true, y_pred = _upcast(y_true, y_pred)
     
     y_pred = tf.squeeze(y_pred)
     y_true = tf.squeeze(y_true)
@@ -108,6 +117,8 @@ def dice_coef(y_true, y_pred, const=K.epsilon()):
         
     '''
     
+    y_true, y_pred = _upcast(y_true, y_pred)
+    
     # flatten 2-d tensors
     y_true_pos = tf.reshape(y_true, [-1])
     y_pred_pos = tf.reshape(y_pred, [-1])
@@ -134,8 +145,7 @@ def dice(y_true, y_pred, const=K.epsilon()):
         
     '''
     # tf tensor casting
-    y_pred = tf.convert_to_tensor(y_pred)
-    y_true = tf.cast(y_true, y_pred.dtype)
+    y_true, y_pred = _upcast(y_true, y_pred)
     
     # <--- squeeze-out length-1 dimensions.
     y_pred = tf.squeeze(y_pred)
@@ -159,6 +169,8 @@ def tversky_coef(y_true, y_pred, alpha=0.5, const=1e-5):
         
     '''
     
+    y_true, y_pred = _upcast(y_true, y_pred)
+    
     # flatten 2-d tensors
     y_true_pos = tf.reshape(y_true, [-1])
     y_pred_pos = tf.reshape(y_pred, [-1])
@@ -191,8 +203,7 @@ def tversky(y_true, y_pred, alpha=0.5, const=K.epsilon()):
         
     '''
     # tf tensor casting
-    y_pred = tf.convert_to_tensor(y_pred)
-    y_true = tf.cast(y_true, y_pred.dtype)
+    y_true, y_pred = _upcast(y_true, y_pred)
     
     # <--- squeeze-out length-1 dimensions.
     y_pred = tf.squeeze(y_pred)
@@ -222,8 +233,7 @@ def focal_tversky(y_true, y_pred, alpha=0.7, gamma=4/3, const=1e-5):
         
     '''
     # tf tensor casting
-    y_pred = tf.convert_to_tensor(y_pred)
-    y_true = tf.cast(y_true, y_pred.dtype)
+    y_true, y_pred = _upcast(y_true, y_pred)
     
     # <--- squeeze-out length-1 dimensions.
     y_pred = tf.squeeze(y_pred)
@@ -239,6 +249,7 @@ def multiclass_focal_tversky(alpha=0.7, gamma=4/3, smooth=K.epsilon()):
         Returns: Loss Function
     """
     def wrapper(y_true, y_pred):
+        y_true, y_pred = _upcast(y_true, y_pred)
         y_true = K.permute_dimensions(y_true, (3,1,2,0))
         y_pred = K.permute_dimensions(y_pred, (3,1,2,0))
 
@@ -274,8 +285,7 @@ def ms_ssim(y_true, y_pred, **kwargs):
     
     """
     
-    y_pred = tf.convert_to_tensor(y_pred)
-    y_true = tf.cast(y_true, y_pred.dtype)
+    y_true, y_pred = _upcast(y_true, y_pred)
     
     y_pred = tf.squeeze(y_pred)
     y_true = tf.squeeze(y_true)
@@ -462,6 +472,8 @@ def triplet_1d(y_true, y_pred, N, margin=5.0):
         
     '''
     
+    y_true, y_pred = _upcast(y_true, y_pred)
+    
     # anchor sample pair separations.
     Embd_anchor = y_pred[:, 0:N]
     Embd_pos = y_pred[:, N:2*N]
@@ -0,0 +1,99 @@
+# Starts NUM_WORKERS local worker processes of a training script, a multi-worker run on one machine for
+# testing. Every worker gets a TF_CONFIG of a localhost cluster, its share of the cores of the machine and
+# the same run stamp, so all workers write into the same MODEL_SAVE_PATH/<run> (see recordbase.distribute).
+# Worker 0 is the chief and prints to the console, the other workers log to LOG_DIR. If a worker fails the
+# others are stopped. Command line arguments (e.g. --resume) are passed on to the script.
+#   python launch_workers.py [--resume [run]]
+# On several nodes run the training script itself on every node with a TF_CONFIG listing all nodes.
+import os
+import sys
+import json
+import time
+import socket
+import subprocess
+from datetime import datetime
+
+NUM_WORKERS = 2
+SCRIPT = "train_model.py" # or "../Phase 1/train_p1.py", relative paths of the script are resolved from the current directory
+HOST = "localhost"
+CPU_ONLY = True # hide GPUs, the workers share the cores of the machine
+THREADS_PER_WORKER = None # intra-op threads of every worker, None splits the cores of the machine evenly
+LOG_DIR = "./logs/workers"
+RUN_STAMP_ENV = "RUN_STAMP" # see recordbase.distribute.run_stamp
+
+def free_ports(count):
+    """count free ports of HOST, kept bound until all are found so they differ"""
+    sockets = []
+    for _ in range(count):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind((HOST, 0))
+        sockets.append(s)
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def worker_env(cluster, index, threads, env=None):
+    """Environment of worker index of cluster"""
+    worker = dict(os.environ, **(env or {}))
+    worker["TF_CONFIG"] = json.dumps({"cluster": cluster, "task": {"type": "worker", "index": index}})
+    worker["TF_NUM_INTRAOP_THREADS"] = worker["OMP_NUM_THREADS"] = str(threads)
+    worker["TF_NUM_INTEROP_THREADS"] = "2"
+    worker["PYTHONUNBUFFERED"] = "1" # worker logs show up while training
+    if CPU_ONLY:
+        worker["CUDA_VISIBLE_DEVICES"] = ""
+    return worker
+
+
+def launch(script, num_workers, args=(), env=None, log_dir=LOG_DIR, threads=THREADS_PER_WORKER):
+    """Runs script on num_workers local workers until all of them exit
+
+    Args:
+        script (str): python script creating its strategy with recordbase.distribute.worker_strategy
+        num_workers (int): worker processes
+        args (list): command line arguments of every worker
+        env (dict): more environment variables of every worker
+        log_dir (str): directory of the logs of the workers other than the chief
+        threads (int): intra-op threads of every worker, None splits the cores evenly
+    Return:
+        int: 0 if every worker succeeded, otherwise the exit code of the first failed worker
+    """
+    cluster = {"worker": [f"{HOST}:{port}" for port in free_ports(num_workers)]}
+    threads = threads or max(1, (os.cpu_count() or 1) // num_workers)
+    env = dict(env or {}, **{RUN_STAMP_ENV: datetime.now().strftime("%d_%m-%H_%M")})
+    os.makedirs(log_dir, exist_ok=True)
+    print(f"Info: Starting {num_workers} worker(s) of {script} with {threads} thread(s) each, logs of workers 1+ in {log_dir}")
+
+    processes, logs = [], []
+    for index in range(num_workers):
+        log = None if index == 0 else open(os.path.join(log_dir, f"worker_{index}.log"), "w")
+        logs.append(log)
+        processes.append(subprocess.Popen([sys.executable, script, *args], env=worker_env(cluster, index, threads, env),
+                                          stdout=log, stderr=None if log is None else subprocess.STDOUT))
+    code = 0
+    try:
+        while any(p.poll() is None for p in processes):
+            failed = [p.returncode for p in processes if p.returncode not in (None, 0)]
+            if len(failed) > 0: # the others would wait for the failed worker in the next all-reduce
+                code = failed[0]
+                break
+            time.sleep(1)
+    except KeyboardInterrupt:
+        code = 1
+    for p in processes:
+        if p.poll() is None:
+            p.terminate()
+    for p in processes:
+        p.wait()
+        code = code or p.returncode
+    for log in logs:
+        if log is not None:
+            log.close()
+    return code
+
+
+if __name__ == '__main__':
+    code = launch(SCRIPT, NUM_WORKERS, sys.argv[1:])
+    print(f"Info: Workers finished with exit code {code}")
+    sys.exit(code)
@@ -0,0 +1,38 @@
+from . import schema
+from . import writer
+from . import reader
+from .writer import plan_shards, write_shards, write_shard, sort_and_shuffle
+from .reader import detect_schema, parse_examples_batch, decode_image_batch, decode_label_batch, drop_stale_records
+from . import manifest
+from .manifest import load_manifest, write_manifest, steps_per_epoch, shuffle_buffer_size
+from . import incremental
+from . import arrays
+from .arrays import ArrayBase, array_dataset, write_array_base
+from . import strata
+from .strata import weighted_record_dataset, regroup_records
+from . import splits
+from .splits import load_split, make_splits, write_split_manifest
+from . import augment
+from .augment import augment_batch
+from . import cache
+from .cache import apply_cache, CACHE_OFF, CACHE_RAM, CACHE_DISK
+from . import resume
+from .resume import ResumeState, ResumeCallback
+from . import loader
+from .loader import SharedMemoryLoader
+from . import boxes
+from .boxes import build_box_index, load_box_index, box_lookup
+from . import patches
+from .patches import sample_patches
+from . import headcrop
+from .headcrop import bucket_by_canvas, crop_to_canvas, CANVAS_SIZES
+from . import hardexamples
+from .hardexamples import HardExampleSampler, HardExampleCallback
+from . import engine
+from .engine import attach_train_step
+from . import precision
+from .precision import precision_policy, set_precision_policy, loss_scale_optimizer, cast_model
+from . import distribute
+from .distribute import worker_strategy, is_chief, shard_batches, distribute_batches
+from . import checkpoints
+from .checkpoints import CheckpointWriter, CheckpointCallback, load_weights
@@ -0,0 +1,160 @@
+# Packed array record base. Images and class maps of a split are stored as two fixed-shape uint8 .npy
+# files next to a json index, so samples are read with np.memmap as zero-copy slices. Unlike the
+# sequential tfrecord shards every sample can be read in any order, a shuffle is a permutation of
+# indexes instead of a shuffle buffer and there is nothing to decode.
+import os
+import json
+import time
+import numpy as np
+import tensorflow as tf
+import tqdm
+
+from .schema import (RGB, IMAGE_CHANNELS, read_bytes, record_key, hash_pair, decode_image_bytes,
+                     decode_png_bytes, class_lookup_table, class_map_lookup_table, lookup, label_depth, class_pixel_counts)
+from .reader import class_map_to_onehot, expand_channels
+
+ARRAY_FORMAT_VERSION = 1
+
+
+def array_paths(out_dir, filename="batch"):
+    """Image array, class map array and index paths of a split"""
+    return (os.path.join(out_dir, f"images_{filename}.npy"),
+            os.path.join(out_dir, f"labels_{filename}.npy"),
+            os.path.join(out_dir, f"array_index_{filename}.json"))
+
+
+def write_array_base(pairs, class_values, out_dir, filename="batch", channels=RGB):
+    """Packs image/label png pairs into a memory mapped array base
+
+    Every image must have the same size, the arrays are allocated from the first pair and filled in place.
+
+    Args:
+        pairs (list): (img_path, label_path) tuples in the order they are stored
+        class_values (list): pixel values of the classes in label png
+        out_dir (str): output directory
+        filename (str): name of the split
+        channels (str): RGB or GRAY
+    Return:
+        dict: written index
+    """
+    start = time.perf_counter()
+    image_path, label_path, index_file = array_paths(out_dir, filename)
+    lut = class_lookup_table(class_values)
+    depth = label_depth(class_values)
+    height, width = decode_png_bytes(read_bytes(pairs[0][1]), 0).shape
+    images = np.lib.format.open_memmap(image_path, mode="w+", dtype=np.uint8,
+                                       shape=(len(pairs), height, width, IMAGE_CHANNELS[channels]))
+    labels = np.lib.format.open_memmap(label_path, mode="w+", dtype=np.uint8, shape=(len(pairs), height, width))
+    keys, hashes = [], []
+    class_pixels = np.zeros(depth, dtype=np.int64)
+    for i, (img_path, lbl_path) in enumerate(tqdm.tqdm(pairs)):
+        img_bytes, label_bytes = read_bytes(img_path), read_bytes(lbl_path)
+        key = record_key(img_path)
+        images[i] = decode_image_bytes(img_bytes, channels)
+        lookup(lut, decode_png_bytes(label_bytes, 0), out=labels[i]) # written straight into the memory map
+        class_pixels += class_pixel_counts(labels[i], depth)
+        keys.append(key)
+        hashes.append(hash_pair(key, img_bytes, label_bytes))
+    images.flush()
+    labels.flush()
+    del images, labels
+
+    index = {
+        "version": ARRAY_FORMAT_VERSION,
+        "records": len(pairs),
+        "height": height,
+        "width": width,
+        "channels": channels,
+        "class_values": class_values,
+        "label_depth": depth,
+        "class_pixels": class_pixels.tolist(),
+        "images": os.path.basename(image_path),
+        "labels": os.path.basename(label_path),
+        "keys": keys,
+        "hashes": hashes,
+    }
+    with tf.io.gfile.GFile(index_file, "w") as f:
+        json.dump(index, f)
+    print(f"Info: Packed {len(pairs)} pairs into {image_path} and {label_path} in {time.perf_counter() - start:.1f}s")
+    return index
+
+
+class ArrayBase:
+    """Read only, memory mapped view of an array base written by write_array_base
+
+    Args:
+        directory (str): directory of the arrays
+        filename (str): name of the split
+    """
+
+    def __init__(self, directory, filename="batch"):
+        _, _, index_file = array_paths(directory, filename)
+        with tf.io.gfile.GFile(index_file) as f:
+            self.index = json.load(f)
+        self.images = np.load(os.path.join(directory, self.index["images"]), mmap_mode="r")
+        self.labels = np.load(os.path.join(directory, self.index["labels"]), mmap_mode="r")
+        self.depth = self.index["label_depth"]
+        self.onehot_table = class_map_lookup_table(self.depth)
+        self.keys = self.index["keys"]
+
+    def __len__(self):
+        return self.index["records"]
+
+    def __getitem__(self, i):
+        """Zero-copy image and class map of sample i"""
+        return self.images[i], self.labels[i]
+
+    def batch(self, indexes):
+        """Copies the samples of indexes into contiguous [B, H, W, C] and [B, H, W] arrays
+
+        Indexes are read in ascending order so neighbouring samples share page cache reads,
+        the batch keeps the order of indexes.
+        """
+        indexes = np.asarray(indexes)
+        order = np.argsort(indexes)
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        sorted_indexes = indexes[order]
+        return self.images[sorted_indexes][inverse], self.labels[sorted_indexes][inverse]
+
+    def onehot(self, class_map, out=None):
+        """Numpy version of reader.class_map_to_onehot for the keras Sequence loaders, written into out when given"""
+        return lookup(self.onehot_table, class_map, out)
+
+
+def array_dataset(base, batch_size, shuffle=True, seed=None, epochs=1, drop_remainder=False, expand=True):
+    """Range indexed tf.data pipeline of an array base
+
+    The dataset shuffles sample indexes, every epoch is a full random permutation of the base
+    without any shuffle buffer of decoded samples. Batches are gathered from the memory map.
+
+    Args:
+        base (ArrayBase): array base to read
+        batch_size (int): batch size
+        shuffle (bool): permute the samples every epoch
+        seed (int): seed of the permutation
+        epochs (int): amount of passes over the base, None repeats forever
+        drop_remainder (bool): drop the last smaller batch of every epoch
+        expand (bool): broadcast single channel images to 3 channels
+    Return:
+        tf.data.Dataset: uint8 [B, H, W, 3] images and float32 [B, H, W, depth] one-hot masks
+    """
+    height, width = base.index["height"], base.index["width"]
+    channels = IMAGE_CHANNELS[base.index["channels"]]
+    depth = base.depth
+
+    def gather(indexes):
+        images, labels = tf.numpy_function(base.batch, [indexes], (tf.uint8, tf.uint8))
+        images.set_shape([None, height, width, channels])
+        labels.set_shape([None, height, width])
+        if channels == 1 and expand:
+            images = expand_channels(images)
+        return images, class_map_to_onehot(labels, depth)
+
+    dataset = tf.data.Dataset.range(len(base))
+    if shuffle:
+        dataset = dataset.shuffle(len(base), seed=seed, reshuffle_each_iteration=True) # indexes only, 8 bytes each
+    return (dataset
+            .batch(batch_size, drop_remainder=drop_remainder)
+            .repeat(epochs)
+            .map(gather, num_parallel_calls=tf.data.AUTOTUNE))
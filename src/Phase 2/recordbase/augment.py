@@ -0,0 +1,186 @@
+# In-graph joint image/mask augmentation, replaces the albumentations aug_fn wrapped in tf.numpy_function.
+# Every transform works on whole [B, H, W, C] batches with per sample random parameters, keeps static
+# shapes and runs without the GIL, so the tf.data map can use real num_parallel_calls parallelism.
+# Geometric transforms are applied identically to images (bilinear) and one-hot masks (nearest neighbour).
+import math
+import tensorflow as tf
+
+# border handling of the geometric transforms. REFLECT repeats the edge pixel (d c b a | a b c d) like
+# cv2.BORDER_REFLECT, the BORDER_REFLECT_101 default of albumentations (d c b | a b c d) has no TF fill mode,
+# the borders differ by one pixel. a constant fill would leave pixels without any one-hot channel in the masks
+FILL_MODE = "REFLECT"
+
+
+def seeded_uniform(seed=None):
+    """tf.random.uniform, or with a seed (int [2] tensor) stateless draws that only depend on the seed
+
+    Every call of the returned function folds its call number into the seed, so the draws of a batch
+    are the same whenever the pipeline is rebuilt, e.g. by a resumed run.
+    """
+    if seed is None:
+        return tf.random.uniform
+    calls = [0]
+
+    def uniform(shape, minval=0, maxval=None, dtype=tf.float32):
+        calls[0] += 1
+        if maxval is None:
+            maxval = 1
+        return tf.random.stateless_uniform(shape, tf.random.experimental.stateless_fold_in(seed, calls[0]), minval, maxval, dtype)
+    return uniform
+
+
+def _random_mask(batch_size, p, uniform=tf.random.uniform):
+    """Per sample bool, True with probability p"""
+    return uniform([batch_size]) < p
+
+
+def shift_scale_rotate_transforms(angles, scales, shifts_x, shifts_y, height, width):
+    """Projective transforms rotating by angles (radians) and scaling around the image center, then shifting
+
+    Shifts are fractions of the image size. Returns [B, 8] transforms in the output to input
+    convention of ImageProjectiveTransform.
+    """
+    height = tf.cast(height, tf.float32)
+    width = tf.cast(width, tf.float32)
+    cx, cy = (width - 1) / 2, (height - 1) / 2
+    tx, ty = shifts_x * width, shifts_y * height
+    cos = tf.cos(angles) / scales
+    sin = tf.sin(angles) / scales
+    zeros = tf.zeros_like(angles)
+    return tf.stack([cos, sin, cx - cos * (cx + tx) - sin * (cy + ty),
+                     -sin, cos, cy + sin * (cx + tx) - cos * (cy + ty),
+                     zeros, zeros], axis=1)
+
+
+def transform_images(images, transforms, interpolation="BILINEAR"):
+    """Applies [B, 8] projective transforms to float [B, H, W, C] images"""
+    out = tf.raw_ops.ImageProjectiveTransformV3(images=images, transforms=transforms, output_shape=tf.shape(images)[1:3],
+                                                fill_value=0.0, interpolation=interpolation, fill_mode=FILL_MODE)
+    out.set_shape(images.shape)
+    return out
+
+
+def random_flip(images, masks, p=0.5, horizontal=True, vertical=True, uniform=tf.random.uniform):
+    """Flips every sample with probability p, like A.Flip
+
+    A flipped sample is flipped horizontally, vertically or both with equal chance, with a single enabled
+    axis it is always flipped along that axis.
+    """
+    modes = [mode for mode in ((True, False), (False, True), (True, True))
+             if (horizontal or not mode[0]) and (vertical or not mode[1])]
+    if len(modes) == 0:
+        return images, masks
+    batch_size = tf.shape(images)[0]
+    mode = uniform([batch_size], 0, len(modes), dtype=tf.int32)
+    apply = _random_mask(batch_size, p, uniform)
+    for axis, column in ((2, 0), (1, 1)):
+        if not any(m[column] for m in modes):
+            continue
+        flip = tf.logical_and(apply, tf.gather(tf.constant([m[column] for m in modes]), mode))[:, tf.newaxis, tf.newaxis, tf.newaxis]
+        images = tf.where(flip, tf.reverse(images, [axis]), images)
+        if masks is not None:
+            masks = tf.where(flip, tf.reverse(masks, [axis]), masks)
+    return images, masks
+
+
+def random_shift_scale_rotate(images, masks, p=0.5, rotate_limit=0, shift_limit=0.0, scale_limit=0.0, uniform=tf.random.uniform):
+    """Random rotation (degrees), shift (fraction of the size) and scale (fraction) in a single resampling pass
+
+    rotate_limit alone is A.Rotate, all three are A.ShiftScaleRotate.
+    """
+    batch_size = tf.shape(images)[0]
+    apply = tf.cast(_random_mask(batch_size, p, uniform), tf.float32)
+    symmetric = lambda limit: uniform([batch_size], -limit, limit) * apply
+    angles = symmetric(rotate_limit * math.pi / 180)
+    scales = 1 + symmetric(scale_limit)
+    transforms = shift_scale_rotate_transforms(angles, scales, symmetric(shift_limit), symmetric(shift_limit),
+                                               tf.shape(images)[1], tf.shape(images)[2])
+    images = transform_images(images, transforms)
+    if masks is not None:
+        masks = transform_images(masks, transforms, interpolation="NEAREST")
+    return images, masks
+
+
+def _gather(images, y, x):
+    return tf.gather_nd(images, tf.cast(tf.stack([y, x], axis=-1), tf.int32), batch_dims=1)
+
+
+def warp_images(images, flow, nearest=False):
+    """Samples [B, H, W, C] images at every pixel + flow ([B, H, W, 2] as dy, dx), borders are clamped"""
+    shape = tf.shape(images)
+    height = tf.cast(shape[1], tf.float32)
+    width = tf.cast(shape[2], tf.float32)
+    grid_y, grid_x = tf.meshgrid(tf.range(height), tf.range(width), indexing="ij")
+    y = tf.clip_by_value(grid_y + flow[..., 0], 0, height - 1)
+    x = tf.clip_by_value(grid_x + flow[..., 1], 0, width - 1)
+    if nearest:
+        return _gather(images, tf.round(y), tf.round(x))
+    y0, x0 = tf.floor(y), tf.floor(x)
+    y1, x1 = tf.minimum(y0 + 1, height - 1), tf.minimum(x0 + 1, width - 1)
+    wy, wx = (y - y0)[..., tf.newaxis], (x - x0)[..., tf.newaxis]
+    top = _gather(images, y0, x0) * (1 - wx) + _gather(images, y0, x1) * wx
+    bottom = _gather(images, y1, x0) * (1 - wx) + _gather(images, y1, x1) * wx
+    return top * (1 - wy) + bottom * wy
+
+
+def random_elastic(images, masks, p=0.5, alpha=0.0, grid=8, uniform=tf.random.uniform):
+    """Elastic deformation, a random displacement of up to alpha pixels on a grid x grid lattice upsampled
+    bicubically to the image size. A coarser grid is a smoother field, like a larger sigma of A.ElasticTransform.
+    """
+    shape = tf.shape(images)
+    apply = tf.cast(_random_mask(shape[0], p, uniform), tf.float32)[:, tf.newaxis, tf.newaxis, tf.newaxis]
+    coarse = uniform([shape[0], grid, grid, 2], -1.0, 1.0)
+    flow = tf.image.resize(coarse, shape[1:3], method="bicubic") * alpha * apply
+    images = warp_images(images, flow)
+    if masks is not None:
+        masks = warp_images(masks, flow, nearest=True)
+    return images, masks
+
+
+def random_intensity(images, p=0.5, brightness=0.0, contrast=0.0, uniform=tf.random.uniform):
+    """Brightness (fraction of 255) and contrast (fraction around the image mean) jitter, images only"""
+    batch_size = tf.shape(images)[0]
+    apply = tf.cast(_random_mask(batch_size, p, uniform), tf.float32)[:, tf.newaxis, tf.newaxis, tf.newaxis]
+    delta = uniform([batch_size, 1, 1, 1], -brightness, brightness) * 255
+    factor = uniform([batch_size, 1, 1, 1], 1 - contrast, 1 + contrast)
+    mean = tf.reduce_mean(images, axis=[1, 2, 3], keepdims=True)
+    jittered = (images - mean) * factor + mean + delta
+    return images + (jittered - images) * apply
+
+
+def augment_batch(images, masks=None, p=0.5, flip=False, rotate_limit=0, shift_limit=0.0, scale_limit=0.0,
+                  elastic_alpha=0.0, elastic_grid=8, brightness=0.0, contrast=0.0, seed=None):
+    """Augments a batch of images and their one-hot masks, transforms with a zero limit are skipped
+
+    Args:
+        images (tf.Tensor): uint8 [B, H, W, C] images
+        masks (tf.Tensor): float [B, H, W, depth] one-hot masks or None for classification
+        p (float): probability of every transform, per sample
+        flip (bool): random horizontal and vertical flips, like A.Flip
+        rotate_limit (float): maximum rotation in degrees, like A.Rotate(limit)
+        shift_limit (float): maximum shift as a fraction of the image size
+        scale_limit (float): maximum scale change, 0.1 scales between 0.9 and 1.1
+        elastic_alpha (float): maximum elastic displacement in pixels
+        elastic_grid (int): size of the elastic displacement lattice
+        brightness (float): maximum brightness change as a fraction of 255
+        contrast (float): maximum contrast change
+        seed (tf.Tensor): int [2] seed of stateless draws, e.g. (run seed, batch position), None draws from the global seed
+    Return:
+        uint8 images and float32 masks (None if masks is None) with the input shapes
+    """
+    out_images = tf.cast(images, tf.float32)
+    out_masks = None if masks is None else tf.cast(masks, tf.float32)
+    uniform = seeded_uniform(seed)
+    if flip:
+        out_images, out_masks = random_flip(out_images, out_masks, p, uniform=uniform)
+    if rotate_limit or shift_limit or scale_limit:
+        out_images, out_masks = random_shift_scale_rotate(out_images, out_masks, p, rotate_limit, shift_limit, scale_limit, uniform)
+    if elastic_alpha:
+        out_images, out_masks = random_elastic(out_images, out_masks, p, elastic_alpha, elastic_grid, uniform)
+    if brightness or contrast:
+        out_images = random_intensity(out_images, p, brightness, contrast, uniform)
+    out_images = tf.cast(tf.clip_by_value(tf.round(out_images), 0, 255), tf.uint8)
+    out_images.set_shape(images.shape)
+    if out_masks is not None:
+        out_masks.set_shape(masks.shape)
+    return out_images, out_masks
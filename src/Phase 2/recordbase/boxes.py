@@ -0,0 +1,134 @@
+# Per-slice bounding box index stored next to the shards of a record base. Boxes are keyed by the
+# record/hash of every record, so records replaced by incremental builds never collide with their
+# replacements, and looked up in-graph by the samplers instead of being searched in every mask.
+import os
+import json
+import time
+import numpy as np
+import tensorflow as tf
+import tqdm
+
+from .schema import RECORD_KEY_KEY, RECORD_HASH_KEY, CLASS_MAP_KEY, LABEL_DEPTH_KEY, LABEL_KEY, mask_box
+from .manifest import manifest_path
+
+BOX_INDEX_VERSION = 1
+BOX_INDEX_GLOB = "boxes*.json"
+LESION_BOX = "lesion" # every pixel of any class
+NO_BOX = [-1, -1, -1, -1] # slices without any pixel of the box
+
+
+def box_index_path(out_dir, filename="batch"):
+    """Box index of a split, several splits can share a directory"""
+    return os.path.join(out_dir, f"boxes_{filename}.json")
+
+
+def lesion_box(class_map, depth):
+    """Box of the class pixels of a class map, the background is the last index of multiclass maps"""
+    return mask_box(class_map == 1 if depth == 1 else class_map < depth - 1)
+
+
+def _record_class_map(feature):
+    """uint8 class map and depth of a parsed example of either label format"""
+    height = feature['image/height'].int64_list.value[0]
+    width = feature['image/width'].int64_list.value[0]
+    if CLASS_MAP_KEY in feature:
+        class_map = np.frombuffer(feature[CLASS_MAP_KEY].bytes_list.value[0], dtype=np.uint8).reshape(height, width)
+        return class_map, feature[LABEL_DEPTH_KEY].int64_list.value[0]
+    mask = tf.io.parse_tensor(feature[LABEL_KEY].bytes_list.value[0], out_type=tf.float32).numpy()
+    if mask.shape[-1] == 1:
+        return (mask[..., 0] > 0.5).astype(np.uint8), 1
+    return np.argmax(mask, axis=-1).astype(np.uint8), mask.shape[-1]
+
+
+def record_boxes(serialized):
+    """Record hash, key and boxes of a serialized segmentation example"""
+    feature = tf.train.Example.FromString(serialized).features.feature
+    if RECORD_HASH_KEY not in feature:
+        raise ValueError("Records without record/hash can not be indexed, write the base again with create_tfrecords.py")
+    class_map, depth = _record_class_map(feature)
+    return (feature[RECORD_HASH_KEY].bytes_list.value[0].decode(), feature[RECORD_KEY_KEY].bytes_list.value[0].decode(),
+            {LESION_BOX: lesion_box(class_map, depth)})
+
+
+def _shard_stat(filename):
+    stat = tf.io.gfile.stat(filename)
+    return [stat.length, stat.mtime_nsec]
+
+
+def build_box_index(filenames, compression_type, path):
+    """Reads the records of a split and writes its box index
+
+    Shards that did not change since the index at path was written are not read again, so
+    indexing after an incremental build only reads the new delta shards.
+
+    Args:
+        filenames (list): shards of a single split
+        compression_type (str): ZLIB, GZIP or None
+        path (str): output path, see box_index_path
+    Return:
+        dict: written index
+    """
+    start = time.perf_counter()
+    previous = {"shards": {}, "records": {}}
+    if tf.io.gfile.exists(path):
+        with tf.io.gfile.GFile(path) as f:
+            previous = json.load(f)
+        if previous.get("version") != BOX_INDEX_VERSION:
+            previous = {"shards": {}, "records": {}}
+    shards = {os.path.basename(f): _shard_stat(f) for f in sorted(filenames)}
+    unchanged = {shard for shard, stat in shards.items() if previous["shards"].get(shard) == stat}
+    records = {h: r for h, r in previous["records"].items() if r["shard"] in unchanged}
+    changed = [f for f in sorted(filenames) if os.path.basename(f) not in unchanged]
+    for filename in tqdm.tqdm(changed):
+        for serialized in tf.data.TFRecordDataset(filename, compression_type=compression_type):
+            record_hash, key, boxes = record_boxes(serialized.numpy())
+            records[record_hash] = dict(boxes, key=key, shard=os.path.basename(filename))
+    index = {"version": BOX_INDEX_VERSION, "fields": [LESION_BOX], "shards": shards, "records": records}
+    with tf.io.gfile.GFile(path, "w") as f:
+        json.dump(index, f)
+    with_lesion = sum(1 for r in records.values() if r[LESION_BOX] is not None)
+    print(f"Info: Indexed boxes of {len(records)} records ({with_lesion} with lesions, {len(changed)} shard(s) read) "
+          f"to {path} in {time.perf_counter() - start:.1f}s")
+    return index
+
+
+def index_split_boxes(out_dir, filename, compression_type):
+    """Box index of the shards listed in the manifest of a split, called by the writers after a build"""
+    with tf.io.gfile.GFile(manifest_path(out_dir, filename)) as f:
+        shards = json.load(f)["shards"]
+    return build_box_index([os.path.join(out_dir, shard["file"]) for shard in shards], compression_type,
+                           box_index_path(out_dir, filename))
+
+
+def load_box_index(filenames):
+    """Combines the box indexes next to filenames into {record hash: boxes}
+
+    Raises:
+        FileNotFoundError: if no box index is found next to the shards
+    """
+    records = {}
+    for directory in sorted({os.path.dirname(f) for f in filenames}):
+        for path in sorted(tf.io.gfile.glob(os.path.join(directory, BOX_INDEX_GLOB))):
+            with tf.io.gfile.GFile(path) as f:
+                records.update(json.load(f)["records"])
+    if len(records) == 0:
+        raise FileNotFoundError(f"No box index next to {filenames[0]}, run create_box_index.py on the record base")
+    return records
+
+
+def box_lookup(records, field):
+    """In-graph lookup of the boxes of a batch of record hashes
+
+    Args:
+        records (dict): output of load_box_index
+        field (str): box to look up, e.g. LESION_BOX
+    Return:
+        callable: string [B] record hashes -> int32 [B, 4] boxes, NO_BOX for unknown records and empty boxes
+    """
+    hashes = list(records)
+    boxes = np.array([records[h].get(field) or NO_BOX for h in hashes] + [NO_BOX], dtype=np.int32)
+    table = tf.lookup.StaticHashTable(
+        tf.lookup.KeyValueTensorInitializer(tf.constant(hashes), tf.range(len(hashes), dtype=tf.int64)),
+        default_value=len(hashes))
+    boxes = tf.constant(boxes)
+    return lambda record_hashes: tf.gather(boxes, table.lookup(record_hashes))
@@ -0,0 +1,62 @@
+# Cache stage of the reading pipelines. Records are cached after parsing and decoding but before
+# augmentation and normalization, in their compact form (uint8 images with the stored channels and uint8
+# class maps), so later epochs skip inflating, parsing and decoding. Disk snapshots live in a directory
+# named after a hash of the decode config and the shard list, a changed shard or config gets a new one.
+import os
+import json
+import hashlib
+import tensorflow as tf
+
+from .schema import IMAGE_CHANNELS
+
+CACHE_OFF = "off"
+CACHE_RAM = "ram"
+CACHE_DISK = "disk"
+CACHE_POLICIES = [CACHE_OFF, CACHE_RAM, CACHE_DISK]
+
+# bump when the cached form changes, old snapshots are not read again
+CACHE_STAGE_VERSION = 1
+
+
+def cache_key(filenames, config):
+    """Hash of the decode config and of the name, size and modification time of every shard"""
+    shards = []
+    for filename in sorted(filenames):
+        stat = tf.io.gfile.stat(filename)
+        shards.append([os.path.basename(filename), stat.length, stat.mtime_nsec])
+    content = json.dumps({"version": CACHE_STAGE_VERSION, "config": config, "shards": shards}, sort_keys=True)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def apply_cache(dataset, policy, filenames, config, cache_dir="./cache"):
+    """Caches dataset in RAM or as an on-disk snapshot
+
+    Args:
+        dataset (tf.data.Dataset): deterministic part of the pipeline, nothing random may come before it
+        policy (str): one of CACHE_POLICIES
+        filenames (list): shards read by dataset
+        config (dict): everything else changing the elements of dataset (schema, stale hashes, ...)
+        cache_dir (str): parent directory of the snapshots
+    Return:
+        tf.data.Dataset: cached dataset
+    """
+    if policy == CACHE_OFF:
+        return dataset
+    if policy == CACHE_RAM:
+        return dataset.cache()
+    if policy != CACHE_DISK:
+        raise ValueError(f"Unknown cache policy {policy}, use one of {CACHE_POLICIES}")
+    path = os.path.join(cache_dir, cache_key(filenames, config))
+    if not tf.io.gfile.exists(path):
+        tf.io.gfile.makedirs(path)
+        with tf.io.gfile.GFile(os.path.join(path, "cache_config.json"), "w") as f:
+            json.dump({"config": config, "shards": sorted(os.path.basename(f) for f in filenames)}, f, indent=2)
+    print(f"Info: Snapshot of {len(filenames)} shard(s) at {path}")
+    return dataset.apply(tf.data.experimental.snapshot(path, compression="AUTO"))
+
+
+def decoded_shuffle_size(schema, records, memory_mb):
+    """Largest shuffle buffer of decoded samples (image and class map) fitting into memory_mb"""
+    channels = schema.get("depth") or IMAGE_CHANNELS["rgb"]
+    sample_bytes = schema["height"] * schema["width"] * (channels + 1)
+    return int(max(1, min(records, memory_mb * 2**20 // sample_bytes)))
@@ -0,0 +1,171 @@
+# Weight checkpoints written in the background. At the end of an epoch the weights are copied to host memory
+# (model.get_weights) and training goes on, a writer thread saves the copy as a tf.train.Checkpoint in
+# MODEL_SAVE_PATH/<run>/checkpoints, optionally with float16 weights. Only the best_k checkpoints by the
+# monitored metric and the last_n checkpoints are kept, the .h5 models are exported once at the end of
+# training. The optimizer state needed to continue a run is saved by resume.ResumeState.
+import os
+import json
+import queue
+import threading
+import numpy as np
+import tensorflow as tf
+
+CHECKPOINT_DIR = "checkpoints"
+INDEX_FILE = "checkpoints.json" # epochs and monitored values of the kept checkpoints
+WEIGHT_KEY = "weight_{:05d}" # checkpoint key of the i-th entry of model.weights
+FLOAT16_MAX = float(np.finfo(np.float16).max)
+
+
+def weight_key(index):
+    return f"{WEIGHT_KEY.format(index)}/.ATTRIBUTES/VARIABLE_VALUE"
+
+
+def to_float16(weight):
+    """float16 copy of a float weight, weights outside the float16 range (e.g. large variances) stay as they are"""
+    if weight.dtype in (np.float32, np.float64) and np.all(np.abs(weight) <= FLOAT16_MAX):
+        return weight.astype(np.float16)
+    return weight
+
+
+def load_weights(model, path):
+    """Sets the weights of model from a checkpoint of CheckpointWriter, float16 weights are cast back"""
+    reader = tf.train.load_checkpoint(path)
+    model.set_weights([reader.get_tensor(weight_key(i)).astype(v.dtype.as_numpy_dtype) for i, v in enumerate(model.weights)])
+
+
+class CheckpointWriter:
+    """Writes weight snapshots of a model from a background thread and keeps the best and the last ones
+
+    Args:
+        run_dir (str): MODEL_SAVE_PATH/<run>, the checkpoints go to run_dir/checkpoints
+        monitor (str): metric of the logs ranking the checkpoints, like ModelCheckpoint
+        mode (str): min or max, the better direction of monitor
+        best_k (int): best checkpoints kept
+        last_n (int): most recent checkpoints kept
+        float16 (bool): store float weights as float16, half the size on disk
+    """
+
+    def __init__(self, run_dir, monitor="val_loss", mode="min", best_k=3, last_n=2, float16=False):
+        if mode not in ("min", "max"):
+            raise ValueError(f"Unknown mode {mode}, use min or max")
+        self.directory = os.path.join(run_dir, CHECKPOINT_DIR)
+        self.monitor = monitor
+        self.mode = mode
+        self.best_k = best_k
+        self.last_n = last_n
+        self.float16 = float16
+        tf.io.gfile.makedirs(self.directory)
+        self.entries = self._read_index() # a resumed run keeps ranking its earlier checkpoints
+        self.error = None
+        # one snapshot waits while the previous one is written, a slower writer makes the training thread wait
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+        self.thread.start()
+
+    def save(self, model, epoch, value=None):
+        """Copies the weights of model to host memory and queues them, returns as soon as the copy is done"""
+        self._raise_error()
+        self.queue.put((model.get_weights(), epoch, value))
+
+    def flush(self):
+        """Waits until every queued snapshot is written"""
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+    def path(self, entry):
+        return os.path.join(self.directory, entry["name"])
+
+    def best(self):
+        """Entry of the best kept checkpoint, None without a monitored value"""
+        ranked = self._ranked()
+        return ranked[0] if len(ranked) > 0 else None
+
+    def export(self, model, path):
+        """Saves model with the weights of the best checkpoint as .h5, model keeps its own weights
+
+        Return:
+            str: path, None if there is no checkpoint with a monitored value
+        """
+        self.flush()
+        best = self.best()
+        if best is None:
+            return None
+        weights = model.get_weights()
+        load_weights(model, self.path(best))
+        model.save(path)
+        model.set_weights(weights)
+        print(f"Info: Exported epoch {best['epoch']} ({self.monitor} {best['value']:.5f}) to {path}")
+        return path
+
+    def _ranked(self):
+        scored = [e for e in self.entries if e["value"] is not None]
+        return sorted(scored, key=lambda e: e["value"], reverse=self.mode == "max")
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e: # raised on the training thread by the next save or flush
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, weights, epoch, value):
+        name = f"epoch_{epoch:03d}"
+        if self.float16:
+            weights = [to_float16(w) for w in weights]
+        with tf.device("CPU:0"):
+            variables = {WEIGHT_KEY.format(i): tf.Variable(w, trainable=False) for i, w in enumerate(weights)}
+        tf.train.Checkpoint(**variables).write(os.path.join(self.directory, name))
+        self.entries = [e for e in self.entries if e["name"] != name] + [{"name": name, "epoch": epoch, "value": value}]
+        # retention, the index only lists checkpoints that are completely written
+        kept = sorted(self.entries, key=lambda e: e["epoch"])[-self.last_n:] if self.last_n > 0 else []
+        kept = {e["name"] for e in kept + self._ranked()[:self.best_k]}
+        for entry in [e for e in self.entries if e["name"] not in kept]:
+            for filename in tf.io.gfile.glob(f"{self.path(entry)}.*"):
+                tf.io.gfile.remove(filename)
+        self.entries = [e for e in self.entries if e["name"] in kept]
+        with tf.io.gfile.GFile(os.path.join(self.directory, INDEX_FILE), "w") as f:
+            json.dump({"monitor": self.monitor, "mode": self.mode, "checkpoints": self.entries}, f, indent=2)
+
+    def _read_index(self):
+        path = os.path.join(self.directory, INDEX_FILE)
+        if not tf.io.gfile.exists(path):
+            return []
+        with tf.io.gfile.GFile(path) as f:
+            return json.load(f)["checkpoints"]
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+class CheckpointCallback(tf.keras.callbacks.Callback):
+    """Snapshots the weights into a CheckpointWriter every save_epochs epochs
+
+    Args:
+        writer (CheckpointWriter): writer of the run, only the chief of a multi-worker run has one
+        save_epochs (int): epochs between snapshots
+    """
+
+    def __init__(self, writer, save_epochs=1):
+        super(CheckpointCallback, self).__init__()
+        self.writer = writer
+        self.save_epochs = save_epochs
+
+    def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.save_epochs == 0:
+            value = (logs or {}).get(self.writer.monitor)
+            self.writer.save(self.model, epoch + 1, None if value is None else float(value))
+
+    def on_train_end(self, logs=None):
+        self.writer.flush()
@@ -0,0 +1,82 @@
+# DICOM side of the record writers. Slices are windowed in batches and written straight into
+# records, no intermediate png is written or decoded.
+import numpy as np
+import SimpleITK as sitk
+
+from .schema import (RAW, RGB, GRAY, MULTI_WINDOW, read_bytes, record_key, hash_pair, record_features, decode_png_bytes,
+                     label_depth, class_lookup_table, lookup, class_pixel_counts, parse_single_image_class_map,
+                     head_box_features)
+
+BRAIN_WINDOW = (40, 100) # window level, window width in HU, same as dicom_to_png.ipynb
+SUBDURAL_WINDOW = (80, 200)
+BONE_WINDOW = (600, 2800)
+MULTI_WINDOWS = [BRAIN_WINDOW, SUBDURAL_WINDOW, BONE_WINDOW] # channel order of MULTI_WINDOW images
+
+
+def windowed_image(images, wLevel, wWidth):
+    """Vectorized windowedImage of dicom_to_png.ipynb, works on a single slice or a [N, H, W] stack
+
+    Args:
+        images (np.ndarray): hounsfield unit values
+        wLevel (float): window level
+        wWidth (float): window width
+    Return:
+        np.ndarray: uint8 windowed images with the same shape
+    """
+    wStart = wLevel - wWidth / 2
+    imgray = np.subtract(images, wStart, dtype=np.float32)
+    imgray *= 255 / wWidth
+    np.clip(imgray, 0, 255, out=imgray)
+    return imgray.astype(np.uint8)
+
+
+def read_dicom_slice(dicom_path):
+    """Reads a single slice DICOM file as hounsfield units, SimpleITK applies the rescale slope/intercept"""
+    return sitk.GetArrayFromImage(sitk.ReadImage(dicom_path))[0]
+
+
+def window_slices(slices, windows):
+    """Windows a list of slices into [H, W, len(windows)] images
+
+    Slices with the same shape are windowed as one stacked array.
+    """
+    if len({s.shape for s in slices}) == 1:
+        stack = np.stack(slices)
+        return list(np.stack([windowed_image(stack, *window) for window in windows], axis=-1))
+    return [np.stack([windowed_image(s, *window) for window in windows], axis=-1) for s in slices]
+
+
+def dicom_examples(items, class_values, window=BRAIN_WINDOW, codec=RAW, channels=GRAY):
+    """Builds class map examples of a batch of DICOM slices, usable as a batched write_shards example_fn
+
+    Args:
+        items (list): (dicom_path, label_path) tuples, label_path is the label png of the slice or None
+            for slices without any lesion
+        class_values (list): pixel values of the classes in label png
+        window (tuple): window level and width in HU of GRAY and RGB images
+        codec (str): image codec of the records
+        channels (str): GRAY (single window, single channel), RGB (single window copied to 3 channels)
+            or MULTI_WINDOW (one window of MULTI_WINDOWS per channel)
+    Return:
+        list: (serialized example, info) tuples in items order
+    """
+    depth = label_depth(class_values)
+    lut = class_lookup_table(class_values)
+    slices = [read_dicom_slice(dicom_path) for dicom_path, _ in items]
+    windowed = window_slices(slices, MULTI_WINDOWS if channels == MULTI_WINDOW else [window])
+    results = []
+    for (dicom_path, label_path), image in zip(items, windowed):
+        label_bytes = b"" if label_path is None else read_bytes(label_path)
+        key = record_key(dicom_path)
+        record_hash = hash_pair(key, read_bytes(dicom_path), label_bytes)
+        if label_path is None:
+            class_map = np.full(image.shape[:2], lut[0], dtype=np.uint8)
+        else:
+            class_map = lookup(lut, decode_png_bytes(label_bytes, 0))
+        if channels == RGB:
+            image = np.repeat(image, 3, axis=-1)
+        out = parse_single_image_class_map(image, class_map, depth, codec=codec,
+                                           extra_features={**record_features(key, record_hash), **head_box_features(image)})
+        results.append((out.SerializeToString(),
+                        {"key": key, "hash": record_hash, "class_pixels": class_pixel_counts(class_map, depth)}))
+    return results
@@ -0,0 +1,97 @@
+# Data-parallel training on several workers, e.g. CPU nodes without GPUs. Every worker runs the same training
+# script with its own TF_CONFIG (see launch_workers.py) and MultiWorkerMirroredStrategy all-reduces the
+# gradients of every step. The record shards are split by batch: every worker builds the same seeded stream
+# of serialized record batches and keeps every num_workers-th batch, so a worker only parses, decodes and
+# augments its own batches. An epoch of a worker is cut or filled up to worker_steps batches, the collective
+# ops need the same amount of steps on every worker (see shard_batches). Streams that depend on state of
+# a worker, like the hard example draws (recordbase.hardexamples) from its own losses, differ between the
+# workers and cannot be sharded this way. Files (checkpoints, CSV logs, tensorboard) are written by the
+# chief, the other workers write the checkpoint copies they have to write into temporary directories. Every worker needs the record base and MODEL_SAVE_PATH at the same path.
+import os
+import json
+from datetime import datetime
+import tensorflow as tf
+
+RUN_STAMP_ENV = "RUN_STAMP" # set by launch_workers.py, all workers of a run write to the same run directory
+
+
+def cluster_config():
+    """TF_CONFIG of this process, {} without one"""
+    return json.loads(os.environ.get("TF_CONFIG", "{}"))
+
+
+def num_workers():
+    """Workers of the cluster in TF_CONFIG, 1 without one"""
+    cluster = cluster_config().get("cluster", {})
+    return max(1, len(cluster.get("chief", [])) + len(cluster.get("worker", [])))
+
+
+def task_name():
+    """<task type>_<task index> of this worker, None without TF_CONFIG"""
+    task = cluster_config().get("task")
+    return None if task is None else f"{task['type']}_{task['index']}"
+
+
+def is_chief():
+    """The chief task, or worker 0 of a cluster without one, writes the files of a run"""
+    config = cluster_config()
+    task = config.get("task")
+    if task is None or task["type"] == "chief":
+        return True
+    return task["type"] == "worker" and task["index"] == 0 and "chief" not in config.get("cluster", {})
+
+
+def worker_strategy():
+    """MultiWorkerMirroredStrategy for a cluster of more than one worker, the default strategy otherwise
+
+    Create it before any other tensorflow op of the script, the collective ops configure the runtime.
+    """
+    if num_workers() == 1:
+        return tf.distribute.get_strategy()
+    options = tf.distribute.experimental.CommunicationOptions(
+        implementation=tf.distribute.experimental.CommunicationImplementation.AUTO) # ring all-reduce on CPUs
+    strategy = tf.distribute.MultiWorkerMirroredStrategy(communication_options=options)
+    print(f"PreTrain: Worker {task_name()} of {num_workers()}{' (chief)' if is_chief() else ''}")
+    return strategy
+
+
+def run_stamp():
+    """Date part of the run name, the same on every worker of a launch_workers.py run"""
+    return os.environ.get(RUN_STAMP_ENV) or datetime.now().strftime("%d_%m-%H_%M")
+
+
+def write_directory(directory):
+    """directory on the chief, a temporary directory inside it on the other workers, removed after writing"""
+    return directory if is_chief() else os.path.join(directory, f"workertemp_{task_name()}")
+
+
+def worker_steps(steps, workers):
+    """Steps every worker runs per epoch when the batches of an epoch are split over workers"""
+    return max(1, steps // workers)
+
+
+def shard_batches(dataset, worker, steps=None):
+    """Batches of a worker out of the batch stream every worker builds the same
+
+    Args:
+        dataset (tf.data.Dataset): batches of serialized records, in the same order on every worker
+        worker (tuple): (index, count) of the worker, None returns dataset unchanged
+        steps (int): batches the worker keeps, e.g. worker_steps of one epoch, a shorter share repeats its
+            batches so every worker runs exactly steps batches. None for endless streams
+    """
+    if worker is None:
+        return dataset
+    index, count = worker
+    dataset = dataset.shard(count, index)
+    return dataset if steps is None else dataset.repeat().take(steps)
+
+
+def distribute_batches(strategy, dataset_fn):
+    """Input of model.fit, dataset_fn(worker) builds the batches of one worker, see shard_batches
+
+    The per worker datasets are used as they are, keras neither re-batches nor auto-shards them.
+    """
+    if strategy.num_replicas_in_sync == 1:
+        return dataset_fn(None)
+    return strategy.distribute_datasets_from_function(
+        lambda context: dataset_fn((context.input_pipeline_id, context.num_input_pipelines)))
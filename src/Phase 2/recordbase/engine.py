@@ -0,0 +1,70 @@
+# Training step of the training scripts, installed in place of the keras train_step of a compiled model,
+# model.fit and every callback keep working. A batch of the pipeline is split into accum_steps
+# micro-batches and their gradients are summed before a single optimizer update, only the activations
+# of one micro-batch are alive at a time. The forward pass can be compiled with XLA. BatchNormalization
+# still normalizes each micro-batch on its own, only the optimizer sees the large batch.
+import tensorflow as tf
+
+
+def micro_batch_size(batch_size, accum_steps):
+    """Samples of every micro-batch of a batch, the last one may be smaller"""
+    return (batch_size + accum_steps - 1) // accum_steps
+
+
+def attach_train_step(model, accum_steps=1, jit_compile=False, sampler=None):
+    """Replaces the training step of a compiled model
+
+    Call it again after the model is replaced (load_model), compile keeps it. Training batches are
+    (x, y) or (x, y, record ids) with a sampler.
+
+    Args:
+        model (keras.Model): compiled model
+        accum_steps (int): micro-batches of every batch, gradients are accumulated over them
+        jit_compile (bool): compile the forward pass of a micro-batch (and its gradient) with XLA
+        sampler (HardExampleSampler): records the per sample losses of every micro-batch, optional
+    Return:
+        keras.Model: the same model
+    """
+    def forward(x):
+        y_pred = model(x, training=True)
+        return y_pred, list(model.losses) # regularization losses are computed inside the compiled function
+    forward = tf.function(forward, jit_compile=True) if jit_compile else forward
+
+    def micro_step(x, y, ids, weight):
+        with tf.GradientTape() as tape:
+            y_pred, regularization_losses = forward(x)
+            loss = model.compiled_loss(y, y_pred, regularization_losses=regularization_losses)
+            # every micro-batch adds its share of the batch mean
+            loss = loss * weight
+            if isinstance(model.optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+                loss = model.optimizer.get_scaled_loss(loss)
+        model.compiled_metrics.update_state(y, y_pred)
+        if sampler is not None:
+            sampler.record(ids, sampler.sample_loss_fn(y, tf.stop_gradient(y_pred)))
+        return tape.gradient(loss, model.trainable_variables)
+
+    def train_step(data):
+        x, y = data[0], data[1]
+        ids = data[2] if sampler is not None else None
+        variables = model.trainable_variables
+        if accum_steps == 1:
+            gradients = micro_step(x, y, ids, 1.0)
+        else:
+            batch_size = tf.shape(y)[0]
+            size = micro_batch_size(batch_size, accum_steps)
+            gradients = [tf.zeros_like(v) for v in variables]
+            for start in tf.range(0, batch_size, size):
+                part = lambda t: t[start:start + size]
+                micro_y = part(y)
+                weight = tf.cast(tf.shape(micro_y)[0], tf.float32) / tf.cast(batch_size, tf.float32)
+                micro_gradients = micro_step(tf.nest.map_structure(part, x), micro_y, None if ids is None else part(ids), weight)
+                gradients = [g if m is None else g + tf.cast(m, g.dtype) for g, m in zip(gradients, micro_gradients)]
+        if isinstance(model.optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+            gradients = model.optimizer.get_unscaled_gradients(gradients)
+        # the loss scale optimizer skips the update if any gradient is not finite
+        model.optimizer.apply_gradients([(g, v) for g, v in zip(gradients, variables) if g is not None])
+        return {m.name: m.result() for m in model.metrics}
+
+    model.train_step = train_step
+    model.train_function = None
+    return model
@@ -0,0 +1,153 @@
+# Loss-aware sampling of the training records. The training step records a running loss of every
+# record it sees, keyed by its record id, and at the end of every epoch the losses are turned into draw
+# weights: a record with twice the mean loss is drawn about twice as often in the next epochs, easy
+# records (most of them empty slices) less often. HardExampleCallback draws the records of the next epoch
+# from the weights outside tf.data, as many draws as there are seen records, seeded by the run seed and
+# the epoch, and the input pipeline waits for them before it starts the epoch. An epoch keeps its amount
+# of batches and a resumed run gets the same draws.
+import threading
+import numpy as np
+import tensorflow as tf
+
+from .schema import RECORD_HASH_KEY
+from .engine import attach_train_step
+
+
+def record_ids(serialized, record_hashes):
+    """Ids of serialized records, their record/hash or a hash of the record bytes for records without one"""
+    fallback = tf.strings.as_string(tf.strings.to_hash_bucket_fast(serialized, 2**62))
+    return tf.where(tf.equal(record_hashes, ""), fallback, record_hashes)
+
+
+def record_id(serialized):
+    """record_ids of a single serialized record, parses nothing but its hash"""
+    features = tf.io.parse_single_example(serialized, {RECORD_HASH_KEY: tf.io.FixedLenFeature([], tf.string, default_value="")})
+    return record_ids(serialized, features[RECORD_HASH_KEY])
+
+
+def per_sample_loss(loss_fn):
+    """Turns a loss reducing over the whole batch into [B] losses, every sample is passed as a batch of one"""
+    def sample_losses(y_true, y_pred):
+        return tf.map_fn(lambda sample: tf.cast(loss_fn(sample[0][tf.newaxis], sample[1][tf.newaxis]), tf.float32),
+                         (y_true, y_pred), fn_output_signature=tf.float32)
+    return sample_losses
+
+
+class HardExampleSampler:
+    """Running per record losses and the draw weights of the records
+
+    Args:
+        sample_loss_fn (callable): (y_true, y_pred) -> [B] losses, e.g. per_sample_loss of the training loss
+        momentum (float): share of the previous running loss kept on every new loss of a record
+        power (float): weights are (loss / mean loss) ** power, 0 disables the re-weighting
+        min_weight (float): lower clip of the weights, keeps easy records in the epochs
+        max_weight (float): upper clip of the weights, keeps a few hard records from filling the epochs
+        seed (int): run seed, the draws of an epoch only depend on the seed, the epoch and the weights.
+            None draws unseeded
+    """
+
+    def __init__(self, sample_loss_fn, momentum=0.7, power=1.0, min_weight=0.2, max_weight=5.0, seed=None):
+        self.sample_loss_fn = sample_loss_fn
+        self.seed = seed
+        self.momentum = momentum
+        self.power = power
+        self.min_weight = min_weight
+        self.max_weight = max_weight
+        self.losses = tf.lookup.experimental.MutableHashTable(tf.string, tf.float32, default_value=-1.0)
+        self.weights = tf.lookup.experimental.MutableHashTable(tf.string, tf.float32, default_value=1.0) # unseen records get 1
+        self.draws = tf.lookup.experimental.MutableHashTable(tf.string, tf.int64, default_value=1) # unseen records are drawn once
+        self.draw_epoch = -1 # latest epoch with draws, see set_draws
+        self._drawn = threading.Condition()
+
+    def trackables(self):
+        """Tables to save with the run, see ResumeState"""
+        return {"sample_losses": self.losses, "sample_weights": self.weights}
+
+    def record(self, ids, losses):
+        """Updates the running losses of a batch, in-graph"""
+        losses = tf.cast(losses, tf.float32)
+        previous = self.losses.lookup(ids)
+        running = tf.where(previous < 0, losses, self.momentum * previous + (1 - self.momentum) * losses)
+        return self.losses.insert(ids, running)
+
+    def update_weights(self):
+        """Turns the running losses into draw weights, relative to their mean and clipped last
+
+        The weights stay inside [min_weight, max_weight], their mean is about 1.
+
+        Return:
+            dict: records, mean loss and the weight range, None before any loss was recorded
+        """
+        ids, losses = self.losses.export()
+        losses = losses.numpy()
+        if len(losses) == 0:
+            return None
+        weights = (losses / max(losses.mean(), 1e-12)) ** self.power
+        weights = np.clip(weights / max(weights.mean(), 1e-12), self.min_weight, self.max_weight).astype(np.float32)
+        self.weights.insert(ids, weights)
+        return {"records": len(losses), "mean_loss": float(losses.mean()),
+                "min_weight": float(weights.min()), "max_weight": float(weights.max())}
+
+    def set_draws(self, epoch):
+        """Draws the records of an epoch from the current weights and lets the input pipeline start it
+
+        Every record with a weight is drawn with the probability of its weight, as many times in total
+        as there are records with a weight, records without a weight are drawn once.
+        """
+        ids, weights = self.weights.export()
+        ids, weights = ids.numpy(), weights.numpy()
+        if len(ids) > 0:
+            order = np.argsort(ids) # the export order of the table changes between runs
+            ids, weights = ids[order], weights[order]
+            rng = np.random.default_rng(None if self.seed is None else [self.seed, epoch])
+            self.draws.insert(ids, rng.multinomial(len(ids), weights / weights.sum()).astype(np.int64))
+        with self._drawn:
+            self.draw_epoch = max(self.draw_epoch, epoch)
+            self._drawn.notify_all()
+
+    def _wait_for_draws(self, epoch):
+        with self._drawn:
+            self._drawn.wait_for(lambda: self.draw_epoch >= epoch)
+        return epoch
+
+    def resample(self, dataset, epoch, id_fn=lambda *sample: sample[-1]):
+        """Repeats or drops every sample of one epoch of dataset by its draws, put it in front of the shuffle
+
+        The epoch starts once set_draws ran for it, so the draws never depend on how far the pipeline
+        prefetches. Needs a HardExampleCallback on the model.
+
+        Args:
+            dataset (tf.data.Dataset): samples of one epoch, the id of a sample is id_fn(*sample)
+            epoch (int): epoch of the samples, a python int or an int64 tensor inside tf.data functions
+        """
+        start = tf.data.Dataset.from_tensors(tf.cast(epoch, tf.int64)).map(
+            lambda e: tf.numpy_function(func=self._wait_for_draws, inp=[e], Tout=tf.int64))
+        return start.flat_map(lambda e: dataset.flat_map(
+            lambda *sample: tf.data.Dataset.from_tensors(sample).repeat(self.draws.lookup(id_fn(*sample)))))
+
+    def attach(self, model, accum_steps=1, jit_compile=False):
+        """Replaces the training step of a compiled model with one that records the losses of its batches
+
+        Training batches are (x, y, record ids), the ids take the place of sample weights. Call it again
+        when the model is replaced, e.g. by load_model. See engine.attach_train_step for the arguments.
+        """
+        return attach_train_step(model, accum_steps, jit_compile, sampler=self)
+
+
+class HardExampleCallback(tf.keras.callbacks.Callback):
+    """Updates the draw weights of a HardExampleSampler at the end of every epoch and draws the next epoch"""
+
+    def __init__(self, sampler):
+        super(HardExampleCallback, self).__init__()
+        self.sampler = sampler
+
+    def on_epoch_begin(self, epoch, logs=None):
+        if self.sampler.draw_epoch < epoch: # first epoch of a run, resumed runs draw from the restored weights
+            self.sampler.set_draws(epoch)
+
+    def on_epoch_end(self, epoch, logs=None):
+        stats = self.sampler.update_weights()
+        if stats is not None:
+            print(f"\nInfo: Hard examples of {stats['records']} records, mean loss {stats['mean_loss']:.4f}, "
+                  f"weights {stats['min_weight']:.2f}-{stats['max_weight']:.2f}")
+        self.sampler.set_draws(epoch + 1)
@@ -0,0 +1,101 @@
+# Head crop of CT slices. Most of a slice is the black margin around the head, so every slice is cut
+# down to the smallest square canvas of CANVAS_SIZES holding its whole head box (stored at ingest as
+# schema.HEAD_BOX_KEY). Slices are grouped by canvas before batching, so every batch has one shape and
+# no tissue pixel is ever cropped or resized away. The models are fully convolutional, they only see a
+# few distinct input shapes instead of the full slice.
+import tensorflow as tf
+
+from .schema import HEAD_BOX_KEY, HEAD_THRESHOLD
+from .patches import crop_batch
+
+CANVAS_SIZES = [320, 384, 448, 512]
+NO_HEAD_BOX = [-1, -1, -1, -1] # records written before head boxes were stored
+
+
+def canvas_sizes(sizes, height, width):
+    """Sorted canvases of square height x width slices, the full slice is always the last one
+
+    Raises:
+        ValueError: for non-square slices or canvases larger than the slices
+    """
+    if height != width:
+        raise ValueError(f"Head crop needs square slices, got {height}x{width}")
+    if max(sizes) > height:
+        raise ValueError(f"Canvas {max(sizes)} is larger than the {height}x{width} slices")
+    return sorted(set(sizes) | {height})
+
+
+def image_head_box(image, threshold=HEAD_THRESHOLD):
+    """In-graph schema.head_box of an uint8 [H, W, C] image, int64 [4]"""
+    mask = tf.reduce_max(image, axis=-1) > threshold
+    rows = tf.cast(tf.reduce_any(mask, axis=1), tf.int32)
+    cols = tf.cast(tf.reduce_any(mask, axis=0), tf.int32)
+    height, width = tf.shape(rows, out_type=tf.int64)[0], tf.shape(cols, out_type=tf.int64)[0]
+    box = tf.stack([tf.argmax(rows), tf.argmax(cols), height - tf.argmax(rows[::-1]), width - tf.argmax(cols[::-1])])
+    return tf.where(tf.reduce_any(mask), box, tf.stack([tf.constant(0, tf.int64), 0, height, width]))
+
+
+def record_head_box(serialized, decode_fn, threshold=HEAD_THRESHOLD):
+    """Head box of a single serialized record
+
+    Args:
+        serialized (tf.Tensor): scalar string record
+        decode_fn (callable): serialized record -> uint8 [H, W, C] image, only called for records without a stored box
+        threshold (int): see image_head_box
+    Return:
+        tf.Tensor: int64 [4] y0, x0, y1, x1
+    """
+    box = tf.io.parse_single_example(serialized, {HEAD_BOX_KEY: tf.io.FixedLenFeature([4], tf.int64, default_value=NO_HEAD_BOX)})[HEAD_BOX_KEY]
+    return tf.cond(box[0] >= 0, lambda: box, lambda: image_head_box(decode_fn(serialized), threshold))
+
+
+def canvas_index(boxes, sizes):
+    """Index of the smallest canvas of sizes (see canvas_sizes) holding each of the [..., 4] boxes"""
+    extent = tf.maximum(boxes[..., 2] - boxes[..., 0], boxes[..., 3] - boxes[..., 1])
+    return tf.reduce_sum(tf.cast(extent[..., tf.newaxis] > tf.constant(sizes, tf.int64), tf.int64), axis=-1)
+
+
+def bucket_by_canvas(dataset, batch_size, sizes):
+    """Batches a dataset of single samples so that a full batch only holds slices of one canvas
+
+    The head box has to be the last element of every sample. Every canvas fills its own batches, the
+    samples left over in the canvases when the dataset ends are merged into mixed batches, which
+    crop_to_canvas crops to their largest canvas. A pass has ceil(samples / batch_size) batches like a
+    plain batch, so manifest.steps_per_epoch holds.
+    """
+    batch_size = tf.constant(batch_size, tf.int64)
+    canvas_batches = dataset.apply(tf.data.experimental.group_by_window(
+        key_func=lambda *sample: canvas_index(sample[-1], sizes),
+        reduce_func=lambda key, window: window.batch(batch_size),
+        window_size=batch_size))
+    # full batches stay as they are, the incomplete ones are split into single samples and re-batched
+    units = canvas_batches.flat_map(lambda *batch: tf.data.Dataset.from_tensor_slices(batch).batch(
+        tf.where(tf.shape(batch[-1], out_type=tf.int64)[0] == batch_size, batch_size, tf.constant(1, tf.int64))))
+    return units.apply(tf.data.experimental.group_by_window(
+        key_func=lambda *unit: tf.cast(tf.shape(unit[-1], out_type=tf.int64)[0] == batch_size, tf.int64),
+        reduce_func=lambda key, window: window.unbatch().batch(batch_size),
+        window_size_func=lambda key: tf.where(key == 1, tf.constant(1, tf.int64), batch_size)))
+
+
+def crop_to_canvas(images, boxes, sizes, masks=None):
+    """Crops a batch of bucket_by_canvas to its canvas, centred on the head boxes
+
+    Canvases are moved back inside the slice where needed, the whole head box always stays inside.
+
+    Args:
+        images (tf.Tensor): [B, H, W, C] images
+        boxes (tf.Tensor): int64 [B, 4] head boxes
+        sizes (list): see canvas_sizes
+        masks (tf.Tensor): [B, H, W, depth] masks cropped with the images, optional
+    Return:
+        tf.Tensor or tuple: cropped images, or images and masks
+    """
+    boxes = tf.cast(boxes, tf.int64)
+    size = tf.gather(tf.constant(sizes, tf.int64), tf.reduce_max(canvas_index(boxes, sizes)))
+    shape = tf.shape(images, out_type=tf.int64)
+    centres = (boxes[:, :2] + boxes[:, 2:]) // 2
+    origins = tf.clip_by_value(centres - size // 2, 0, tf.stack([shape[1], shape[2]]) - size)
+    origins, size = tf.cast(origins, tf.int32), tf.cast(size, tf.int32)
+    if masks is None:
+        return crop_batch(images, origins, size)
+    return crop_batch(images, origins, size), crop_batch(masks, origins, size)
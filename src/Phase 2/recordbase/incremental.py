@@ -0,0 +1,263 @@
+# Incremental, content-addressed record base builds. The build index keeps the content hash of every
+# source image/label pair and which shard holds its record. Rebuilding only encodes pairs whose hash is
+# not in any shard yet, into new delta shards; replaced records stay in their old shards as stale
+# records that the readers filter out (recordbase.reader.drop_stale_records) until compact() rewrites
+# the base into fixed-size shards.
+import os
+import json
+import time
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import tensorflow as tf
+import tqdm
+
+from .schema import RECORD_HASH_KEY, hash_pair_files, record_key
+from .writer import plan_shards, write_shards
+from .manifest import write_manifest, manifest_path
+
+
+def index_path(out_dir, filename="batch"):
+    return os.path.join(out_dir, f"build_index_{filename}.json")
+
+
+def new_index(config):
+    """Empty build index
+
+    Args:
+        config (dict): everything that changes the content of a record (class values, label format, codec,
+            compression), an index can only be extended by builds with the same config
+    """
+    return {"config": config, "shards": [], "records": {}, "live": {}, "next_delta": 1}
+
+
+def load_index(path, config):
+    if not tf.io.gfile.exists(path):
+        return None
+    with tf.io.gfile.GFile(path) as f:
+        index = json.load(f)
+    if index["config"] != config:
+        raise ValueError(f"Record config changed since the last build ({index['config']} -> {config}), "
+                         f"run a full build instead of an incremental one")
+    return index
+
+
+def save_index(index, path):
+    tmp_path = f"{path}.tmp"
+    with tf.io.gfile.GFile(tmp_path, "w") as f:
+        json.dump(index, f)
+    tf.io.gfile.rename(tmp_path, path, overwrite=True)
+
+
+def remove_obsolete_shards(index, out_dir, path):
+    """Deletes the shards a compaction replaced, also those left over by an interrupted one, and saves the index"""
+    obsolete = index.pop("obsolete", [])
+    for shard in obsolete:
+        if tf.io.gfile.exists(os.path.join(out_dir, shard)):
+            tf.io.gfile.remove(os.path.join(out_dir, shard))
+    if len(obsolete) > 0:
+        save_index(index, path)
+    return len(obsolete)
+
+
+def add_shard_stats(index, shard_stats):
+    """Registers freshly written shards and their records in the index"""
+    for stats in shard_stats:
+        shard = os.path.basename(stats["path"])
+        index["shards"].append(shard)
+        for info in stats["record_info"]:
+            index["records"][info["hash"]] = {
+                "key": info["key"],
+                "shard": shard,
+                "raw_bytes": info["raw_bytes"],
+                "class_pixels": info["class_pixels"],
+            }
+            index["live"][info["key"]] = info["hash"]
+
+
+def stale_hashes(index):
+    live = set(index["live"].values())
+    return sorted(h for h in index["records"] if h not in live)
+
+
+def write_index_manifest(index, out_dir, filename, compression_type, **info):
+    """Writes the manifest of the base from the index, only live records are counted"""
+    live = set(index["live"].values())
+    shard_stats = {shard: {"path": os.path.join(out_dir, shard), "records": 0, "raw_bytes": 0, "stale": 0,
+                           "class_pixels": [], "class_slices": []} for shard in index["shards"]}
+    for record_hash, record in index["records"].items():
+        stats = shard_stats[record["shard"]]
+        if record_hash not in live:
+            stats["stale"] += 1
+            continue
+        stats["records"] += 1
+        stats["raw_bytes"] += record["raw_bytes"]
+        if len(stats["class_pixels"]) == 0:
+            stats["class_pixels"] = [0] * len(record["class_pixels"])
+            stats["class_slices"] = [0] * len(record["class_pixels"])
+        for c, pixels in enumerate(record["class_pixels"]):
+            stats["class_pixels"][c] += pixels
+            stats["class_slices"][c] += int(pixels > 0)
+    shard_stats = list(shard_stats.values())
+    for stats in shard_stats:
+        stats["bytes"] = tf.io.gfile.stat(stats["path"]).length
+    return write_manifest(manifest_path(out_dir, filename), shard_stats, compression_type=compression_type,
+                          stale_hashes=stale_hashes(index), **info)
+
+
+def remove_build(out_dir, filename="batch"):
+    """Deletes the shards, manifest and index of the previous build of a split, before a full rebuild
+
+    Return:
+        int: amount of removed shards
+    """
+    path = index_path(out_dir, filename)
+    if not tf.io.gfile.exists(path):
+        return 0
+    with tf.io.gfile.GFile(path) as f:
+        index = json.load(f) # any config, the full build replaces it
+    shards = index["shards"] + index.get("obsolete", [])
+    for shard in shards:
+        if tf.io.gfile.exists(os.path.join(out_dir, shard)):
+            tf.io.gfile.remove(os.path.join(out_dir, shard))
+    if tf.io.gfile.exists(manifest_path(out_dir, filename)):
+        tf.io.gfile.remove(manifest_path(out_dir, filename))
+    tf.io.gfile.remove(path)
+    return len(shards)
+
+
+def hash_pairs(pairs, num_threads=16):
+    """Content hash of every (img_path, label_path) pair, hashing is io bound so threads are enough"""
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(tqdm.tqdm(executor.map(lambda pair: hash_pair_files(*pair), pairs), total=len(pairs)))
+
+
+def incremental_build(pairs, example_fn, config, max_files, filename="batch", out_dir="./outdata/tfrecord/",
+                      compression_type=None, num_workers=0, batch_size=0, **info):
+    """Encodes only new or changed pairs into delta shards and updates the index and manifest
+
+    A first build on an empty directory writes regular shards, so a full build and an
+    incremental build of the same files produce the same base.
+
+    Args:
+        pairs (list): (img_path, label_path) tuples of the whole split, in the order they should be written,
+            label_path can be None for unlabelled sources
+        example_fn (callable): see write_shards, has to return key and hash infos
+        config (dict): see new_index
+        max_files (int): maximum amount of examples in a shard
+        filename (str): name of the split
+        out_dir (str): directory of the shards, index and manifest
+        compression_type (str): ZLIB, GZIP or None
+        num_workers (int): amount of writer processes
+        batch_size (int): see write_shard
+        **info: extra manifest fields
+    Return:
+        dict: updated index
+    """
+    start = time.perf_counter()
+    path = index_path(out_dir, filename)
+    index = load_index(path, config)
+    first_build = index is None
+    if first_build:
+        index = new_index(config)
+    else:
+        remove_obsolete_shards(index, out_dir, path)
+
+    hashes = hash_pairs(pairs)
+    live = {}
+    changed = []
+    for pair, record_hash in zip(pairs, hashes):
+        live[record_key(pair[0])] = record_hash
+        if record_hash not in index["records"]:
+            changed.append(pair)
+    removed = len([key for key in index["live"] if key not in live])
+    index["live"] = live
+    print(f"Info: {len(pairs)} pairs, {len(changed)} new or changed, {removed} removed")
+
+    if len(changed) > 0:
+        shard_name = filename if first_build else f"delta{index['next_delta']:04d}_{filename}"
+        shards = plan_shards(changed, max_files, filename=shard_name, out_dir=out_dir)
+        add_shard_stats(index, write_shards(shards, example_fn, compression_type=compression_type,
+                                              num_workers=num_workers, batch_size=batch_size))
+        if not first_build:
+            index["next_delta"] += 1
+
+    save_index(index, path)
+    manifest = write_index_manifest(index, out_dir, filename, compression_type, **info)
+    print(f"Info: Incremental build done in {time.perf_counter() - start:.1f}s, "
+          f"{manifest['records']} live and {len(manifest['stale_hashes'])} stale records")
+    return index
+
+
+def compact(config, max_files, filename="batch", out_dir="./outdata/tfrecord/", compression_type=None, **info):
+    """Merges base and delta shards into fixed-size shards without the stale records
+
+    Records are copied as serialized bytes, nothing is decoded or encoded again. The compacted shards get
+    new names and the old ones are removed after the index is saved, an interrupted compaction keeps a
+    readable base, run compact again to remove the shards it left.
+
+    Args:
+        config (dict): see new_index
+        max_files (int): maximum amount of examples in a shard
+        filename (str): name of the split
+        out_dir (str): directory of the shards, index and manifest
+        compression_type (str): ZLIB, GZIP or None
+        **info: extra manifest fields
+    Return:
+        dict: updated index
+    """
+    start = time.perf_counter()
+    path = index_path(out_dir, filename)
+    index = load_index(path, config)
+    if index is None:
+        raise FileNotFoundError(f"No build index at {path}")
+    remove_obsolete_shards(index, out_dir, path)
+    live = set(index["live"].values())
+    records = sum(1 for h in index["records"] if h in live)
+    splits = (records//max_files) + (1 if records%max_files else 0)
+    tmp_dir = os.path.join(out_dir, f"compact_{filename}")
+    os.makedirs(tmp_dir, exist_ok=True)
+    options = tf.io.TFRecordOptions(compression_type=compression_type) if compression_type else None
+    hash_description = {RECORD_HASH_KEY : tf.io.FixedLenFeature([], tf.string, default_value="")}
+
+    compacted = new_index(config)
+    generation = index.get("next_compact", 1) # new shard names, the old shards stay readable until the index is saved
+    compacted["next_compact"] = generation + 1
+    shard_index, shard_count, writer = 0, 0, None
+    shard_paths = [os.path.join(out_dir, shard) for shard in index["shards"]]
+    dataset = (tf.data.TFRecordDataset(shard_paths, compression_type=compression_type)
+                .map(lambda x: (x, tf.io.parse_single_example(x, hash_description)[RECORD_HASH_KEY])))
+    for serialized, record_hash in tqdm.tqdm(dataset, total=len(index["records"])):
+        record_hash = record_hash.numpy().decode()
+        if record_hash not in live or record_hash in compacted["records"]:
+            continue
+        if writer is None or shard_count == max_files:
+            if writer is not None:
+                writer.close()
+            shard_index += 1
+            shard_count = 0
+            shard = f"tfrecord_{shard_index}in{splits}_compact{generation:04d}_{filename}.tfrecords"
+            compacted["shards"].append(shard)
+            writer = tf.io.TFRecordWriter(os.path.join(tmp_dir, shard), options=options)
+        writer.write(serialized.numpy())
+        record = dict(index["records"][record_hash])
+        record["shard"] = compacted["shards"][-1]
+        compacted["records"][record_hash] = record
+        shard_count += 1
+    if writer is not None:
+        writer.close()
+    compacted["live"] = index["live"]
+
+    # the index switches to the compacted shards in one save, the old shards are removed after it. an
+    # interrupted compaction leaves the old or the new base with obsolete shards next to it, the next
+    # incremental_build or compact removes them
+    index["obsolete"] = compacted["shards"]
+    save_index(index, path)
+    for shard in compacted["shards"]:
+        shutil.move(os.path.join(tmp_dir, shard), os.path.join(out_dir, shard))
+    compacted["obsolete"] = index["shards"]
+    save_index(compacted, path)
+    write_index_manifest(compacted, out_dir, filename, compression_type, **info)
+    remove_obsolete_shards(compacted, out_dir, path)
+    shutil.rmtree(tmp_dir)
+    print(f"Info: Compacted {len(index['shards'])} shard(s) into {len(compacted['shards'])} in {time.perf_counter() - start:.1f}s")
+    return compacted
@@ -0,0 +1,165 @@
+# Multi-process batch producer for the numpy Dataset/ArrayDataset path of train_model_no_tfrc.py.
+# Worker processes read, decode and augment samples and write them straight into preallocated batch
+# slots in shared memory, the training process only copies finished batches out. Workers run a fixed
+# amount of batches ahead, across epoch boundaries, and stay alive for the whole run: every epoch is
+# a new permutation sent with the tasks instead of a new worker pool.
+import random
+import weakref
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+import tensorflow as tf
+
+
+def _batch_worker(dataset, buffers, tasks, results, seed):
+    # forked workers inherit the random state of the parent, without a reseed they augment identically
+    random.seed(seed)
+    np.random.seed(seed % 2**32)
+    cv2.setNumThreads(1) # the parallelism comes from the processes
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        key, slot, sample_indexes = task
+        try:
+            for row, index in enumerate(sample_indexes):
+                rows = [buffer[slot, row] for buffer in buffers]
+                if hasattr(dataset, "load"): # decodes straight into the shared rows, see Dataset.load
+                    dataset.load(index, *rows)
+                    continue
+                for values, value in zip(rows, dataset[index]):
+                    values[...] = value
+            results.put((key, None))
+        except Exception:
+            results.put((key, traceback.format_exc()))
+
+
+def _shutdown(workers, tasks, memories):
+    for _ in workers:
+        tasks.put(None)
+    for worker in workers:
+        worker.join(timeout=5)
+        if worker.is_alive():
+            worker.terminate()
+    for memory in memories:
+        memory.close()
+        memory.unlink()
+
+
+class SharedMemoryLoader(tf.keras.utils.Sequence):
+    """Drop-in replacement of Dataloder that builds batches in worker processes
+
+    Every sample of dataset must have the shapes and dtypes of dataset[0]. Workers are forked, so the
+    dataset and its albumentations transforms do not have to be picklable. Batches are prefetched in
+    order, pass shuffle=False to model.fit, the loader shuffles the samples itself every epoch.
+
+    Args:
+        dataset: instance of Dataset or ArrayDataset, indexable and returning (image, mask)
+        batch_size (int): samples in a batch, the last incomplete batch of an epoch is dropped
+        shuffle (bool): new permutation of the samples every epoch
+        workers (int): worker processes
+        prefetch (int): batches the workers run ahead, also the amount of shared memory slots
+        seed (int): seed of the permutations and of the worker random states
+    """
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, workers=4, prefetch=8, seed=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.epoch = 0
+        self.orders = {}
+
+        sample = [np.asarray(value) for value in dataset[0]]
+        self.memories, self.buffers = [], []
+        for value in sample:
+            shape = (prefetch, batch_size) + value.shape
+            memory = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * value.dtype.itemsize)
+            self.memories.append(memory)
+            self.buffers.append(np.ndarray(shape, dtype=value.dtype, buffer=memory.buf))
+
+        context = multiprocessing.get_context("fork")
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        base_seed = int(self.rng.integers(2**31))
+        self.workers = [context.Process(target=_batch_worker, args=(dataset, self.buffers, self.tasks, self.results, base_seed + i), daemon=True)
+                        for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+        self._finalizer = weakref.finalize(self, _shutdown, self.workers, self.tasks, self.memories)
+
+        self.free_slots = list(range(prefetch))
+        self.slots = {} # (epoch, batch): slot of submitted batches
+        self.ready = set() # finished batches that were not taken yet
+        self.next_task = (0, 0)
+        self.last = (None, None) # keras peeks at batch 0 before iterating from 0
+        self._submit()
+
+    def __len__(self):
+        """Denotes the number of batches per epoch"""
+        return len(self.dataset) // self.batch_size
+
+    def _order(self, epoch):
+        if epoch not in self.orders:
+            self.orders[epoch] = self.rng.permutation(len(self.dataset)) if self.shuffle else np.arange(len(self.dataset))
+        return self.orders[epoch]
+
+    def _submit(self):
+        """Fills every free slot with the next batches, continuing into the next epoch"""
+        while len(self.free_slots) > 0 and len(self) > 0:
+            epoch, i = self.next_task
+            if i >= len(self):
+                self.next_task = (epoch + 1, 0)
+                continue
+            slot = self.free_slots.pop()
+            self.tasks.put(((epoch, i), slot, self._order(epoch)[i * self.batch_size:(i + 1) * self.batch_size]))
+            self.slots[(epoch, i)] = slot
+            self.next_task = (epoch, i + 1)
+
+    def _wait(self, key):
+        while key not in self.ready:
+            done, error = self.results.get()
+            if error is not None:
+                raise RuntimeError(f"Batch worker failed on batch {done}:\n{error}")
+            self.ready.add(done)
+
+    def _release(self, keys):
+        """Frees the slots of batches that will not be taken, they are finished first because workers cannot be interrupted"""
+        for key in list(keys):
+            self._wait(key)
+            self.ready.discard(key)
+            self.free_slots.append(self.slots.pop(key))
+
+    def __getitem__(self, i):
+        key = (self.epoch, i)
+        if key == self.last[0]:
+            return self.last[1]
+        if key not in self.slots:
+            # out of order access, everything prefetched is dropped and prefetching restarts at i
+            self._release(self.slots)
+            self.next_task = key
+            self._submit()
+        self._wait(key)
+        slot = self.slots.pop(key)
+        self.ready.discard(key)
+        # copy out, the slot is refilled while keras still holds the batch
+        batch = tuple(buffer[slot].copy() for buffer in self.buffers)
+        self.free_slots.append(slot)
+        self._submit()
+        self.last = (key, batch)
+        return batch
+
+    def on_epoch_end(self):
+        """Moves to the next permutation, batches of it may already be prefetched"""
+        self.epoch += 1
+        self.last = (None, None)
+        self._release([key for key in self.slots if key[0] < self.epoch])
+        for epoch in [epoch for epoch in self.orders if epoch < self.epoch]:
+            del self.orders[epoch]
+        self._submit()
+
+    def close(self):
+        """Stops the workers and frees the shared memory, also done when the loader is garbage collected"""
+        self._finalizer()
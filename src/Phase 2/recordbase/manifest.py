@@ -0,0 +1,183 @@
+# JSON manifest written next to the shards of a record base. It holds everything the training
+# scripts used to hardcode by hand (record counts) together with the format and class statistics.
+import os
+import json
+import math
+import numpy as np
+import tensorflow as tf
+
+from .schema import (IMAGE_CODEC_KEY, LABEL_KEY, CLASS_MAP_KEY, LABEL_DEPTH_KEY,
+                     ONEHOT, CLASS_MAP, SCHEMA_VERSIONS, RAW, class_pixel_counts)
+
+MANIFEST_GLOB = "manifest*.json"
+CLASSIFICATION = "classification" # phase 1 records, 'image' tensor and a float 'label'
+
+
+def manifest_path(out_dir, filename="batch"):
+    """Manifest of a split, several splits can share a directory"""
+    return os.path.join(out_dir, f"manifest_{filename}.json")
+
+
+def _sum_counts(shards, key):
+    counts = [np.asarray(s[key], dtype=np.int64) for s in shards if s.get(key)]
+    if len(counts) == 0:
+        return []
+    return np.sum(counts, axis=0).tolist()
+
+
+def write_manifest(path, shard_stats, compression_type=None, label_format=CLASS_MAP, image_codec=RAW, **info):
+    """Writes the manifest of the shards in shard_stats
+
+    Args:
+        path (str): output path, see manifest_path
+        shard_stats (list): statistics dicts returned by write_shards
+        compression_type (str): ZLIB, GZIP or None
+        label_format (str): label format of the records
+        image_codec (str): image codec of the records
+        **info: anything else to keep in the manifest, e.g. class_values or the stale_hashes of an incremental build
+    Return:
+        dict: written manifest
+    """
+    shards = []
+    for stats in shard_stats:
+        shards.append({
+            "file": os.path.basename(stats["path"]),
+            "records": stats["records"],
+            "bytes": stats["bytes"],
+            "raw_bytes": stats.get("raw_bytes", 0),
+            "class_pixels": stats.get("class_pixels", []),
+            "class_slices": stats.get("class_slices", []),
+            "stale": stats.get("stale", 0),
+        })
+    manifest = {
+        "schema_version": SCHEMA_VERSIONS.get(label_format, 1),
+        "label_format": label_format,
+        "image_codec": image_codec,
+        "compression_type": compression_type,
+        "records": sum(s["records"] for s in shards),
+        "bytes": sum(s["bytes"] for s in shards),
+        "raw_bytes": sum(s["raw_bytes"] for s in shards),
+        "class_pixels": _sum_counts(shards, "class_pixels"),
+        "class_slices": _sum_counts(shards, "class_slices"),
+        "stale_hashes": [],
+    }
+    manifest.update(info)
+    manifest["shards"] = shards
+    with tf.io.gfile.GFile(path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Info: Wrote manifest of {manifest['records']} records in {len(shards)} shard(s) to {path}")
+    return manifest
+
+
+def _group_counts(shards):
+    counts = {}
+    for shard in shards:
+        if shard.get("group") is not None:
+            counts[shard["group"]] = counts.get(shard["group"], 0) + shard["records"]
+    return counts
+
+
+def load_manifest(filenames):
+    """Combines the manifests next to filenames into a summary of exactly those shards
+
+    Args:
+        filenames (list): shard paths that will be read
+    Return:
+        dict: records (live records only), bytes, raw_bytes, class_pixels, class_slices, stale, stale_hashes,
+            groups (records per group) and shards of filenames, plus the format fields of the manifest
+    Raises:
+        FileNotFoundError: if a shard is not listed in any manifest
+    """
+    entries = {}
+    info = {}
+    stale_hashes = set()
+    for directory in sorted({os.path.dirname(f) for f in filenames}):
+        for path in sorted(tf.io.gfile.glob(os.path.join(directory, MANIFEST_GLOB))):
+            with tf.io.gfile.GFile(path) as f:
+                manifest = json.load(f)
+            for shard in manifest["shards"]:
+                shard = dict(shard, group=manifest.get("group")) # group of class-stratified bases, see recordbase.strata
+                entries[os.path.normpath(os.path.join(directory, shard["file"]))] = shard
+            stale_hashes.update(manifest.get("stale_hashes", []))
+            for key in ("schema_version", "label_format", "image_codec", "compression_type"):
+                info.setdefault(key, manifest.get(key))
+    missing = [f for f in filenames if os.path.normpath(f) not in entries]
+    if len(missing) > 0:
+        raise FileNotFoundError(f"{len(missing)} shard(s) are not listed in any manifest (e.g. {missing[0]}), "
+                                f"run create_manifest.py on the record base")
+    shards = [entries[os.path.normpath(f)] for f in filenames]
+    info.update({
+        "records": sum(s["records"] for s in shards),
+        "bytes": sum(s["bytes"] for s in shards),
+        "raw_bytes": sum(s.get("raw_bytes", 0) for s in shards),
+        "class_pixels": _sum_counts(shards, "class_pixels"),
+        "class_slices": _sum_counts(shards, "class_slices"),
+        "stale": sum(s.get("stale", 0) for s in shards),
+        "stale_hashes": sorted(stale_hashes),
+        "groups": _group_counts(shards),
+        "shards": shards,
+    })
+    return info
+
+
+def steps_per_epoch(manifest, batch_size):
+    """One epoch is one pass over every record, the last batch may be smaller"""
+    return math.ceil(manifest["records"] / batch_size)
+
+
+def shuffle_buffer_size(manifest, memory_mb):
+    """Largest shuffle buffer of serialized records that fits into memory_mb, never more than the record count"""
+    if manifest["records"] == 0:
+        return 0
+    record_bytes = max(manifest["raw_bytes"] / manifest["records"], 1)
+    return int(max(1, min(manifest["records"], memory_mb * 2**20 // record_bytes)))
+
+
+def _example_counts(serialized):
+    """Returns label format, image codec and per class counts of a serialized example of any schema"""
+    feature = tf.train.Example.FromString(serialized).features.feature
+    codec = feature[IMAGE_CODEC_KEY].bytes_list.value[0].decode() if IMAGE_CODEC_KEY in feature else RAW
+    if CLASS_MAP_KEY in feature:
+        depth = feature[LABEL_DEPTH_KEY].int64_list.value[0]
+        class_map = np.frombuffer(feature[CLASS_MAP_KEY].bytes_list.value[0], dtype=np.uint8)
+        return CLASS_MAP, codec, class_pixel_counts(class_map, depth), None
+    if LABEL_KEY in feature:
+        mask = tf.io.parse_tensor(feature[LABEL_KEY].bytes_list.value[0], out_type=tf.float32).numpy()
+        return ONEHOT, codec, mask.sum(axis=(0, 1)).astype(np.int64), None
+    label = int(feature["label"].float_list.value[0])
+    return CLASSIFICATION, codec, None, label
+
+
+def build_manifest(filenames, compression_type, path, **info):
+    """Counts the records of an existing record base and writes its manifest, only needed once per base
+
+    Args:
+        filenames (list): shards of a single split
+        compression_type (str): ZLIB, GZIP or None
+        path (str): output path of the manifest
+    Return:
+        dict: written manifest
+    """
+    shard_stats = []
+    label_format, codec = ONEHOT, RAW
+    for filename in sorted(filenames):
+        stats = {"path": filename, "records": 0, "bytes": tf.io.gfile.stat(filename).length, "raw_bytes": 0}
+        class_pixels, class_slices = None, None
+        for record in tf.data.TFRecordDataset(filename, compression_type=compression_type):
+            serialized = record.numpy()
+            label_format, codec, pixels, label = _example_counts(serialized)
+            stats["records"] += 1
+            stats["raw_bytes"] += len(serialized)
+            if pixels is None: # classification, every slice has a single class
+                pixels = np.zeros(max(label + 1, 2), dtype=np.int64)
+                pixels[label] = 1
+            if class_slices is None:
+                class_slices = np.zeros_like(pixels)
+                class_pixels = np.zeros_like(pixels)
+            class_slices[:len(pixels)] += pixels > 0
+            class_pixels[:len(pixels)] += pixels
+        stats["class_slices"] = [] if class_slices is None else class_slices.tolist()
+        stats["class_pixels"] = [] if class_pixels is None or label_format == CLASSIFICATION else class_pixels.tolist()
+        shard_stats.append(stats)
+    return write_manifest(path, shard_stats, compression_type=compression_type, label_format=label_format,
+                          image_codec=codec, **info)
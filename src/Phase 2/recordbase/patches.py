@@ -0,0 +1,73 @@
+# Fixed-size patch sampling for segmentation training. A batch of full slices is cut into one square
+# crop per slice, centred on the lesion (from the box index, see recordbase.boxes) or placed at
+# random. The models are fully convolutional, so a model trained on patches still predicts on full
+# slices, the patch size only has to be a multiple of the 32x downsampling of the encoders.
+import tensorflow as tf
+
+from .augment import seeded_uniform
+
+PATCH_MULTIPLE = 32
+
+
+def check_patch_size(patch_size, height=None, width=None):
+    if patch_size % PATCH_MULTIPLE != 0:
+        raise ValueError(f"Patch size {patch_size} is not a multiple of {PATCH_MULTIPLE}, the decoder skip connections would not line up")
+    if height is not None and (patch_size > height or patch_size > width):
+        raise ValueError(f"Patch size {patch_size} is larger than the {height}x{width} slices")
+
+
+def patch_origins(boxes, height, width, patch_size, lesion_fraction=0.5, uniform=tf.random.uniform):
+    """Top left corner of the crop of every slice
+
+    A slice with a box gets a lesion-centred crop with probability lesion_fraction, its centre is a
+    random point of the box. Every other crop is placed uniformly at random. Crops never leave the slice.
+
+    Args:
+        boxes (tf.Tensor): int32 [B, 4] y0, x0, y1, x1 boxes, negative for slices without a box
+        height (int): slice height
+        width (int): slice width
+        patch_size (int): crop size
+        lesion_fraction (float): share of lesion-centred crops among slices with a box
+        uniform (callable): random draws, see augment.seeded_uniform
+    Return:
+        tf.Tensor: int32 [B, 2] y, x origins
+    """
+    batch_size = tf.shape(boxes)[0]
+    limits = tf.cast(tf.stack([height - patch_size, width - patch_size]), tf.float32)
+    boxes = tf.cast(boxes, tf.float32)
+    centred = (boxes[:, 0] >= 0) & (uniform([batch_size]) < lesion_fraction)
+    centres = boxes[:, :2] + uniform([batch_size, 2]) * (boxes[:, 2:] - boxes[:, :2])
+    lesion_origins = centres - patch_size / 2
+    random_origins = uniform([batch_size, 2]) * (limits + 1)
+    origins = tf.where(centred[:, tf.newaxis], lesion_origins, random_origins)
+    return tf.cast(tf.clip_by_value(tf.floor(origins), 0, limits), tf.int32)
+
+
+def crop_batch(images, origins, patch_size):
+    """Cuts a [patch_size, patch_size] crop at every origin out of [B, H, W, C] images of any dtype, patch_size can be a tensor"""
+    offsets = tf.range(patch_size)
+    rows = origins[:, 0:1] + offsets
+    cols = origins[:, 1:2] + offsets
+    crops = tf.gather(images, rows, axis=1, batch_dims=1)
+    crops = tf.gather(crops, cols, axis=2, batch_dims=1)
+    size = tf.get_static_value(patch_size)
+    crops.set_shape([images.shape[0], size, size, images.shape[-1]])
+    return crops
+
+
+def sample_patches(images, masks, boxes, patch_size, lesion_fraction=0.5, seed=None):
+    """Crops the same patch out of every image and its mask
+
+    Args:
+        images (tf.Tensor): [B, H, W, C] images
+        masks (tf.Tensor): [B, H, W, depth] masks
+        boxes (tf.Tensor): int32 [B, 4] lesion boxes, see recordbase.boxes.box_lookup
+        patch_size (int): crop size, a multiple of PATCH_MULTIPLE
+        lesion_fraction (float): see patch_origins
+        seed (tf.Tensor): int [2] seed of stateless draws, None draws from the global seed
+    Return:
+        tuple: [B, patch_size, patch_size, C] images and [B, patch_size, patch_size, depth] masks
+    """
+    shape = tf.shape(images)
+    origins = patch_origins(boxes, shape[1], shape[2], patch_size, lesion_fraction, seeded_uniform(seed))
+    return crop_batch(images, origins, patch_size), crop_batch(masks, origins, patch_size)
@@ -0,0 +1,70 @@
+# Reduced precision training of the training scripts. mixed_float16 is the fast path of GPUs with tensor
+# cores, its smallest normal number is 6e-5, so small gradients flush to zero without loss scaling.
+# mixed_bfloat16 keeps the range of float32 and needs no loss scaling, it is the fast path of CPUs with
+# oneDNN bfloat16 kernels (AVX512-BF16, AMX). In both modes the weights stay float32, the model outputs
+# stay float32 and the losses and metrics of segmentation_models, hetorex and keras_unet_collection
+# compute in float32, see check_precision.py.
+import tensorflow as tf
+
+FLOAT32 = "float32"
+MIXED_FLOAT16 = "mixed_float16"
+MIXED_BFLOAT16 = "mixed_bfloat16"
+PRECISION_FLAGS = {"mixed_precision": MIXED_FLOAT16, "bfloat16": MIXED_BFLOAT16} # FLAGS of the training scripts
+
+
+def precision_policy(flags):
+    """Keras policy of the FLAGS of a training script, FLOAT32 without a precision flag
+
+    Raises:
+        ValueError: for more than one precision flag
+    """
+    policies = [policy for flag, policy in PRECISION_FLAGS.items() if flag in flags]
+    if len(policies) > 1:
+        raise ValueError(f"Only one of {list(PRECISION_FLAGS)} can be set, got {flags}")
+    return policies[0] if policies else FLOAT32
+
+
+def set_precision_policy(policy):
+    """Sets the global policy, models built afterwards compute in its dtype
+
+    The oneDNN kernels used by bfloat16 on CPU are enabled by TF_ENABLE_ONEDNN_OPTS=1, which is read
+    when tensorflow is loaded, the scripts set it in front of their imports.
+    """
+    tf.keras.mixed_precision.set_global_policy(policy)
+    print(f"PreTrain: Using {policy} policy" + (", dynamic loss scaling" if policy == MIXED_FLOAT16 else ""))
+
+
+def loss_scale_optimizer(optimizer, policy):
+    """Wraps the optimizer of a float16 policy into a dynamic LossScaleOptimizer, other policies need no loss scaling
+
+    compile only wraps the optimizer of models that compute in float16 themselves, the explicit wrap
+    also keeps it for models cast by cast_model and for engine.attach_train_step.
+    """
+    if policy == MIXED_FLOAT16 and not isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+        return tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+    return optimizer
+
+
+def model_policy(model):
+    """Policy of the hidden layers of a model, the output layers may compute in float32 under any policy"""
+    policies = {layer.dtype_policy.name for layer in model.layers
+                if layer.name not in model.output_names and not isinstance(layer, tf.keras.layers.InputLayer)}
+    return policies.pop() if len(policies) == 1 else None
+
+
+def cast_model(model, policy, custom_objects=None):
+    """Functional model with the layers and weights of model computing under policy, output layers keep float32
+
+    load_model restores the dtype every layer was saved with, a model saved in float32 stays float32 under
+    a mixed global policy. The cast model is not compiled and gets new optimizer slots.
+    """
+    if model_policy(model) == policy:
+        return model
+    config = model.get_config()
+    for layer in config["layers"]:
+        if layer["name"] not in model.output_names and layer["class_name"] != "InputLayer":
+            layer["config"]["dtype"] = policy
+    cast = tf.keras.Model.from_config(config, custom_objects=custom_objects)
+    cast.set_weights(model.get_weights())
+    print(f"PreTrain: Cast {model.name} from {model_policy(model)} to {policy}")
+    return cast
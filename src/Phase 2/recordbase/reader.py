@@ -0,0 +1,140 @@
+# tf.data side of the record schema. Both the legacy one-hot records and the uint8 class map
+# records are accepted, the format of a record base is found by peeking its first record.
+import tensorflow as tf
+
+from .schema import (IMAGE_KEY, ENCODED_IMAGE_KEY, IMAGE_CODEC_KEY, LABEL_KEY, CLASS_MAP_KEY,
+                     LABEL_DEPTH_KEY, VERSION_KEY, RECORD_HASH_KEY, ONEHOT, CLASS_MAP, SCHEMA_VERSIONS,
+                     RAW, PNG, BMP)
+
+
+def _int64_value(feature, key, default=None):
+    if key in feature:
+        return feature[key].int64_list.value[0]
+    return default
+
+
+def detect_schema(filename, compression_type=None):
+    """Reads the first record of a shard and returns how the records should be decoded
+
+    Args:
+        filename (str): path of a tfrecord shard
+        compression_type (str): ZLIB, GZIP or None
+    Return:
+        dict: version, label_format, image_codec, label_depth, height, width and depth of the records
+    """
+    record = next(iter(tf.data.TFRecordDataset(filename, compression_type=compression_type).take(1)))
+    feature = tf.train.Example.FromString(record.numpy()).features.feature
+    label_format = CLASS_MAP if CLASS_MAP_KEY in feature else ONEHOT
+    codec = feature[IMAGE_CODEC_KEY].bytes_list.value[0].decode() if IMAGE_CODEC_KEY in feature else RAW
+    return {
+        "version": _int64_value(feature, VERSION_KEY, SCHEMA_VERSIONS[label_format]),
+        "label_format": label_format,
+        "image_codec": codec,
+        "label_depth": _int64_value(feature, LABEL_DEPTH_KEY),
+        "height": _int64_value(feature, 'image/height'),
+        "width": _int64_value(feature, 'image/width'),
+        "depth": _int64_value(feature, 'image/depth'),
+    }
+
+
+def feature_description(schema, with_hash=False):
+    image_key = IMAGE_KEY if schema.get("image_codec", RAW) == RAW else ENCODED_IMAGE_KEY
+    label_key = CLASS_MAP_KEY if schema["label_format"] == CLASS_MAP else LABEL_KEY
+    description = {
+        image_key : tf.io.FixedLenFeature([], tf.string),
+        label_key : tf.io.FixedLenFeature([], tf.string)
+    }
+    if with_hash: # record id of the box index and per sample statistics
+        description[RECORD_HASH_KEY] = tf.io.FixedLenFeature([], tf.string, default_value="")
+    return description
+
+
+def parse_examples_batch(examples, schema, with_hash=False):
+    return tf.io.parse_example(examples, feature_description(schema, with_hash))
+
+
+def class_map_to_onehot(class_map, depth, dtype=tf.float32):
+    """Expands [..., H, W] class indexes to the [..., H, W, depth] one-hot mask the models expect"""
+    if depth == 1:
+        return tf.cast(tf.expand_dims(class_map, -1), dtype)
+    return tf.one_hot(class_map, depth, dtype=dtype)
+
+
+def expand_channels(images):
+    """Broadcasts single channel images to the 3 channels the imagenet backbones expect"""
+    return tf.tile(images, [1, 1, 1, 3])
+
+
+def decode_image_batch(features, schema=None, expand=True):
+    """Decodes a parsed batch of images to uint8 [B, H, W, 3]
+
+    Encoded images are decoded with map_fn, its iterations run in parallel inside the graph and
+    several batches are decoded at once through num_parallel_calls of the tf.data map.
+    Single channel records are broadcast to 3 channels unless expand is False.
+    """
+    codec = RAW if schema is None else schema.get("image_codec", RAW)
+    depth = 3 if schema is None or schema.get("depth") is None else schema["depth"]
+    if codec == RAW:
+        images = tf.vectorized_map(lambda x: tf.io.parse_tensor(x, out_type = tf.uint8), features[IMAGE_KEY])
+    else:
+        if codec == PNG:
+            decode_fn = lambda x: tf.io.decode_png(x, channels=depth)
+        elif codec == BMP:
+            decode_fn = lambda x: tf.io.decode_bmp(x, channels=0)[..., :depth]
+        else:
+            raise ValueError(f"Unknown image codec {codec}")
+        images = tf.map_fn(decode_fn, features[ENCODED_IMAGE_KEY], fn_output_signature=tf.uint8, parallel_iterations=32)
+    if schema is not None and schema.get("height") is not None:
+        images.set_shape([None, schema["height"], schema["width"], depth])
+    if depth == 1 and expand:
+        images = expand_channels(images)
+    return images
+
+
+def decode_label_batch(features, schema):
+    """Returns float32 one-hot masks of a parsed batch whatever the label format is"""
+    if schema["label_format"] == CLASS_MAP:
+        class_map = tf.io.decode_raw(features[CLASS_MAP_KEY], tf.uint8)
+        class_map = tf.reshape(class_map, [-1, schema["height"], schema["width"]])
+        return class_map_to_onehot(class_map, schema["label_depth"])
+    return tf.vectorized_map(lambda x: tf.io.parse_tensor(x, out_type = tf.float32), features[LABEL_KEY])
+
+
+def decode_class_map_batch(features, schema, depth):
+    """Returns uint8 [B, H, W] class maps of a parsed batch, the compact form of decode_label_batch
+
+    Args:
+        features (dict): parsed batch
+        schema (dict): see detect_schema
+        depth (int): one-hot depth of the labels, legacy one-hot records do not store it
+    """
+    if schema["label_format"] == CLASS_MAP:
+        class_map = tf.io.decode_raw(features[CLASS_MAP_KEY], tf.uint8)
+        return tf.reshape(class_map, [-1, schema["height"], schema["width"]])
+    onehot = decode_label_batch(features, schema)
+    if depth == 1:
+        return tf.cast(onehot[..., 0] > 0.5, tf.uint8)
+    return tf.cast(tf.argmax(onehot, axis=-1), tf.uint8)
+
+
+def drop_stale_records(record_dataset, stale_hashes):
+    """Filters out records that were replaced by an incremental build, see recordbase.incremental
+
+    Args:
+        record_dataset (tf.data.Dataset): serialized examples
+        stale_hashes (list): record/hash values of the replaced records, from the manifest
+    Return:
+        tf.data.Dataset: record_dataset without the stale records, unchanged if there are none
+    """
+    if len(stale_hashes) == 0:
+        return record_dataset
+    stale_table = tf.lookup.StaticHashTable(
+        tf.lookup.KeyValueTensorInitializer(tf.constant(stale_hashes), tf.ones([len(stale_hashes)], tf.int64)),
+        default_value=0)
+    hash_description = {RECORD_HASH_KEY : tf.io.FixedLenFeature([], tf.string, default_value="")}
+
+    def is_live(serialized):
+        record_hash = tf.io.parse_single_example(serialized, hash_description)[RECORD_HASH_KEY]
+        return tf.equal(stale_table.lookup(record_hash), 0)
+
+    return record_dataset.filter(is_live)
@@ -0,0 +1,133 @@
+# Resumable training runs. The model, the optimizer, the run seed and the position of the input pipeline
+# (epoch and step inside the epoch) are saved together as a tf.train.Checkpoint in MODEL_SAVE_PATH/<run>/resume.
+# The pipelines are deterministic given the seed and the epoch, so the position is enough to rebuild the
+# iterator: a resumed run regenerates the order of its epoch and skips the consumed records before they
+# are parsed or decoded, instead of storing shuffle buffers of up to SHUFFLE_MEMORY_MB in every checkpoint.
+import os
+import argparse
+import tensorflow as tf
+
+RESUME_DIR = "resume"
+LATEST = "latest"
+
+
+def parse_resume_args(argv=None):
+    """Reads `--resume [run]` from the command line
+
+    Return:
+        str: None without --resume, LATEST or the run name
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--resume", nargs="?", const=LATEST, default=None)
+    args, _ = parser.parse_known_args(argv)
+    return args.resume
+
+
+def latest_run(save_path):
+    """Name of the most recently written run in save_path that has a resume checkpoint, None if there is none"""
+    runs = []
+    for run in tf.io.gfile.listdir(save_path) if tf.io.gfile.exists(save_path) else []:
+        run = run.rstrip("/")
+        checkpoint = tf.train.latest_checkpoint(os.path.join(save_path, run, RESUME_DIR))
+        if checkpoint is not None:
+            runs.append((tf.io.gfile.stat(f"{checkpoint}.index").mtime_nsec, run))
+    return max(runs)[1] if len(runs) > 0 else None
+
+
+def epoch_seed(seed, epoch):
+    """Shuffle seed of an epoch, a python int or an int64 tensor inside tf.data functions"""
+    return seed * 1000003 + epoch
+
+
+class ResumeState:
+    """Checkpoint of a training run and the position of its input pipeline
+
+    Args:
+        run_dir (str): MODEL_SAVE_PATH/<run>
+        model (keras.Model): compiled model, its optimizer is saved too
+        seed (int): run seed, replaced by the saved one on restore
+        max_to_keep (int): amount of resume checkpoints kept
+        extra (dict): more trackables saved with the run, e.g. HardExampleSampler.trackables()
+        write_dir (str): directory the checkpoints are written to instead of run_dir/resume, it is removed
+            after every save, e.g. distribute.write_directory of workers other than the chief
+    """
+
+    def __init__(self, run_dir, model, seed, max_to_keep=2, extra=None, write_dir=None):
+        self.directory = os.path.join(run_dir, RESUME_DIR)
+        self.write_dir = write_dir
+        self.max_to_keep = max_to_keep
+        self.extra = extra or {}
+        self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.step = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.seed = tf.Variable(seed, dtype=tf.int64, trainable=False)
+        self.track(model)
+
+    def track(self, model):
+        """(Re)builds the checkpoint, needed when the model is compiled again with another optimizer"""
+        self.checkpoint = tf.train.Checkpoint(model=model, optimizer=model.optimizer,
+                                              epoch=self.epoch, step=self.step, seed=self.seed, **self.extra)
+        self.manager = tf.train.CheckpointManager(self.checkpoint, self.directory, max_to_keep=self.max_to_keep)
+        self.write_manager = self.manager if self.write_dir is None else \
+            tf.train.CheckpointManager(self.checkpoint, self.write_dir, max_to_keep=1)
+
+    def restore(self):
+        """Restores the latest checkpoint of the run
+
+        Return:
+            tuple: (epoch, step) to continue from, (0, 0) if the run has no checkpoint
+        """
+        if self.manager.latest_checkpoint is None:
+            return 0, 0
+        # optimizer slots that do not exist yet are restored when the optimizer creates them
+        self.checkpoint.restore(self.manager.latest_checkpoint).expect_partial()
+        print(f"PreTrain: Resuming {self.manager.latest_checkpoint} at epoch {int(self.epoch)} step {int(self.step)}")
+        return int(self.epoch), int(self.step)
+
+    def save(self, epoch, step):
+        self.epoch.assign(epoch)
+        self.step.assign(step)
+        path = self.write_manager.save()
+        if self.write_dir is not None and tf.io.gfile.exists(self.write_dir):
+            tf.io.gfile.rmtree(self.write_dir)
+        return path
+
+
+class ResumeCallback(tf.keras.callbacks.Callback):
+    """Saves a ResumeState every save_steps batches and at the end of every epoch
+
+    Args:
+        state (ResumeState): state to save
+        save_steps (int): batches between mid-epoch checkpoints, 0 only saves at epoch ends
+    """
+
+    def __init__(self, state, save_steps=0):
+        super(ResumeCallback, self).__init__()
+        self.state = state
+        self.save_steps = save_steps
+        self.epoch = 0
+        self.step = 0
+        self.epoch_start = 0
+        self.step_offset = 0
+
+    def skip_steps(self, steps):
+        """The next epoch starts steps batches in, used for the partial first epoch of a resumed run"""
+        self.step_offset = steps
+
+    def on_train_begin(self, logs=None):
+        if self.state.checkpoint.optimizer is not self.model.optimizer:
+            self.state.track(self.model)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.epoch_start = self.step = self.step_offset
+        self.step_offset = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        # batch is the last batch of the execution, with steps_per_execution keras skips the batches in between
+        step = self.epoch_start + batch + 1
+        if self.save_steps > 0 and step // self.save_steps > self.step // self.save_steps:
+            self.state.save(self.epoch, step)
+        self.step = step
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.state.save(epoch + 1, 0)
@@ -0,0 +1,295 @@
+# Example layout of the records written by create_tfrecords.py and read by the training scripts.
+import os
+import hashlib
+import numpy as np
+import cv2
+import tensorflow as tf
+
+IMAGE_KEY = 'image/raw_image' # serialized uint8 tensor
+ENCODED_IMAGE_KEY = 'image/encoded' # png/bmp file bytes
+IMAGE_CODEC_KEY = 'image/format'
+LABEL_KEY = 'label/raw' # legacy one-hot float mask as a serialized tensor
+CLASS_MAP_KEY = 'label/class_map' # single channel uint8 class index map as raw bytes
+LABEL_DEPTH_KEY = 'label/depth'
+VERSION_KEY = 'schema/version'
+RECORD_KEY_KEY = 'record/key' # source file name of the example
+RECORD_HASH_KEY = 'record/hash' # content hash of the source image/label pair, see hash_pair
+HEAD_BOX_KEY = 'image/head_box' # int64 [y0, x0, y1, x1] of the head, ends exclusive, see head_box
+HEAD_THRESHOLD = 16 # uint8 value above which a windowed pixel belongs to the head, air is 0 in every window
+
+# label formats
+ONEHOT = "onehot" # schema version 1
+CLASS_MAP = "class_map" # schema version 2
+SCHEMA_VERSIONS = {ONEHOT: 1, CLASS_MAP: 2}
+
+# image codecs, all of them are lossless
+RAW = "raw" # tf.io.serialize_tensor, relies on record compression for size
+PNG = "png"
+BMP = "bmp"
+IMAGE_CODECS = [RAW, PNG, BMP]
+PNG_COMPRESSION = 3 # 0-9, higher is smaller but slower to write, decode speed barely changes
+
+# image channels, ct slices are grayscale so rgb only stores three copies of the same values
+RGB = "rgb"
+GRAY = "gray" # single channel, readers broadcast it to the 3 channels the imagenet backbones expect
+MULTI_WINDOW = "multi_window" # 3 different HU windows of a DICOM slice, see recordbase.dicom
+IMAGE_CHANNELS = {RGB: 3, GRAY: 1, MULTI_WINDOW: 3}
+
+
+def serialize_array(array):
+    array = tf.io.serialize_tensor(array).numpy()
+    return array
+
+
+def image_feature(value):
+    """Returns a bytes_list from a string / byte."""
+    return tf.train.Feature(
+        bytes_list=tf.train.BytesList(value=[serialize_array(value)])
+    )
+
+
+def bytes_feature(value):
+    """Returns a bytes_list from a string / byte."""
+    if isinstance(value, type(tf.constant(0))):
+        value = value.numpy()
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def float_feature(value):
+    """Returns a float_list from a float / double."""
+    return tf.train.Feature(float_list=tf.train.FloatList(value=[value]))
+
+
+def int64_feature(value):
+    """Returns an int64_list from a bool / enum / int / uint."""
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+
+def float_feature_list(value):
+    """Returns a list of float_list from a float / double."""
+    return tf.train.Feature(float_list=tf.train.FloatList(value=value))
+
+
+def int64_feature_list(value):
+    """Returns an int64_list from a list of bool / enum / int / uint."""
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
+
+
+def read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def record_key(img_path):
+    return os.path.basename(img_path)
+
+
+def hash_pair(key, img_bytes, label_bytes):
+    """Content hash of an image/label pair, same file name with the same content always gives the same hash"""
+    digest = hashlib.sha1()
+    for data in (key.encode(), img_bytes):
+        digest.update(len(data).to_bytes(8, "little"))
+        digest.update(data)
+    digest.update(label_bytes)
+    return digest.hexdigest()
+
+
+def hash_pair_files(img_path, label_path):
+    label_bytes = b"" if label_path is None else read_bytes(label_path)
+    return hash_pair(record_key(img_path), read_bytes(img_path), label_bytes)
+
+
+def record_features(key, record_hash):
+    return {
+        RECORD_KEY_KEY : bytes_feature(key.encode()),
+        RECORD_HASH_KEY : bytes_feature(record_hash.encode()),
+    }
+
+
+def mask_box(mask):
+    """[y0, x0, y1, x1] of the True pixels of a 2d mask, ends exclusive, None if there are none"""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return [int(rows[0]), int(cols[0]), int(rows[-1]) + 1, int(cols[-1]) + 1]
+
+
+def head_box(image, threshold=HEAD_THRESHOLD):
+    """Box of the head of an uint8 [H, W, C] slice, the whole slice if it is empty"""
+    box = mask_box(image.max(axis=-1) > threshold)
+    return [0, 0, image.shape[0], image.shape[1]] if box is None else box
+
+
+def head_box_features(image):
+    return {HEAD_BOX_KEY : int64_feature_list(head_box(image))}
+
+
+def decode_png_bytes(data, flags=cv2.IMREAD_COLOR):
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+
+
+def read_image(img_path):
+    img = cv2.imread(img_path)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def decode_image_bytes(img_bytes, channels=RGB):
+    """Decodes png bytes to a [H, W, C] uint8 rgb or single channel image"""
+    if channels == GRAY:
+        return decode_png_bytes(img_bytes, cv2.IMREAD_GRAYSCALE)[..., np.newaxis]
+    if channels == RGB:
+        return cv2.cvtColor(decode_png_bytes(img_bytes), cv2.COLOR_BGR2RGB)
+    raise ValueError(f"{channels} images can only be created from DICOM files")
+
+
+def encode_image(image, codec):
+    """Encodes an rgb or single channel uint8 image to png or bmp bytes"""
+    if codec not in (PNG, BMP):
+        raise ValueError(f"Unknown image codec {codec}, use one of {IMAGE_CODECS}")
+    params = [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION] if codec == PNG else []
+    if image.shape[-1] == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    success, encoded = cv2.imencode(f".{codec}", image, params)
+    if not success:
+        raise ValueError(f"Could not encode image as {codec}")
+    return encoded.tobytes()
+
+
+def image_features(image, codec=RAW):
+    """Returns the image part of an example, raw images keep the original key so old readers can still read them"""
+    if codec == RAW:
+        return {IMAGE_KEY : image_feature(image)}
+    return {
+        IMAGE_CODEC_KEY : bytes_feature(codec.encode()),
+        ENCODED_IMAGE_KEY : bytes_feature(encode_image(image, codec)),
+    }
+
+
+def read_mask(label_path, class_values):
+    """Reads a label png and converts it to a one-hot mask with background as the last channel"""
+    return onehot_from_mask(cv2.imread(label_path, 0), class_values)
+
+
+def label_depth(class_values):
+    """Amount of one-hot channels of a mask, background gets its own channel if mask is not binary"""
+    return 1 if len(class_values) == 1 else len(class_values) + 1
+
+
+def class_lookup_table(class_values):
+    """Maps label png pixel values to one-hot channel indexes
+
+    Channel order is the same as read_mask, class_values first and background last.
+    For binary masks the class is 1 and everything else is 0.
+    """
+    depth = label_depth(class_values)
+    background = 0 if depth == 1 else depth - 1
+    lut = np.full(256, background, dtype=np.uint8)
+    for index, value in enumerate(class_values):
+        lut[value] = 1 if depth == 1 else index
+    return lut
+
+
+def class_map_lookup_table(depth, dtype=np.float32):
+    """Maps class indexes to one-hot rows, [max(depth, 2), depth], the numpy version of reader.class_map_to_onehot"""
+    return np.eye(max(depth, 2), dtype=dtype)[:, -depth:]
+
+
+def onehot_lookup_table(class_values, dtype=np.float32):
+    """Maps label png pixel values straight to one-hot rows, [256, depth] with background already set"""
+    return class_map_lookup_table(label_depth(class_values), dtype)[class_lookup_table(class_values)]
+
+
+def lookup(table, values, out=None):
+    """Indexes table with uint8 values in a single pass, without temporary arrays
+
+    With a class_lookup_table this is a class map, with a one-hot table a one-hot mask.
+
+    Args:
+        table (np.ndarray): lookup table, the first axis is indexed
+        values (np.ndarray): uint8 [..., H, W] pixels or class indexes
+        out (np.ndarray): preallocated [..., H, W(, depth)] output with the dtype of table, e.g. a row of a batch buffer
+    """
+    # clip instead of the default raise mode, raise buffers the output and uint8 values are always in range
+    return np.take(table, values, axis=0, out=out, mode="clip")
+
+
+def read_class_map(label_path, class_values, out=None):
+    """Reads a label png as an uint8 class index map, see class_lookup_table for the index order"""
+    return lookup(class_lookup_table(class_values), cv2.imread(label_path, 0), out)
+
+
+def onehot_from_mask(mask, class_values, dtype=np.float64, out=None):
+    """Same as read_mask for an already decoded label png, background is set by the same lookup"""
+    return lookup(onehot_lookup_table(class_values, dtype), mask, out)
+
+
+def class_pixel_counts(class_map, depth):
+    """Pixel count of every one-hot channel of a class map, used by the record base manifest"""
+    counts = np.bincount(class_map.ravel(), minlength=max(depth, 2))
+    return counts[1:2] if depth == 1 else counts[:depth]
+
+
+def parse_single_image(image, label, extra_features=None):
+    #define the dictionary -- the structure -- of our single example
+    data = {
+        'image/height' : int64_feature(image.shape[0]),
+        'image/width' : int64_feature(image.shape[1]),
+        'image/depth' : int64_feature(image.shape[2]),
+        IMAGE_KEY : image_feature(image),
+        LABEL_KEY : image_feature(label)
+    }
+    data.update(extra_features or {})
+    #create an Example, wrapping the single features
+    out = tf.train.Example(features=tf.train.Features(feature=data))
+    return out
+
+
+def parse_single_image_class_map(image, class_map, depth, codec=RAW, extra_features=None):
+    """Same as parse_single_image but label is stored as raw uint8 class indexes instead of float one-hot"""
+    data = {
+        VERSION_KEY : int64_feature(SCHEMA_VERSIONS[CLASS_MAP]),
+        'image/height' : int64_feature(image.shape[0]),
+        'image/width' : int64_feature(image.shape[1]),
+        'image/depth' : int64_feature(image.shape[2]),
+        CLASS_MAP_KEY : bytes_feature(np.ascontiguousarray(class_map, dtype=np.uint8).tobytes()),
+        LABEL_DEPTH_KEY : int64_feature(depth)
+    }
+    data.update(image_features(image, codec))
+    data.update(extra_features or {})
+    return tf.train.Example(features=tf.train.Features(feature=data))
+
+
+def segmentation_example(img_path, label_path, class_values, label_format=CLASS_MAP, codec=RAW, channels=RGB):
+    """Builds the serialized example of an image/label png pair
+
+    Args:
+        img_path (str): path of the rgb slice
+        label_path (str): path of the single channel label png
+        class_values (list): pixel values of the classes in label png
+        label_format (str): CLASS_MAP (uint8, ~24x smaller) or ONEHOT (legacy float mask)
+        codec (str): one of IMAGE_CODECS, only used with CLASS_MAP labels
+        channels (str): RGB or GRAY
+    Return:
+        bytes: serialized tf.train.Example
+        dict: key, hash and class_pixels (pixel count of every one-hot channel) of the record
+    """
+    img_bytes, label_bytes = read_bytes(img_path), read_bytes(label_path)
+    key = record_key(img_path)
+    record_hash = hash_pair(key, img_bytes, label_bytes)
+    extra_features = record_features(key, record_hash)
+    img = decode_image_bytes(img_bytes, channels)
+    extra_features.update(head_box_features(img))
+    mask = decode_png_bytes(label_bytes, cv2.IMREAD_GRAYSCALE)
+    if label_format == CLASS_MAP:
+        class_map = lookup(class_lookup_table(class_values), mask)
+        depth = label_depth(class_values)
+        out = parse_single_image_class_map(image=img, class_map=class_map, depth=depth, codec=codec, extra_features=extra_features)
+        class_pixels = class_pixel_counts(class_map, depth)
+    elif label_format == ONEHOT:
+        mask = onehot_from_mask(mask, class_values)
+        out = parse_single_image(image=img, label=mask, extra_features=extra_features)
+        class_pixels = mask.sum(axis=(0, 1)).astype(np.int64)
+    else:
+        raise ValueError(f"Unknown label format {label_format}, use {CLASS_MAP} or {ONEHOT}")
+    return out.SerializeToString(), {"key": key, "hash": record_hash, "class_pixels": class_pixels}
@@ -0,0 +1,142 @@
+# Dataset split manifests. A split is a list of image/label file pairs with their content hashes, kept in
+# a single json file instead of copies of the files in train/val directories. Re-splitting only rewrites
+# the json, the writers and loaders read the pairs of a split from it. Hashes of files that did not
+# change since the previous manifest are reused, so re-splitting does not read the images again.
+import os
+import json
+import tensorflow as tf
+
+from .schema import record_key
+from .writer import sort_and_shuffle
+from .incremental import hash_pairs
+
+SPLIT_MANIFEST_VERSION = 1
+
+
+def split_sizes(total, sizes):
+    """Converts {split: count or fraction} to counts, the last split gets every remaining file"""
+    counts = {}
+    remaining = total
+    names = list(sizes)
+    for name in names[:-1]:
+        count = int(round(sizes[name] * total)) if isinstance(sizes[name], float) else sizes[name]
+        counts[name] = min(count, remaining)
+        remaining -= counts[name]
+    counts[names[-1]] = remaining
+    return counts
+
+
+def _file_stat(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _reusable_hashes(previous):
+    """{(image, label, image stat, label stat): hash} of a previous split manifest"""
+    if previous is None:
+        return {}
+    reusable = {}
+    for name in previous["splits"]:
+        for entry in resolve_entries(previous, name):
+            reusable[(entry["image"], entry["label"], tuple(entry["image_stat"]), tuple(entry["label_stat"] or []))] = entry["hash"]
+    return reusable
+
+
+def make_splits(data_dir, label_dir, sizes, seed=None, ext="png", previous=None):
+    """Assigns the image/label pairs of a dataset to splits
+
+    Args:
+        data_dir (str): directory of the images
+        label_dir (str): directory of the label pngs, same file names as the images, images without one are skipped
+        sizes (dict): {split: file count or fraction of the files}, the last split gets the rest
+        seed (int): seed of the assignment, None keeps sorted order
+        ext (str): image extension
+        previous (dict): an earlier split manifest, hashes of unchanged files are taken from it
+    Return:
+        dict: split manifest, see write_split_manifest
+    """
+    img_filenames = sort_and_shuffle(tf.io.gfile.glob(os.path.join(data_dir, f"*.{ext}")), seed=seed)
+    pairs, unlabelled = [], []
+    for img_filename in img_filenames:
+        label_filename = os.path.join(label_dir, os.path.basename(img_filename))
+        if os.path.exists(label_filename):
+            pairs.append((img_filename, label_filename))
+        else: # the record writers need a label for every image
+            unlabelled.append(os.path.basename(img_filename))
+    if len(unlabelled) > 0:
+        print(f"Info: Skipping {len(unlabelled)} image(s) without a label in {label_dir}, e.g. {', '.join(unlabelled[:5])}")
+
+    stats = [(_file_stat(img), _file_stat(label) if label else None) for img, label in pairs]
+    reusable = _reusable_hashes(previous)
+    cache_keys = [(os.path.abspath(img), os.path.abspath(label) if label else None, tuple(img_stat), tuple(label_stat or []))
+                  for (img, label), (img_stat, label_stat) in zip(pairs, stats)]
+    missing = [i for i, key in enumerate(cache_keys) if key not in reusable]
+    print(f"Info: {len(pairs)} pairs, hashing {len(missing)} new or changed pair(s)")
+    new_hashes = dict(zip(missing, hash_pairs([pairs[i] for i in missing])))
+    hashes = [new_hashes[i] if i in new_hashes else reusable[key] for i, key in enumerate(cache_keys)]
+
+    counts = split_sizes(len(pairs), sizes)
+    splits = {}
+    start = 0
+    for name, count in counts.items():
+        splits[name] = [{"key": record_key(img), "image": img, "label": label, "hash": record_hash,
+                         "image_stat": img_stat, "label_stat": label_stat}
+                        for (img, label), record_hash, (img_stat, label_stat)
+                        in zip(pairs[start:start + count], hashes[start:start + count], stats[start:start + count])]
+        start += count
+    return {"version": SPLIT_MANIFEST_VERSION, "seed": seed, "data_dir": data_dir, "label_dir": label_dir,
+            "sizes": counts, "splits": splits}
+
+
+def write_split_manifest(path, manifest):
+    """Writes a split manifest, file paths are stored relative to the manifest so the dataset can be moved"""
+    base = os.path.dirname(os.path.abspath(path))
+    relative = dict(manifest, splits={
+        name: [dict(entry, image=os.path.relpath(os.path.abspath(entry["image"]), base),
+                    label=None if entry["label"] is None else os.path.relpath(os.path.abspath(entry["label"]), base))
+               for entry in entries]
+        for name, entries in manifest["splits"].items()})
+    tmp_path = f"{path}.tmp"
+    with tf.io.gfile.GFile(tmp_path, "w") as f:
+        json.dump(relative, f, indent=1)
+    tf.io.gfile.rename(tmp_path, path, overwrite=True)
+    print(f"Info: Wrote split manifest {path} ({', '.join(f'{k}: {v}' for k, v in manifest['sizes'].items())})")
+
+
+def read_split_manifest(path):
+    with tf.io.gfile.GFile(path) as f:
+        manifest = json.load(f)
+    manifest["path"] = os.path.abspath(path)
+    return manifest
+
+
+def resolve_entries(manifest, split):
+    """Entries of a split with absolute file paths"""
+    if split not in manifest["splits"]:
+        raise KeyError(f"No split {split} in {manifest.get('path')}, found {list(manifest['splits'])}")
+    base = os.path.dirname(manifest["path"]) if "path" in manifest else ""
+    return [dict(entry, image=os.path.normpath(os.path.join(base, entry["image"])),
+                 label=None if entry["label"] is None else os.path.normpath(os.path.join(base, entry["label"])))
+            for entry in manifest["splits"][split]]
+
+
+def load_split(path, split):
+    """(img_path, label_path) pairs of a split, in the order of the manifest"""
+    return [(entry["image"], entry["label"]) for entry in resolve_entries(read_split_manifest(path), split)]
+
+
+def link_split(pairs, data_dir, label_dir):
+    """Hardlinks the pairs of a split into data_dir and label_dir for tools that need split directories
+
+    Hardlinks take no extra space, the source and split directories have to be on the same file system.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    os.makedirs(label_dir, exist_ok=True)
+    for img_path, label_path in pairs:
+        for src, dst_dir in ((img_path, data_dir), (label_path, label_dir)):
+            if src is None:
+                continue
+            dst = os.path.join(dst_dir, os.path.basename(src))
+            if os.path.exists(dst):
+                os.remove(dst)
+            os.link(src, dst)
@@ -0,0 +1,182 @@
+# Class-stratified record bases. Records are written into separate shard groups (lesion / no lesion
+# slices, or one group per class for the phase 1 classifier) and the readers draw from every group
+# with fixed mixing weights. Batches are balanced without a shuffle buffer large enough to mix the
+# whole base.
+import os
+import time
+import numpy as np
+import tensorflow as tf
+import tqdm
+
+from .schema import read_bytes, decode_png_bytes, class_lookup_table, lookup, label_depth, class_pixel_counts
+from .reader import drop_stale_records
+from .manifest import write_manifest, manifest_path, load_manifest, _example_counts, CLASSIFICATION
+
+LESION = "lesion"
+NO_LESION = "no_lesion"
+UNGROUPED = None # shards of record bases written without groups
+
+
+def has_lesion(class_pixels):
+    """True if a slice has any pixel of a class, class_pixels as returned by class_pixel_counts
+
+    Binary masks only count the class, multiclass masks count every class and background last.
+    """
+    class_pixels = np.asarray(class_pixels)
+    if len(class_pixels) == 1:
+        return bool(class_pixels[0] > 0)
+    return bool(class_pixels[:-1].sum() > 0)
+
+
+def lesion_group(label_path, class_values):
+    """Group of an image/label pair, label_path None is a slice without any lesion"""
+    if label_path is None:
+        return NO_LESION
+    class_map = lookup(class_lookup_table(class_values), decode_png_bytes(read_bytes(label_path), 0))
+    return LESION if has_lesion(class_pixel_counts(class_map, label_depth(class_values))) else NO_LESION
+
+
+def group_pairs(pairs, group_fn):
+    """Splits pairs into {group: pairs}, the order inside every group is kept
+
+    Args:
+        pairs (list): (img_path, label_path) tuples
+        group_fn (callable): returns the group name of a label path
+    """
+    groups = {}
+    for pair in tqdm.tqdm(pairs):
+        groups.setdefault(group_fn(pair[1]), []).append(pair)
+    for group, items in groups.items():
+        print(f"Info: Group {group} has {len(items)} pairs")
+    return groups
+
+
+def group_filename(group, filename):
+    """Split name of a group, used for shard, index and manifest names"""
+    return f"{group}_{filename}"
+
+
+def record_group(serialized, class_names=None):
+    """Group of an already serialized record of any schema
+
+    Args:
+        serialized (bytes): serialized example
+        class_names (list): names of the classification labels, index is the label value
+    """
+    label_format, _, pixels, label = _example_counts(serialized)
+    if label_format == CLASSIFICATION:
+        return class_names[label] if class_names else str(label)
+    return LESION if has_lesion(pixels) else NO_LESION
+
+
+def regroup_records(filenames, compression_type, out_dir, filename="batch", max_files=200, class_names=None, **info):
+    """Copies the records of an existing base into group shards, nothing is decoded or encoded again
+
+    Every group gets its own shards and manifest, see group_filename. Stale records of an incremental
+    base (see load_manifest) are not copied.
+
+    Args:
+        filenames (list): shards of a single split
+        compression_type (str): ZLIB, GZIP or None
+        out_dir (str): output directory, should not be the directory of filenames
+        filename (str): name of the split
+        max_files (int): maximum amount of examples in a shard
+        class_names (list): see record_group, only used for classification records
+        **info: extra manifest fields
+    Return:
+        dict: {group: manifest}
+    """
+    start = time.perf_counter()
+    os.makedirs(out_dir, exist_ok=True)
+    options = tf.io.TFRecordOptions(compression_type=compression_type) if compression_type else None
+    writers, stats = {}, {}
+
+    def next_shard(group):
+        if group in writers:
+            writers[group].close()
+        shard_stats = stats.setdefault(group, [])
+        shard_path = os.path.join(out_dir, f"tfrecord_{len(shard_stats) + 1}_{group_filename(group, filename)}.tfrecords")
+        shard_stats.append({"path": shard_path, "records": 0, "raw_bytes": 0, "class_pixels": [], "class_slices": []})
+        writers[group] = tf.io.TFRecordWriter(shard_path, options=options)
+        return shard_stats[-1]
+
+    # stale records of an incremental base are dropped here, the group manifests do not list them
+    dataset = tf.data.TFRecordDataset(sorted(filenames), compression_type=compression_type)
+    stale = load_manifest(filenames)["stale_hashes"]
+    if len(stale) > 0:
+        print(f"Info: Dropping {len(stale)} stale record(s)")
+        dataset = drop_stale_records(dataset, stale)
+    label_format = codec = None
+    for record in tqdm.tqdm(dataset):
+        serialized = record.numpy()
+        label_format, codec, pixels, _ = _example_counts(serialized)
+        group = record_group(serialized, class_names)
+        shard = stats[group][-1] if group in stats else None
+        if shard is None or shard["records"] == max_files:
+            shard = next_shard(group)
+        writers[group].write(serialized)
+        shard["records"] += 1
+        shard["raw_bytes"] += len(serialized)
+        if pixels is not None:
+            if len(shard["class_pixels"]) == 0:
+                shard["class_pixels"] = [0] * len(pixels)
+                shard["class_slices"] = [0] * len(pixels)
+            for c, count in enumerate(pixels):
+                shard["class_pixels"][c] += int(count)
+                shard["class_slices"][c] += int(count > 0)
+    for writer in writers.values():
+        writer.close()
+
+    manifests = {}
+    for group, shard_stats in stats.items():
+        for shard in shard_stats:
+            shard["bytes"] = tf.io.gfile.stat(shard["path"]).length
+        manifests[group] = write_manifest(manifest_path(out_dir, group_filename(group, filename)), shard_stats,
+                                          compression_type=compression_type, label_format=label_format,
+                                          image_codec=codec, group=group, **info)
+    print(f"Info: Regrouped {len(filenames)} shard(s) into {len(stats)} group(s) in {time.perf_counter() - start:.1f}s")
+    return manifests
+
+
+def group_filenames(filenames):
+    """Splits shard paths into {group: paths} using the group field of their manifests"""
+    groups = {}
+    for filename, shard in zip(filenames, load_manifest(filenames)["shards"]):
+        groups.setdefault(shard.get("group", UNGROUPED), []).append(filename)
+    return groups
+
+
+def weighted_record_dataset(filenames, weights, compression_type=None, shuffle_size=0, seed=None):
+    """Serialized records of every group drawn with the mixing weights of weights
+
+    Every group is repeated forever, rare groups are oversampled instead of running out, so the
+    dataset is infinite and the training scripts have to pass steps_per_epoch.
+
+    Args:
+        filenames (list): shards of every group of a split
+        weights (dict): {group: weight}, weights are normalized, groups missing from weights are not read
+        compression_type (str): ZLIB, GZIP or None
+        shuffle_size (int): total shuffle buffer, shared by the groups in proportion to their weights
+        seed (int): seed of the group sampling
+    Return:
+        tf.data.Dataset: serialized records
+    """
+    by_group = group_filenames(filenames)
+    missing = [group for group in weights if group not in by_group]
+    if len(missing) > 0:
+        raise ValueError(f"No shards of group(s) {missing}, found {list(by_group)}. "
+                         f"Write the base with grouping or run stratify_records.py on it")
+    total = float(sum(weights.values()))
+    datasets, probabilities = [], []
+    for group, weight in weights.items():
+        group_files = by_group[group]
+        dataset = tf.data.TFRecordDataset(group_files, compression_type=compression_type, num_parallel_reads=tf.data.AUTOTUNE)
+        stale = load_manifest(group_files)["stale_hashes"]
+        if len(stale) > 0:
+            dataset = drop_stale_records(dataset, stale)
+        group_shuffle = int(shuffle_size * weight / total)
+        if group_shuffle > 0:
+            dataset = dataset.shuffle(group_shuffle)
+        datasets.append(dataset.repeat())
+        probabilities.append(weight / total)
+    return tf.data.experimental.sample_from_datasets(datasets, weights=probabilities, seed=seed)
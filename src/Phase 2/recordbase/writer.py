@@ -0,0 +1,141 @@
+# Sharded tfrecord writer. Every shard is owned by exactly one worker process so shards can be
+# written in parallel without any locking, and the shard contents only depend on the file order.
+import os
+import time
+import random
+import multiprocessing as mp
+import numpy as np
+import tensorflow as tf
+import tqdm
+
+
+def sort_and_shuffle(filenames, seed=None):
+    """Returns filenames in a reproducible order, glob order differs between file systems so we sort first"""
+    filenames = sorted(filenames)
+    if seed is not None:
+        random.Random(seed).shuffle(filenames)
+    return filenames
+
+
+def plan_shards(items, max_files, filename="batch", out_dir="./outdata/tfrecord/"):
+    """Splits items into shards of up to max_files items
+
+    Args:
+        items (list): anything the example function accepts, usually (img_path, label_path) tuples
+        max_files (int): maximum amount of examples in a shard
+        filename (str): name of the split, used in the shard names
+        out_dir (str): directory of the shards
+    Return:
+        list: (shard_path, shard_items) tuples in shard order
+    """
+    splits = (len(items)//max_files) + 1 #determine how many tfr shards are needed
+    if len(items)%max_files == 0:
+        splits-=1
+    shards = []
+    for i in range(splits):
+        shard_path = os.path.join(out_dir, f"tfrecord_{i+1}in{splits}_{filename}.tfrecords")
+        shards.append((shard_path, items[i*max_files:(i+1)*max_files]))
+    return shards
+
+
+def _examples(items, example_fn, batch_size):
+    if batch_size > 0:
+        for i in range(0, len(items), batch_size):
+            yield from example_fn(items[i:i+batch_size])
+    else:
+        for item in items:
+            yield example_fn(*item)
+
+
+def write_shard(shard_path, items, example_fn, compression_type=None, batch_size=0):
+    """Writes a single shard and returns its statistics
+
+    Args:
+        shard_path (str): output path of the shard
+        items (list): items to pass into example_fn one by one
+        example_fn (callable): returns serialized example bytes and a dict with class_pixels (and optionally
+            key and hash) of an item, should be picklable
+        compression_type (str): ZLIB, GZIP or None
+        batch_size (int): if > 0 example_fn gets lists of up to batch_size items and returns a list of
+            results, for sources that are cheaper to process in batches
+    Return:
+        dict: path, records, bytes, raw_bytes (uncompressed), class_pixels, class_slices, per record
+            record_info and seconds of the shard
+    """
+    start = time.perf_counter()
+    options = tf.io.TFRecordOptions(compression_type=compression_type) if compression_type else None
+    raw_bytes = 0
+    record_info = []
+    class_pixels = None
+    class_slices = None
+    with tf.io.TFRecordWriter(shard_path, options=options) as writer:
+        for serialized, info in _examples(items, example_fn, batch_size):
+            writer.write(serialized)
+            raw_bytes += len(serialized)
+            counts = np.asarray(info["class_pixels"], dtype=np.int64)
+            record_info.append({"key": info.get("key"), "hash": info.get("hash"),
+                                "raw_bytes": len(serialized), "class_pixels": counts.tolist()})
+            if class_pixels is None:
+                class_pixels = np.zeros_like(counts)
+                class_slices = np.zeros_like(counts)
+            class_pixels += counts
+            class_slices += counts > 0
+    return {
+        "path": shard_path,
+        "records": len(items),
+        "bytes": tf.io.gfile.stat(shard_path).length,
+        "raw_bytes": raw_bytes,
+        "class_pixels": [] if class_pixels is None else class_pixels.tolist(),
+        "class_slices": [] if class_slices is None else class_slices.tolist(),
+        "record_info": record_info,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def _write_shard_task(task):
+    return write_shard(*task)
+
+
+def report_shard(stats):
+    files_per_sec = stats["records"] / max(stats["seconds"], 1e-9)
+    print(f"{os.path.basename(stats['path'])}: {stats['records']} files in {stats['seconds']:.1f}s "
+          f"({files_per_sec:.1f} files/sec), {stats['bytes'] / 2**20:.1f} MiB")
+
+
+def write_shards(shards, example_fn, compression_type=None, num_workers=0, batch_size=0):
+    """Writes planned shards, in a process pool if num_workers > 0
+
+    Shards are handed out whole, so which file ends up in which shard never depends on
+    the amount of workers or on scheduling.
+
+    Args:
+        shards (list): output of plan_shards
+        example_fn (callable): module level function (or functools.partial of one) creating serialized examples
+        compression_type (str): ZLIB, GZIP or None
+        num_workers (int): amount of worker processes, 0 writes on the calling process
+        batch_size (int): see write_shard
+    Return:
+        list: statistics dict of every shard in shard order
+    """
+    if len(shards) > 0:
+        os.makedirs(os.path.dirname(shards[0][0]) or ".", exist_ok=True)
+    tasks = [(shard_path, items, example_fn, compression_type, batch_size) for shard_path, items in shards]
+    start = time.perf_counter()
+    all_stats = []
+    if num_workers > 0 and len(tasks) > 0: # an empty split or an incremental build without changes has no shards
+        # tensorflow is not fork safe, workers have to start with a fresh interpreter
+        with mp.get_context("spawn").Pool(processes=min(num_workers, len(tasks))) as pool:
+            for stats in tqdm.tqdm(pool.imap(_write_shard_task, tasks), total=len(tasks)):
+                all_stats.append(stats)
+    else:
+        for task in tqdm.tqdm(tasks):
+            all_stats.append(_write_shard_task(task))
+    elapsed = time.perf_counter() - start
+
+    for stats in all_stats:
+        report_shard(stats)
+    total_records = sum(s["records"] for s in all_stats)
+    total_bytes = sum(s["bytes"] for s in all_stats)
+    print(f"\nWrote {total_records} elements to TFRecord in {elapsed:.1f}s "
+          f"({total_records / max(elapsed, 1e-9):.1f} files/sec, {total_bytes / 2**20:.1f} MiB)")
+    return all_stats
@@ -113,6 +113,8 @@ from .models.unet import Unet as _Unet
 from .models.pspnet import PSPNet as _PSPNet
 from .models.linknet import Linknet as _Linknet
 from .models.fpn import FPN as _FPN
+from .models._preprocessing import get_preprocessing_layer_class as _get_preprocessing_layer_class
+from .models._recompute import enable_recompute, disable_recompute
 from .custom.custom_registry import Custom_Registry
 
 custom = Custom_Registry(_KERAS_BACKEND, _KERAS_LAYERS, _KERAS_MODELS, _KERAS_UTILS)
@@ -135,10 +137,22 @@ def get_preprocessing(name):
     return preprocess_input
 
 
+def get_preprocessing_layer(name):
+    """In-model version of ``get_preprocessing``, a layer taking uint8 images, see ``input_preprocessing`` of the models"""
+    return inject_global_submodules(_get_preprocessing_layer_class)()(name)
+
+
+def get_custom_objects():
+    """Custom objects needed by ``load_model`` for models built with ``input_preprocessing=True``"""
+    layer_class = inject_global_submodules(_get_preprocessing_layer_class)()
+    return {layer_class.__name__: layer_class}
+
+
 __all__ = [
     'Unet', 'PSPNet', 'FPN', 'Linknet', 'custom'
     'set_framework', 'framework',
-    'get_preprocessing', 'get_available_backbone_names',
+    'get_preprocessing', 'get_preprocessing_layer', 'get_custom_objects', 'get_available_backbone_names',
+    'enable_recompute', 'disable_recompute',
     'losses', 'metrics', 'utils',
     '__version__',
 ]
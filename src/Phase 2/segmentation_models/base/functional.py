@@ -37,6 +37,12 @@ def gather_channels(*xs, indexes=None, **kwargs):
     return xs
 
 
+def to_float32(*xs, **kwargs):
+    """Cast float16 / bfloat16 tensors to float32, ``epsilon`` clipping, ``log`` and ``pow`` are not safe in them"""
+    backend = kwargs['backend']
+    return [backend.cast(x, 'float32') if backend.dtype(x) in ('float16', 'bfloat16') else x for x in xs]
+
+
 def round_if_needed(x, threshold, **kwargs):
     backend = kwargs['backend']
     if threshold is not None:
@@ -84,6 +90,7 @@ def iou_score(gt, pr, class_weights=1., class_indexes=None, smooth=SMOOTH, per_i
     """
 
     backend = kwargs['backend']
+    gt, pr = to_float32(gt, pr, **kwargs)
 
     gt, pr = gather_channels(gt, pr, indexes=class_indexes, **kwargs)
     pr = round_if_needed(pr, threshold, **kwargs)
@@ -136,6 +143,7 @@ def f_score(gt, pr, beta=1, class_weights=1, class_indexes=None, smooth=SMOOTH,
     """
 
     backend = kwargs['backend']
+    gt, pr = to_float32(gt, pr, **kwargs)
 
     gt, pr = gather_channels(gt, pr, indexes=class_indexes, **kwargs)
     pr = round_if_needed(pr, threshold, **kwargs)
@@ -177,6 +185,7 @@ def precision(gt, pr, class_weights=1, class_indexes=None, smooth=SMOOTH, per_im
         float: precision score
     """
     backend = kwargs['backend']
+    gt, pr = to_float32(gt, pr, **kwargs)
 
     gt, pr = gather_channels(gt, pr, indexes=class_indexes, **kwargs)
     pr = round_if_needed(pr, threshold, **kwargs)
@@ -216,6 +225,7 @@ def recall(gt, pr, class_weights=1, class_indexes=None, smooth=SMOOTH, per_image
         float: recall score
     """
     backend = kwargs['backend']
+    gt, pr = to_float32(gt, pr, **kwargs)
 
     gt, pr = gather_channels(gt, pr, indexes=class_indexes, **kwargs)
     pr = round_if_needed(pr, threshold, **kwargs)
@@ -236,6 +246,7 @@ def recall(gt, pr, class_weights=1, class_indexes=None, smooth=SMOOTH, per_image
 
 def categorical_crossentropy(gt, pr, class_weights=1., class_indexes=None, **kwargs):
     backend = kwargs['backend']
+    gt, pr = to_float32(gt, pr, **kwargs)
 
     gt, pr = gather_channels(gt, pr, indexes=class_indexes, **kwargs)
 
@@ -253,6 +264,7 @@ def categorical_crossentropy(gt, pr, class_weights=1., class_indexes=None, **kwa
 
 def binary_crossentropy(gt, pr, **kwargs):
     backend = kwargs['backend']
+    gt, pr = to_float32(gt, pr, **kwargs)
     return backend.mean(backend.binary_crossentropy(gt, pr))
 
 
@@ -272,6 +284,7 @@ def categorical_focal_loss(gt, pr, gamma=2.0, alpha=0.25, class_indexes=None, **
     """
 
     backend = kwargs['backend']
+    gt, pr = to_float32(gt, pr, **kwargs)
     gt, pr = gather_channels(gt, pr, indexes=class_indexes, **kwargs)
 
     # clip to prevent NaN's and Inf's
@@ -298,6 +311,7 @@ def binary_focal_loss(gt, pr, gamma=2.0, alpha=0.25, **kwargs):
 
     """
     backend = kwargs['backend']
+    gt, pr = to_float32(gt, pr, **kwargs)
 
     # clip to prevent NaN's and Inf's
     pr = backend.clip(pr, backend.epsilon(), 1.0 - backend.epsilon())
@@ -5,6 +5,7 @@ from tensorflow.keras.models import Model
 from tensorflow.keras.applications import *
 from ..models._common_blocks import Conv2dBn
 from ..models._utils import freeze_model
+from ..models._recompute import enable_recompute
 from ..backbones.backbones_factory import Backbones
 from keras_applications import get_submodules_from_kwargs
 
@@ -400,6 +401,7 @@ def double_unet(backbone_name='vgg19',
                 encoder_filters=(16, 32, 64, 128, 256),
                 decoder_filters=(256, 128, 64, 32, 16),
                 use_batchnorm=True,
+                recompute=False,
                 **kwargs):
 
     """ Double Unet is a fully convolution neural network for semantic segmantation.
@@ -432,6 +434,8 @@ def double_unet(backbone_name='vgg19',
         decoder_filters: list of numbers of ``Conv2D`` layer filters in decoder blocks
         use_batchnorm: if ``True``, ``BatchNormalisation`` layer between ``Conv2D`` and ``Activation`` layers
             is used.
+        recompute: if ``True`` the activations of the encoder stages and decoder blocks are recomputed during
+            backprop instead of being kept, see ``enable_recompute``. Not saved with the model.
 
     Returns:
         ``keras.models.Model``: **Double Unet**
@@ -497,4 +501,8 @@ def double_unet(backbone_name='vgg19',
     if weights is not None:
         model.load_weights(weights)
 
+    # trade compute for activation memory in training
+    if recompute:
+        enable_recompute(model)
+
     return model
\ No newline at end of file
@@ -0,0 +1,75 @@
+from keras_applications import get_submodules_from_kwargs
+
+from ..backbones.backbones_factory import Backbones
+
+_layer_classes = {}
+
+
+def get_preprocessing_layer_class(**kwargs):
+    """
+    Build (once per framework) the ``BackbonePreprocessing`` layer class
+    Args:
+        **kwargs: ``backend``, ``layers``, ``models`` and ``utils`` submodules of the framework
+
+    Returns:
+        ``BackbonePreprocessing`` layer class, needed as custom object to load models using it
+    """
+    backend, layers, models, keras_utils = get_submodules_from_kwargs(kwargs)
+    submodules = {'backend': backend, 'layers': layers, 'models': models, 'utils': keras_utils}
+    if layers in _layer_classes:
+        return _layer_classes[layers]
+
+    class BackbonePreprocessing(layers.Layer):
+        """Casts uint8 images to float32 and applies the preprocessing of a backbone,
+        same as ``sm.get_preprocessing(backbone_name)`` but inside the model graph
+
+        Args:
+            backbone_name: name of the backbone in the ``Backbones`` registry.
+        """
+
+        def __init__(self, backbone_name, **kwargs):
+            kwargs.setdefault('dtype', 'float32')  # normalization stays float32 under mixed precision
+            super(BackbonePreprocessing, self).__init__(**kwargs)
+            self.backbone_name = backbone_name
+            self.preprocess_input = Backbones.get_preprocessing(backbone_name)
+
+        def call(self, inputs):
+            x = backend.cast(inputs, 'float32')
+            return self.preprocess_input(x, **submodules)
+
+        def compute_output_shape(self, input_shape):
+            return input_shape
+
+        def get_config(self):
+            config = super(BackbonePreprocessing, self).get_config()
+            config.update({'backbone_name': self.backbone_name})
+            return config
+
+    _layer_classes[layers] = BackbonePreprocessing
+    return BackbonePreprocessing
+
+
+def get_backbone(backbone_name, input_shape, weights, input_preprocessing=False, **kwargs):
+    """
+    Build a backbone without top, optionally with a uint8 input and ``BackbonePreprocessing``
+    in front of it. The preprocessing layer becomes part of the backbone graph, so the layer
+    names of the backbone do not change.
+    Args:
+        backbone_name: name of the backbone.
+        input_shape: shape of input data/image ``(H, W, C)``.
+        weights: encoder weights.
+        input_preprocessing: if ``True`` the model input is uint8 and normalized in the model.
+        **kwargs: framework submodules and backbone arguments.
+
+    Returns:
+        ``keras.models.Model``: backbone
+    """
+    if not input_preprocessing:
+        return Backbones.get_backbone(backbone_name, input_shape=input_shape, weights=weights, include_top=False, **kwargs)
+
+    _, layers, _, _ = get_submodules_from_kwargs(kwargs)
+    preprocessing_layer = get_preprocessing_layer_class(**kwargs)
+    input_ = layers.Input(shape=input_shape, dtype='uint8', name='input_uint8')
+    x = preprocessing_layer(backbone_name, name='input_preprocessing')(input_)
+    return Backbones.get_backbone(backbone_name, input_tensor=x, input_shape=input_shape, weights=weights,
+                                  include_top=False, **kwargs)
@@ -0,0 +1,200 @@
+"""Activation recomputation (gradient checkpointing) of functional segmentation models.
+
+The layer graph of a built model is cut into segments by layer name: the encoder stages of the
+backbone and the decoder blocks. In training mode a segment only keeps its input tensors and
+recomputes its inner activations during backprop, trading about a third more compute for a much
+smaller activation memory. The model itself is not changed, only its ``call`` is replaced, so
+weights, layer names, ``model.layers`` and saved ``.h5`` files stay the same as without it.
+
+Relies on the node graph of tf.keras functional models (``_nodes_by_depth``).
+"""
+import re
+import contextlib
+import tensorflow as tf
+
+# a layer belongs to the segment of the first match, e.g. `block3b_expand_conv` -> `block3`
+SEGMENT_PATTERNS = [
+    r'^(decoder_stage\d+)',  # Unet, Linknet decoder blocks
+    r'^(decoder_(?:upsampling|transpose)_\d+_stage\d+)',  # Double Unet decoder blocks
+    r'^encoder2_.*?(stage\d+)',  # Double Unet second encoder
+    r'^(fpn_stage_p\d+|segm_stage\d+)',  # FPN pyramid and segmentation blocks
+    r'^((?:stage|block|conv)_?\d+)(?=[a-z]?_)',  # backbone stages: resnet `stage1_`, efficientnet `block1a_`, vgg `block1_`, densenet `conv2_`
+]
+
+
+def segment_key(layer_name, patterns=SEGMENT_PATTERNS):
+    """Segment of a layer, ``None`` for layers outside of any stage or block"""
+    for pattern in patterns:
+        match = re.match(pattern, layer_name)
+        if match is not None:
+            return match.group(1)
+    return None
+
+
+class Segment:
+    """Consecutive nodes of a model graph
+
+    Args:
+        key: segment name, ``None`` for nodes run without recomputation
+        nodes: keras nodes in execution order
+        inputs: ids of the tensors the nodes take from earlier segments
+        outputs: ids of the tensors used by later segments or returned by the model
+    """
+
+    def __init__(self, key, nodes, inputs, outputs):
+        self.key = key
+        self.nodes = nodes
+        self.inputs = inputs
+        self.outputs = outputs
+
+
+def _node_tensors(node):
+    return [id(t) for t in tf.nest.flatten(node.keras_inputs)], [id(t) for t in tf.nest.flatten(node.outputs)]
+
+
+def plan_segments(model, patterns=SEGMENT_PATTERNS):
+    """Cuts the graph of a functional model into segments
+
+    Nodes are put in an execution order keeping the nodes of a segment together. Unnamed layers
+    between two layers of a segment (e.g. the ``Add`` of a residual unit) join the segment.
+
+    Returns:
+        list of ``Segment``
+    """
+    nodes = [node for depth in sorted(model._nodes_by_depth, reverse=True)
+             for node in model._nodes_by_depth[depth] if not node.is_input]
+    producer = {t: node for node in nodes for t in _node_tensors(node)[1]}
+    pending = {id(node): {id(producer[t]) for t in _node_tensors(node)[0] if t in producer} for node in nodes}
+
+    # topological order, the nodes of the current segment first
+    order, current, done = [], None, set()
+    while len(order) < len(nodes):
+        ready = [node for node in nodes if id(node) not in done and pending[id(node)] <= done]
+        keys = [segment_key(node.layer.name, patterns) for node in ready]
+        pick = next((i for i, key in enumerate(keys) if key == current and key is not None), None)
+        if pick is None:
+            pick = next((i for i, key in enumerate(keys) if key is None), 0)
+        node = ready[pick]
+        current = keys[pick] if keys[pick] is not None else current
+        order.append((current, node))
+        done.add(id(node))
+
+    runs = []
+    for key, node in order:
+        if runs and runs[-1][0] == key:
+            runs[-1][1].append(node)
+        else:
+            runs.append((key, [node]))
+
+    model_outputs = {id(t) for t in tf.nest.flatten(model.outputs)}
+    segments = []
+    for i, (key, run) in enumerate(runs):
+        consumed = {t for node in run for t in _node_tensors(node)[0]}
+        produced = [t for node in run for t in _node_tensors(node)[1]]
+        later = {t for _, other in runs[i + 1:] for node in other for t in _node_tensors(node)[0]} | model_outputs
+        segments.append(Segment(key, run, sorted(consumed - set(produced)), [t for t in produced if t in later]))
+    return segments
+
+
+@contextlib.contextmanager
+def _frozen_statistics(nodes):
+    """The recomputation normalizes with the batch statistics again but must not update the moving ones twice"""
+    layers = [node.layer for node in nodes if isinstance(node.layer, tf.keras.layers.BatchNormalization)]
+    momenta = [layer.momentum for layer in layers]
+    for layer in layers:
+        layer.momentum = 1.0
+    try:
+        yield
+    finally:
+        for layer, momentum in zip(layers, momenta):
+            layer.momentum = momentum
+
+
+def _stateless_dropout(layer, x, seed):
+    """Dropout drawing the same mask in the forward pass and in its recomputation"""
+    if layer.rate == 0:
+        return x
+    noise_shape = layer._get_noise_shape(x)
+    keep = tf.random.stateless_uniform(tf.shape(x) if noise_shape is None else noise_shape, seed) >= layer.rate
+    return x * tf.cast(keep, x.dtype) / tf.cast(1.0 - layer.rate, x.dtype)
+
+
+def _run_nodes(nodes, tensors, training, seed=None):
+    """Calls the layers of nodes on the tensors of ``{keras tensor id: tensor}``, adds their outputs to it"""
+    for i, node in enumerate(nodes):
+        args, kwargs = tf.nest.map_structure(lambda a: tensors.get(id(a), a), (node.call_args, node.call_kwargs))
+        if seed is not None and isinstance(node.layer, tf.keras.layers.Dropout) and training:
+            outputs = _stateless_dropout(node.layer, args[0], seed + tf.constant([0, i], tf.int64))
+        else:
+            if getattr(node.layer, '_expects_training_arg', False) and 'training' not in kwargs:
+                # the recomputation runs outside of the call context of the model
+                kwargs = dict(kwargs, training=training)
+            outputs = node.layer(*args, **kwargs)
+        for t, y in zip(tf.nest.flatten(node.outputs), tf.nest.flatten(outputs)):
+            tensors[id(t)] = y
+    return tensors
+
+
+def _recomputed(segment, training, seed):
+    passes = []
+
+    def run(*inputs):
+        recomputation = len(passes) > 0
+        passes.append(recomputation)
+        tensors = dict(zip(segment.inputs, inputs))
+        with _frozen_statistics(segment.nodes) if recomputation else contextlib.nullcontext():
+            tensors = _run_nodes(segment.nodes, tensors, training, seed)
+        return [tensors[t] for t in segment.outputs]
+
+    return tf.recompute_grad(run)
+
+
+def enable_recompute(model, patterns=SEGMENT_PATTERNS):
+    """Recomputes the segments of a functional model during backprop instead of keeping their activations
+
+    Only calls with ``training=True`` are segmented, inference runs the plain graph. Dropout inside a
+    segment draws its mask from a per call seed, so the recomputation drops the same units. The
+    replaced ``call`` is not saved with the model, call it again after ``load_model``.
+
+    Args:
+        model: functional ``keras.models.Model``, e.g. of ``Unet``, ``FPN``, ``Linknet`` or ``Double_Unet``
+        patterns: regular expressions of the segment names, see ``SEGMENT_PATTERNS``
+
+    Returns:
+        the same model
+
+    Raises:
+        ValueError: if no layer name matches a pattern
+    """
+    segments = plan_segments(model, patterns)
+    if all(segment.key is None for segment in segments):
+        raise ValueError('No encoder stage or decoder block found in model {}.'.format(model.name))
+    functional_call = type(model).call
+
+    @tf.autograph.experimental.do_not_convert
+    def call(inputs, training=None, mask=None):
+        if training is not True:
+            return functional_call(model, inputs, training=training, mask=mask)
+        flat_inputs = model._flatten_to_reference_inputs(inputs)
+        tensors = {id(t): model._conform_to_reference_input(x, t) for t, x in zip(model.inputs, flat_inputs)}
+        base_seed = tf.random.uniform([2], maxval=2 ** 31 - 1, dtype=tf.int64)
+        for i, segment in enumerate(segments):
+            if segment.key is None:
+                tensors = _run_nodes(segment.nodes, tensors, training)
+            else:
+                seed = base_seed + tf.constant([i, 0], tf.int64)
+                outputs = _recomputed(segment, training, seed)(*[tensors[t] for t in segment.inputs])
+                tensors.update(zip(segment.outputs, outputs))
+        return tf.nest.pack_sequence_as(model._nested_outputs, [tensors[id(t)] for t in tf.nest.flatten(model.outputs)])
+
+    model.call = call
+    model.recompute_segments = [segment.key for segment in segments if segment.key is not None]
+    return model
+
+
+def disable_recompute(model):
+    """Restores the plain ``call`` of a model of ``enable_recompute``"""
+    if 'call' in model.__dict__:
+        del model.call
+        del model.recompute_segments
+    return model
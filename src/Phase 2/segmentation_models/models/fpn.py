@@ -3,6 +3,8 @@ from keras_applications import get_submodules_from_kwargs
 from ._common_blocks import Conv2dBn
 from ._utils import freeze_model
 from ..backbones.backbones_factory import Backbones
+from ._preprocessing import get_backbone
+from ._recompute import enable_recompute
 
 backend = None
 layers = None
@@ -185,6 +187,8 @@ def FPN(
         pyramid_use_batchnorm=True,
         pyramid_aggregation='concat',
         pyramid_dropout=None,
+        input_preprocessing=False,
+        recompute=False,
         **kwargs
 ):
     """FPN_ is a fully convolution neural network for image semantic segmentation
@@ -208,6 +212,10 @@ def FPN(
                 is used.
         pyramid_aggregation: one of 'sum' or 'concat'. The way to aggregate pyramid blocks.
         pyramid_dropout: spatial dropout rate for feature pyramid in range (0, 1).
+        input_preprocessing: if ``True`` the model takes uint8 images and applies the backbone preprocessing
+            itself (``BackbonePreprocessing`` layer), so the input pipeline does not have to normalize images.
+        recompute: if ``True`` the activations of the encoder stages and decoder blocks are recomputed during
+            backprop instead of being kept, see ``enable_recompute``. Not saved with the model.
 
     Returns:
         ``keras.models.Model``: **FPN**
@@ -219,12 +227,12 @@ def FPN(
     global backend, layers, models, keras_utils
     backend, layers, models, keras_utils = get_submodules_from_kwargs(kwargs)
 
-    backbone = Backbones.get_backbone(
+    backbone = get_backbone(
         backbone_name,
         input_shape=input_shape,
         weights=encoder_weights,
-        include_top=False,
-        **kwargs,
+        input_preprocessing=input_preprocessing,
+        **kwargs
     )
 
     if encoder_features == 'default':
@@ -250,4 +258,8 @@ def FPN(
     if weights is not None:
         model.load_weights(weights)
 
+    # trade compute for activation memory in training
+    if recompute:
+        enable_recompute(model)
+
     return model
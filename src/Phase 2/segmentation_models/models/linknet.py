@@ -3,6 +3,8 @@ from keras_applications import get_submodules_from_kwargs
 from ._common_blocks import Conv2dBn
 from ._utils import freeze_model
 from ..backbones.backbones_factory import Backbones
+from ._preprocessing import get_backbone
+from ._recompute import enable_recompute
 
 backend = None
 layers = None
@@ -194,6 +196,8 @@ def Linknet(
         decoder_block_type='upsampling',
         decoder_filters=(None, None, None, None, 16),
         decoder_use_batchnorm=True,
+        input_preprocessing=False,
+        recompute=False,
         **kwargs
 ):
     """Linknet_ is a fully convolution neural network for fast image semantic segmentation
@@ -224,6 +228,10 @@ def Linknet(
         decoder_block_type: one of
                     - `upsampling`:  use ``UpSampling2D`` keras layer
                     - `transpose`:   use ``Transpose2D`` keras layer
+        input_preprocessing: if ``True`` the model takes uint8 images and applies the backbone preprocessing
+            itself (``BackbonePreprocessing`` layer), so the input pipeline does not have to normalize images.
+        recompute: if ``True`` the activations of the encoder stages and decoder blocks are recomputed during
+            backprop instead of being kept, see ``enable_recompute``. Not saved with the model.
 
     Returns:
         ``keras.models.Model``: **Linknet**
@@ -243,12 +251,12 @@ def Linknet(
         raise ValueError('Decoder block type should be in ("upsampling", "transpose"). '
                          'Got: {}'.format(decoder_block_type))
 
-    backbone = Backbones.get_backbone(
+    backbone = get_backbone(
         backbone_name,
         input_shape=input_shape,
         weights=encoder_weights,
-        include_top=False,
-        **kwargs,
+        input_preprocessing=input_preprocessing,
+        **kwargs
     )
 
     if encoder_features == 'default':
@@ -273,4 +281,8 @@ def Linknet(
     if weights is not None:
         model.load_weights(weights)
 
+    # trade compute for activation memory in training
+    if recompute:
+        enable_recompute(model)
+
     return model
@@ -3,6 +3,7 @@ from keras_applications import get_submodules_from_kwargs
 from ._common_blocks import Conv2dBn
 from ._utils import freeze_model
 from ..backbones.backbones_factory import Backbones
+from ._preprocessing import get_backbone
 
 backend = None
 layers = None
@@ -165,6 +166,7 @@ def PSPNet(
         psp_pooling_type='avg',
         psp_use_batchnorm=True,
         psp_dropout=None,
+        input_preprocessing=False,
         **kwargs
 ):
     """PSPNet_ is a fully convolution neural network for image semantic segmentation
@@ -187,6 +189,8 @@ def PSPNet(
         psp_use_batchnorm: if ``True``, ``BatchNormalisation`` layer between ``Conv2D`` and ``Activation`` layers
                 is used.
         psp_dropout: dropout rate between 0 and 1.
+        input_preprocessing: if ``True`` the model takes uint8 images and applies the backbone preprocessing
+            itself (``BackbonePreprocessing`` layer), so the input pipeline does not have to normalize images.
 
     Returns:
         ``keras.models.Model``: **PSPNet**
@@ -202,11 +206,11 @@ def PSPNet(
     # control image input shape
     check_input_shape(input_shape, downsample_factor)
 
-    backbone = Backbones.get_backbone(
+    backbone = get_backbone(
         backbone_name,
         input_shape=input_shape,
         weights=encoder_weights,
-        include_top=False,
+        input_preprocessing=input_preprocessing,
         **kwargs
     )
 
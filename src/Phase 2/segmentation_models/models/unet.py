@@ -3,6 +3,8 @@ from keras_applications import get_submodules_from_kwargs
 from ._common_blocks import Conv2dBn
 from ._utils import freeze_model
 from ..backbones.backbones_factory import Backbones
+from ._preprocessing import get_backbone
+from ._recompute import enable_recompute
 
 backend = None
 layers = None
@@ -167,6 +169,8 @@ def Unet(
         decoder_block_type='upsampling',
         decoder_filters=(256, 128, 64, 32, 16),
         decoder_use_batchnorm=True,
+        input_preprocessing=False,
+        recompute=False,
         **kwargs
 ):
     """ Unet is a fully convolution neural network for image semantic segmentation
@@ -194,6 +198,10 @@ def Unet(
         decoder_filters: list of numbers of ``Conv2D`` layer filters in decoder blocks
         decoder_use_batchnorm: if ``True``, ``BatchNormalisation`` layer between ``Conv2D`` and ``Activation`` layers
             is used.
+        input_preprocessing: if ``True`` the model takes uint8 images and applies the backbone preprocessing
+            itself (``BackbonePreprocessing`` layer), so the input pipeline does not have to normalize images.
+        recompute: if ``True`` the activations of the encoder stages and decoder blocks are recomputed during
+            backprop instead of being kept, see ``enable_recompute``. Not saved with the model.
 
     Returns:
         ``keras.models.Model``: **Unet**
@@ -214,12 +222,12 @@ def Unet(
         raise ValueError('Decoder block type should be in ("upsampling", "transpose"). '
                          'Got: {}'.format(decoder_block_type))
 
-    backbone = Backbones.get_backbone(
+    backbone = get_backbone(
         backbone_name,
         input_shape=input_shape,
         weights=encoder_weights,
-        include_top=False,
-        **kwargs,
+        input_preprocessing=input_preprocessing,
+        **kwargs
     )
 
     if encoder_features == 'default':
@@ -244,4 +252,8 @@ def Unet(
     if weights is not None:
         model.load_weights(weights)
 
+    # trade compute for activation memory in training
+    if recompute:
+        enable_recompute(model)
+
     return model
@@ -0,0 +1,27 @@
+# Splits the dataset into train/val by writing a split manifest instead of copying the files
+# (replaces recreate_dataset.ipynb). create_tfrecords.py, create_arrays.py and train_model_no_tfrc.py
+# read the pairs of a split from SPLIT_MANIFEST, re-splitting only rewrites the manifest.
+import os
+from recordbase.splits import make_splits, write_split_manifest, read_split_manifest, load_split, link_split
+
+DATASET_DATA_DIR = './data/dataset1/data/'
+DATASET_LABEL_DIR = './data/dataset1/label/'
+IMG_EXT = "png"
+
+SPLIT_MANIFEST = './data/dataset1/splits.json'
+SPLITS = {"train": 4977, "val": 1659} # file count or fraction of the files, the last split gets the rest
+SEED = 42 # None keeps sorted order
+
+# optional split directories for tools that can not read the manifest, hardlinks take no extra space
+LINK_SPLITS = False
+LINK_DIRS = {"train": ('./data/dataset1/train/', './data/dataset1/train_label/'),
+             "val": ('./data/dataset1/val/', './data/dataset1/val_label/')}
+
+if __name__ == '__main__':
+    previous = read_split_manifest(SPLIT_MANIFEST) if os.path.exists(SPLIT_MANIFEST) else None
+    manifest = make_splits(DATASET_DATA_DIR, DATASET_LABEL_DIR, SPLITS, seed=SEED, ext=IMG_EXT, previous=previous)
+    write_split_manifest(SPLIT_MANIFEST, manifest)
+    if LINK_SPLITS:
+        for split, (data_dir, label_dir) in LINK_DIRS.items():
+            link_split(load_split(SPLIT_MANIFEST, split), data_dir, label_dir)
+            print(f"Info: Linked split {split} into {data_dir} and {label_dir}")
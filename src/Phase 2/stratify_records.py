@@ -0,0 +1,27 @@
+# Splits every split of an existing record base into class-stratified shard groups (see recordbase.strata),
+# for bases written before the writers could group records. Records are copied without decoding.
+import os
+import tensorflow as tf
+from recordbase.strata import regroup_records
+
+# Dataset Constants
+DATASET_PATH = "./final_recordbase"
+SPLIT_DIRS = ["train"] # validation and test splits do not need balanced batches
+RECORD_ENCODING_TYPE = "ZLIB" # none if no encoding is used
+OUT_PATH = "./final_recordbase_grouped"
+MAX_FILES = 200
+
+# phase 1 classification records are grouped by label, use the CLASSES of train_p1.py
+# segmentation records are always grouped into lesion and no_lesion
+CLASS_NAMES = ['inme_yok', 'inme_var']
+
+if __name__ == '__main__':
+    for split in SPLIT_DIRS:
+        split_dir = os.path.join(DATASET_PATH, split)
+        filenames = tf.io.gfile.glob(f"{split_dir}/*.tfrecords")
+        if len(filenames) == 0:
+            print(f"Info: No records in {split_dir}, skipping")
+            continue
+        print(f"Info: Grouping {len(filenames)} shard(s) of split **{split}**")
+        regroup_records(filenames, RECORD_ENCODING_TYPE, os.path.join(OUT_PATH, split), filename=split,
+                        max_files=MAX_FILES, class_names=CLASS_NAMES)
@@ -1,27 +1,48 @@
 # Here is the imports
 import os
+FLAGS = [] # tensorboard, mixed_precision (float16 on GPU), bfloat16 (oneDNN on CPU), fine_tune
+if "bfloat16" in FLAGS:
+    os.environ.setdefault('TF_ENABLE_ONEDNN_OPTS', '1') # bfloat16 kernels of CPUs, read when tensorflow loads
 from tensorflow.python.keras import optimizers
 
 from tensorflow.python.keras.callbacks import EarlyStopping, ModelCheckpoint
 os.environ['TF_GPU_THREAD_MODE'] = 'gpu_private'
-FLAGS = [] # tensorboard, mixed_precision, fine_tune
 from tensorflow import keras
 import numpy as np
 import tensorflow as tf
+from recordbase.distribute import (worker_strategy, num_workers, task_name, is_chief, run_stamp, write_directory,
+                                   worker_steps, shard_batches, distribute_batches)
+STRATEGY = worker_strategy() # multi-worker runs with TF_CONFIG (see launch_workers.py) need it before any other tensorflow op
 #physical_devices = tf.config.list_physical_devices('GPU')
 #tf.config.experimental.set_memory_growth(physical_devices[0], True)
 import segmentation_models as sm
 sm.set_framework("tf.keras")
-if "mixed_precision" in FLAGS:
-    print(f"PreTrain: Using Mixed Policy float16")
-    keras.mixed_precision.set_global_policy('mixed_float16')
+from recordbase.precision import precision_policy, set_precision_policy, loss_scale_optimizer, model_policy, cast_model, FLOAT32
+PRECISION = precision_policy(FLAGS)
+if PRECISION != FLOAT32:
+    set_precision_policy(PRECISION)
 # keras.mixed_precision.set_global_policy('mixed_float16') normally this would provide extra speed for the model
 # but in the case of 1660ti gpus they seem like they have tensor cores even they don't thus it slows down the model use this on higher powered models
 AUTOTUNE = tf.data.AUTOTUNE
 import random
 import albumentations as A
-from datetime import datetime
 from tensorflow.keras.callbacks import TensorBoard
+from recordbase.augment import augment_batch
+from recordbase.reader import (detect_schema, parse_examples_batch, decode_image_batch, decode_label_batch, drop_stale_records,
+                               decode_class_map_batch, class_map_to_onehot, expand_channels)
+from recordbase.cache import apply_cache, decoded_shuffle_size, CACHE_OFF, CACHE_RAM, CACHE_DISK
+from recordbase.manifest import load_manifest, steps_per_epoch, shuffle_buffer_size
+from recordbase.strata import weighted_record_dataset, LESION, NO_LESION
+from recordbase.writer import sort_and_shuffle
+from recordbase.resume import ResumeState, ResumeCallback, parse_resume_args, latest_run, epoch_seed, LATEST
+from recordbase.schema import RECORD_HASH_KEY
+from recordbase.boxes import load_box_index, box_lookup, LESION_BOX
+from recordbase.patches import sample_patches, check_patch_size
+from recordbase.headcrop import (canvas_sizes, record_head_box, image_head_box, bucket_by_canvas, crop_to_canvas,
+                                 CANVAS_SIZES)
+from recordbase.hardexamples import HardExampleSampler, HardExampleCallback, per_sample_loss, record_id, record_ids
+from recordbase.engine import attach_train_step
+from recordbase.checkpoints import CheckpointWriter, CheckpointCallback
 from tensorflow.keras.models import load_model
 from tensorflow.keras import layers
 from tensorflow.keras import backend as K
@@ -39,14 +60,40 @@ RECORD_ENCODING_TYPE = "ZLIB" # none if no encoding is used
 
 # Pipeline parameters
 BUFFER_SIZE = None # set buffer size to default value, change if you have bottleneck
-SHUFFLE_SIZE = 256 # because dataset is too large huge shuffle sizes may cause problems with ram
+SHUFFLE_SIZE = None # None picks the largest buffer fitting into SHUFFLE_MEMORY_MB from the record base manifest
+SHUFFLE_MEMORY_MB = 1024 # because dataset is too large huge shuffle sizes may cause problems with ram
+TRAIN_CACHE = CACHE_OFF # off, ram or disk, caches decoded uint8 samples before augmentation
+VAL_CACHE = CACHE_RAM # validation is the same every epoch, it is only read and decoded once
+CACHE_DIR = "./cache" # disk snapshots, every shard list and decode config gets its own directory
+if num_workers() > 1:
+    CACHE_DIR = os.path.join(CACHE_DIR, task_name()) # workers on one node do not share snapshots
+DECODE_BATCH = 32 # records parsed and decoded together in front of the cache
+GROUP_WEIGHTS = None # e.g. {LESION: 0.5, NO_LESION: 0.5}, mixing weights of a base written with STRATIFY or stratify_records.py
+AUGMENT_BACKEND = "tf" # tf: in-graph recordbase.augment, albumentations: aug_fn in tf.numpy_function
+AUGMENT_PARAMS = {"rotate_limit": 20} # same transforms as aug_fn
 BATCH_SIZE = 2 # Highly dependent on d-gpu and system ram
-STEPS_PER_EPOCH = 6486//BATCH_SIZE # 4646 IMPORTANT this value should be equal to file_amount/batch_size because we can't find file_amount from tf.Dataset you should note it yourself
-VAL_STEPS_PER_EPOCH = 150//BATCH_SIZE # 995 same as steps per epoch
+PATCH_SIZE = None # e.g. 256, trains on square crops (multiple of 32) of the slices, validation stays on full slices
+LESION_PATCH_FRACTION = 0.5 # share of lesion-centred crops of slices with lesions, the rest is placed at random
+PATCH_BATCH_SIZE = 8 # crops are smaller than slices, more of them fit in a batch
+ACCUM_STEPS = 1 # micro-batches of (PATCH_)BATCH_SIZE per optimizer update, the pipeline batches all of them together
+JIT_COMPILE = False # XLA compiled forward and backward pass of every micro-batch
+STEPS_PER_EXECUTION = 1 # training steps per call of the compiled train function, less python overhead per step
+RECOMPUTE = False # recompute encoder stage and decoder block activations in backprop, ~30% slower steps for 2-4x larger batches, see benchmark_memory.py
+TRAIN_BATCH_SIZE = (BATCH_SIZE if PATCH_SIZE is None else PATCH_BATCH_SIZE) * ACCUM_STEPS
+HEAD_CROP = False # crop slices to their head, every batch holds slices of one canvas of CANVAS_SIZES (multiples of 32)
+HARD_EXAMPLES = False # draw slices by their running loss in the following epochs, replaces GROUP_WEIGHTS
+HARD_EXAMPLE_PARAMS = {"momentum": 0.7, "power": 1.0, "min_weight": 0.2, "max_weight": 5.0} # see HardExampleSampler
+SEED = 42 # shard order, shuffle and augmentation seed of a run, resumed runs use the saved one
+CHECKPOINT_EVERY = 1 # epochs between weight snapshots, they are written in the background
+CHECKPOINT_KEEP_BEST = 3 # best snapshots by val_loss kept in MODEL_SAVE_PATH/<run>/checkpoints
+CHECKPOINT_KEEP_LAST = 2 # most recent snapshots kept
+CHECKPOINT_FLOAT16 = False # store the snapshot weights as float16
+RESUME_SAVE_STEPS = 500 # batches between mid-epoch resume checkpoints, 0 only saves at epoch ends
+INITIAL_EPOCH = 27 # first epoch of a new run continuing MODEL_WEIGHTS_PATH, --resume takes it from the checkpoint
 MODEL_WEIGHTS_PATH = './models/24_09-08_30-focal_lovasz_final/best.h5' #'./models/14_09-22_55/best.h5' # if not none model will be contiune training with these weights
-# every shard is 200 files with 36 files on last shard
 # Model Constants
 BACKBONE = 'efficientnetb3'
+IN_MODEL_PREPROCESSING = True # models normalize uint8 images themselves (input_preprocessing), pipeline ships uint8
 # unlabelled 0, iskemik 1, hemorajik 2
 CLASSES = ['iskemik', 'kanama']
 LR = 0.0001
@@ -55,7 +102,17 @@ FINE_TUNE_EPOCH = EPOCHS + 80
 MODEL_SAVE_PATH = "./models"
 
 specifier_name = 'focal_lovasz_final'
-date_name = f'{datetime.now().strftime("%d_%m-%H_%M")}-{specifier_name}'
+date_name = f'{run_stamp()}-{specifier_name}'
+
+# --resume continues the latest run with a resume checkpoint, --resume <run> continues MODEL_SAVE_PATH/<run>
+RESUME = parse_resume_args()
+if RESUME == LATEST:
+    RESUME = latest_run(MODEL_SAVE_PATH)
+    if RESUME is None:
+        raise FileNotFoundError(f"No run with a resume checkpoint in {MODEL_SAVE_PATH}")
+if RESUME is not None:
+    date_name = RESUME
+tf.random.set_seed(SEED)
 
 # Variables
 train_dir = os.path.join(DATASET_PATH, TRAIN_DIR)
@@ -67,18 +124,40 @@ val_filenames = tf.io.gfile.glob(f"{val_dir}/*.tfrecords")
 random.shuffle(train_filenames) # shuffle tfrecord files order
 random.shuffle(val_filenames)
 
+# record counts come from the manifests written next to the shards
+train_manifest = load_manifest(train_filenames)
+val_manifest = load_manifest(val_filenames)
+# batch sizes are per worker, every worker runs its share of the batches of an epoch
+NUM_WORKERS = num_workers()
+STEPS_PER_EPOCH = worker_steps(steps_per_epoch(train_manifest, TRAIN_BATCH_SIZE), NUM_WORKERS)
+VAL_STEPS_PER_EPOCH = worker_steps(steps_per_epoch(val_manifest, BATCH_SIZE), NUM_WORKERS)
+print(f"PreTrain: {NUM_WORKERS} worker(s), per-worker batch {TRAIN_BATCH_SIZE}, global batch {TRAIN_BATCH_SIZE * STRATEGY.num_replicas_in_sync}")
+if GROUP_WEIGHTS is not None:
+    print(f"PreTrain: Sampling groups {train_manifest['groups']} with weights {GROUP_WEIGHTS}")
+print(f"PreTrain: {train_manifest['records']} train records ({STEPS_PER_EPOCH} steps), {val_manifest['records']} val records ({VAL_STEPS_PER_EPOCH} steps)")
+if PATCH_SIZE is not None:
+    if HEAD_CROP:
+        raise ValueError("PATCH_SIZE already crops the slices, disable HEAD_CROP")
+    check_patch_size(PATCH_SIZE)
+    print(f"PreTrain: Training on {PATCH_SIZE}x{PATCH_SIZE} patches, {LESION_PATCH_FRACTION:.0%} lesion-centred")
+
 os.makedirs(f'{MODEL_SAVE_PATH}/{date_name}', exist_ok=True)
 
 # define callbacks for learning rate scheduling and best checkpoints saving
 callbacks = [
-    keras.callbacks.ModelCheckpoint(f'{MODEL_SAVE_PATH}/{date_name}/best.h5', save_weights_only=False, save_best_only=True, mode='min'),
-    keras.callbacks.ModelCheckpoint(f'{MODEL_SAVE_PATH}/{date_name}/epoch_{{epoch:02d}}.h5', save_weights_only=False, save_freq=STEPS_PER_EPOCH*10, save_best_only=False, mode='min'),
     #keras.callbacks.ModelCheckpoint(f'{MODEL_SAVE_PATH}/{date_name}/weights_{{epoch:02d}}.h5', save_weights_only=True, save_freq=STEPS_PER_EPOCH*5, save_best_only=False, mode='min'),
     keras.callbacks.ReduceLROnPlateau(),
-    keras.callbacks.CSVLogger(f'./customlogs/{date_name}.csv')
 ]
-
-if "tensorboard" in FLAGS:
+# metrics are all-reduced, every worker sees the same logs and only the chief writes them
+checkpoint_writer = None
+if is_chief():
+    # best.h5 and final.h5 are exported at the end, during training only weight snapshots are written
+    checkpoint_writer = CheckpointWriter(f'{MODEL_SAVE_PATH}/{date_name}', monitor='val_loss', mode='min', best_k=CHECKPOINT_KEEP_BEST,
+                                         last_n=CHECKPOINT_KEEP_LAST, float16=CHECKPOINT_FLOAT16)
+    callbacks.append(CheckpointCallback(checkpoint_writer, CHECKPOINT_EVERY))
+    callbacks.append(keras.callbacks.CSVLogger(f'./customlogs/{date_name}.csv', append=True)) # resumed runs and later fit calls add rows
+
+if "tensorboard" in FLAGS and is_chief():
     print(f"PreTrain: Using tensorboard")
     callbacks.append(
         TensorBoard(
@@ -119,53 +198,202 @@ def preprocessing_fn(image, mask):
     image, mask = aug["image"].astype("float32"), aug["mask"]#.astype("float32")
     return image, mask 
 
-def parse_examples_batch(examples):
-    feature_description = {
-        'image/raw_image' : tf.io.FixedLenFeature([], tf.string),
-        'label/raw' : tf.io.FixedLenFeature([], tf.string)
-    }
-    samples = tf.io.parse_example(examples, feature_description)
-    return samples
-
-def prepare_sample(features):
-    image = tf.vectorized_map(lambda x: tf.io.parse_tensor(x, out_type = tf.uint8), features["image/raw_image"])
-    label = tf.vectorized_map(lambda x: tf.io.parse_tensor(x, out_type = tf.float32), features["label/raw"])
-    image, label = tf.vectorized_map(lambda x: tf.numpy_function(func=preprocessing_fn, inp=x, Tout=(tf.float32, tf.float32)), [image, label])
-    return image, label
+def batch_seeds(seed):
+    """Patch and augmentation seeds of the stateless seed of a batch, (None, None) without one"""
+    if seed is None:
+        return None, None
+    patch_seed, augment_seed = tf.unstack(tf.random.experimental.stateless_split(seed, 2))
+    return patch_seed, augment_seed
+
+def prepare_batch(image, label, augment, boxes=None, head_boxes=None, sizes=None, seed=None):
+    """Crops, augments and normalizes decoded uint8 images and float32 one-hot labels
 
-def prepare_sample_aug(features):
-    image = tf.vectorized_map(lambda x: tf.io.parse_tensor(x, out_type = tf.uint8), features["image/raw_image"])
-    label = tf.vectorized_map(lambda x: tf.io.parse_tensor(x, out_type = tf.float32), features["label/raw"]) # this was float64
-    image, label = tf.vectorized_map(lambda x: tf.numpy_function(func=aug_fn, inp=x, Tout=(tf.uint8, tf.float32)), [image, label])
+    boxes enable the patch sampler, head_boxes with the canvas sizes the head crop. With a seed the
+    patches and the tf augmentation of the batch only depend on it.
+    """
+    patch_seed, augment_seed = batch_seeds(seed)
+    if boxes is not None: # crops come first, augmentation and preprocessing only run on the patches
+        image, label = sample_patches(image, label, boxes, PATCH_SIZE, LESION_PATCH_FRACTION, seed=patch_seed)
+    if head_boxes is not None:
+        image, label = crop_to_canvas(image, head_boxes, sizes, label)
+    if augment and AUGMENT_BACKEND == "tf":
+        image, label = augment_batch(image, label, **AUGMENT_PARAMS, seed=augment_seed)
+    elif augment:
+        image, label = tf.vectorized_map(lambda x: tf.numpy_function(func=aug_fn, inp=x, Tout=(tf.uint8, tf.float32)), [image, label])
+    if IN_MODEL_PREPROCESSING: # uint8 images, the model applies the backbone preprocessing
+        return image, label
     image, label = tf.vectorized_map(lambda x: tf.numpy_function(func=preprocessing_fn, inp=x, Tout=(tf.float32, tf.float32)), [image, label])
     return image, label
 
-def get_dataset_optimized(filenames, batch_size, shuffle_size, epoch_size, augment=True):
-    record_dataset = tf.data.TFRecordDataset(filenames, compression_type=RECORD_ENCODING_TYPE, num_parallel_reads=AUTOTUNE)
-    if shuffle_size > 0:
-        record_dataset = record_dataset.shuffle(shuffle_size)
-    record_dataset = (record_dataset
-                    .repeat(epoch_size)
-                    .batch(batch_size=batch_size)
-                    .map(map_func=parse_examples_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE))
-    if augment:
-        record_dataset = record_dataset.map(map_func=prepare_sample_aug, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+def prepare_sample(features, schema, box_fn=None, head_boxes=None, sizes=None, seed=None):
+    image = decode_image_batch(features, schema)
+    label = decode_label_batch(features, schema)
+    boxes = None if box_fn is None else box_fn(features[RECORD_HASH_KEY])
+    return prepare_batch(image, label, augment=False, boxes=boxes, head_boxes=head_boxes, sizes=sizes, seed=seed)
+
+def prepare_sample_aug(features, schema, box_fn=None, head_boxes=None, sizes=None, seed=None):
+    image = decode_image_batch(features, schema)
+    label = decode_label_batch(features, schema) # float32 one-hot for both label formats
+    boxes = None if box_fn is None else box_fn(features[RECORD_HASH_KEY])
+    return prepare_batch(image, label, augment=True, boxes=boxes, head_boxes=head_boxes, sizes=sizes, seed=seed)
+
+def decode_compact(features, schema, depth, ids=None):
+    """uint8 images with their stored channels and uint8 class maps, the form that is cached, ids (record ids) are kept next to them"""
+    compact = (decode_image_batch(features, schema, expand=False), decode_class_map_batch(features, schema, depth))
+    return compact if ids is None else compact + (ids,)
+
+def prepare_cached(image, class_map, depth, augment, boxes=None, head_boxes=None, sizes=None, seed=None):
+    # crop the compact uint8 form, only the crops are expanded to one-hot
+    if boxes is not None:
+        image, class_map = sample_patches(image, class_map[..., tf.newaxis], boxes, PATCH_SIZE, LESION_PATCH_FRACTION,
+                                          seed=batch_seeds(seed)[0])
+        class_map = class_map[..., 0]
+    if head_boxes is not None:
+        image, class_map = crop_to_canvas(image, head_boxes, sizes, class_map[..., tf.newaxis])
+        class_map = class_map[..., 0]
+    if image.shape[-1] == 1:
+        image = expand_channels(image)
+    return prepare_batch(image, class_map_to_onehot(class_map, depth), augment, seed=seed) # boxes are None, the crop seed is not drawn again
+
+def get_dataset_optimized(filenames, batch_size, shuffle_size, epoch_size, augment=True, group_weights=None, cache=CACHE_OFF,
+                          start_epoch=0, skip_steps=0, seed=None, patch_size=None, head_crop=None, sampler=None, worker=None):
+    """Training or validation batches of epochs start_epoch to epoch_size
+
+    With a seed the order only depends on the seed and the epoch, so a resumed run gets the same batches
+    from start_epoch and skip_steps on without parsing or decoding the skipped records.
+    With a patch_size every slice is cropped to a PATCH_SIZE patch using the box index next to the shards.
+    With head_crop (canvas sizes) every slice is cropped to its head and batches are grouped by canvas.
+    With a sampler (HardExampleSampler) records are drawn by their loss and batches are (image, label, record ids).
+    With a worker (index, count) every worker keeps its share of the batches, skip_steps counts worker steps.
+    """
+    if sampler is not None and group_weights is not None:
+        raise ValueError("Hard example sampling replaces group_weights, use only one of them")
+    if seed is not None or worker is not None: # every worker needs the same file order
+        filenames = sort_and_shuffle(filenames, seed)
+    schema = detect_schema(filenames[0], RECORD_ENCODING_TYPE) # legacy one-hot or uint8 class map records
+    manifest = load_manifest(filenames)
+    with_hash = patch_size is not None or sampler is not None
+    box_fn = box_lookup(load_box_index(filenames), LESION_BOX) if patch_size is not None else None
+    sizes = None if head_crop is None else canvas_sizes(head_crop, schema["height"], schema["width"])
+    workers = 1 if worker is None else worker[1]
+    epoch_steps = worker_steps(steps_per_epoch(manifest, batch_size), workers)
+    first_step = start_epoch * epoch_steps + skip_steps
+
+    def step_seed(step):
+        """Stateless seed of the batch at a step of the run, a resumed run crops and augments its batches the same"""
+        return None if seed is None else tf.stack([tf.constant(seed, tf.int64), step * workers + (0 if worker is None else worker[0])])
+
+    def batch_records(dataset):
+        """Batches serialized records, with head_crop every batch holds one canvas and carries its head boxes"""
+        if sizes is None:
+            return dataset.batch(batch_size=batch_size)
+        decode_fn = lambda x: decode_image_batch(parse_examples_batch(x[tf.newaxis], schema), schema, expand=False)[0]
+        dataset = dataset.map(map_func=lambda x, *e: (x,) + e + (record_head_box(x, decode_fn),), num_parallel_calls=AUTOTUNE)
+        return bucket_by_canvas(dataset, batch_size, sizes)
+
+    def split_extras(extras):
+        """Record ids (sampler) and head boxes (head_crop) carried next to a batch, in that order"""
+        return extras[0] if sampler is not None else None, extras[-1] if sizes is not None else None
+
+    if shuffle_size is None:
+        shuffle_size = shuffle_buffer_size(manifest, SHUFFLE_MEMORY_MB)
+    if group_weights is not None:
+        # every group is repeated forever and sampled with its weight, epochs are counted by steps_per_epoch.
+        # the draws are independent, a resumed run continues with a new stream seeded by its start epoch
+        record_dataset = batch_records(weighted_record_dataset(filenames, group_weights, RECORD_ENCODING_TYPE, shuffle_size,
+                                                               seed=None if seed is None else epoch_seed(seed, start_epoch)))
+        record_dataset = shard_batches(record_dataset, worker)
+    elif cache != CACHE_OFF:
+        # parse and decode once in file order, everything random comes after the cache
+        depth = schema["label_depth"] or len(manifest["class_pixels"])
+
+        def decode_records(serialized):
+            features = parse_examples_batch(serialized, schema, with_hash)
+            return decode_compact(features, schema, depth, record_ids(serialized, features[RECORD_HASH_KEY]) if with_hash else None)
+
+        def prepare(step, batch):
+            image, class_map, *extras = batch
+            ids, head_boxes = split_extras(extras)
+            batch = prepare_cached(image, class_map, depth, augment, boxes=None if box_fn is None else box_fn(extras[0]),
+                                   head_boxes=head_boxes, sizes=sizes, seed=step_seed(step))
+            return batch if ids is None else batch + (ids,)
+
+        record_dataset = tf.data.TFRecordDataset(filenames, compression_type=RECORD_ENCODING_TYPE)
+        record_dataset = drop_stale_records(record_dataset, manifest["stale_hashes"])
+        record_dataset = (record_dataset
+                        .batch(DECODE_BATCH)
+                        .map(map_func=decode_records, num_parallel_calls=AUTOTUNE)
+                        .unbatch())
+        cache_config = {"schema": schema, "depth": depth, "stale_hashes": manifest["stale_hashes"], "hashes": with_hash}
+        record_dataset = apply_cache(record_dataset, cache, filenames, cache_config, CACHE_DIR)
+        record_dataset = record_dataset.apply(tf.data.experimental.assert_cardinality(manifest["records"]))
+        decoded_shuffle = min(shuffle_size, decoded_shuffle_size(schema, manifest["records"], SHUFFLE_MEMORY_MB))
+
+        def epoch_batches(epoch):
+            dataset = record_dataset
+            if sampler is not None: # draws of every epoch use the weights of the epoch before
+                dataset = sampler.resample(dataset, epoch)
+            if shuffle_size > 0:
+                dataset = dataset.shuffle(decoded_shuffle, seed=None if seed is None else epoch_seed(seed, epoch))
+            if sizes is None:
+                dataset = dataset.batch(batch_size=batch_size)
+            else: # head boxes of cached samples are found on the decoded images, that is cheaper than keeping them in the cache
+                dataset = dataset.map(map_func=lambda *x: x + (image_head_box(x[0]),), num_parallel_calls=AUTOTUNE)
+                dataset = bucket_by_canvas(dataset, batch_size, sizes)
+            return shard_batches(dataset, worker, epoch_steps)
+        # a resumed run skips already trained batches, they come from the cache and are not decoded again
+        record_dataset = (tf.data.Dataset.range(start_epoch, epoch_size)
+                        .flat_map(epoch_batches)
+                        .skip(skip_steps)
+                        .enumerate(first_step)
+                        .map(map_func=prepare, num_parallel_calls=AUTOTUNE))
+        return record_dataset.prefetch(tf.data.experimental.AUTOTUNE)
     else:
-        record_dataset = record_dataset.map(map_func=prepare_sample, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        record_dataset = tf.data.TFRecordDataset(filenames, compression_type=RECORD_ENCODING_TYPE, num_parallel_reads=AUTOTUNE)
+        record_dataset = drop_stale_records(record_dataset, manifest["stale_hashes"]) # records replaced by incremental builds
+        record_dataset = record_dataset.apply(tf.data.experimental.assert_cardinality(manifest["records"]))
+
+        def epoch_batches(epoch):
+            dataset = record_dataset
+            if sampler is not None: # only the record hashes are parsed for the draws
+                dataset = sampler.resample(dataset.map(map_func=lambda x: (x, record_id(x)), num_parallel_calls=AUTOTUNE), epoch)
+            if shuffle_size > 0:
+                dataset = dataset.shuffle(shuffle_size, seed=None if seed is None else epoch_seed(seed, epoch))
+            # the first epoch of a resumed run drops the records of its trained batches (of all workers) before they are parsed
+            skipped = skip_steps * batch_size * workers
+            dataset = dataset.skip(tf.where(epoch == start_epoch, tf.constant(skipped, tf.int64), tf.constant(0, tf.int64)))
+            # batch per epoch so every epoch is exactly one pass, steps_per_epoch rounds the last batch up
+            steps = tf.where(epoch == start_epoch, tf.constant(epoch_steps - skip_steps, tf.int64), tf.constant(epoch_steps, tf.int64))
+            return shard_batches(batch_records(dataset), worker, None if worker is None else steps)
+        record_dataset = tf.data.Dataset.range(start_epoch, epoch_size).flat_map(epoch_batches)
+
+    def prepare(step, batch):
+        serialized, *extras = tf.nest.flatten(batch)
+        ids, head_boxes = split_extras(extras)
+        prepare_fn = prepare_sample_aug if augment else prepare_sample
+        batch = prepare_fn(parse_examples_batch(serialized, schema, with_hash), schema, box_fn, head_boxes, sizes, step_seed(step))
+        return batch if ids is None else batch + (ids,)
+
+    # record ids and head boxes are carried next to the serialized records, the step seeds the random crops and augmentation
+    record_dataset = record_dataset.enumerate(first_step).map(map_func=prepare, num_parallel_calls=tf.data.experimental.AUTOTUNE)
     return record_dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
 n_classes = 1 if len(CLASSES) == 1 else (len(CLASSES) + 1)  # case for binary and multiclass segmentation
 activation = 'sigmoid' if n_classes == 1 else 'softmax'
 
 
-if "fine_tune" in FLAGS:
-    model = sm.Unet(BACKBONE, classes=n_classes, activation=activation, encoder_freeze=True)
-else:
-    #create model
-    model = sm.Unet(BACKBONE, classes=n_classes, activation=activation, encoder_freeze=False)
+# variables of the model and the optimizer are mirrored on every worker
+with STRATEGY.scope():
+    if "fine_tune" in FLAGS:
+        model = sm.Unet(BACKBONE, classes=n_classes, activation=activation, encoder_freeze=True, input_preprocessing=IN_MODEL_PREPROCESSING,
+                        recompute=RECOMPUTE)
+    else:
+        #create model
+        model = sm.Unet(BACKBONE, classes=n_classes, activation=activation, encoder_freeze=False, input_preprocessing=IN_MODEL_PREPROCESSING,
+                        recompute=RECOMPUTE)
 
-# define optomizer
-optim = keras.optimizers.Adam(LR)
+    # define optomizer
+    optim = loss_scale_optimizer(keras.optimizers.Adam(LR), PRECISION)
 
 # Segmentation models losses can be combined together by '+' and scaled by integer or float factor
 # set class weights for dice_loss (car: 1.; pedestrian: 2.; background: 0.5;)
@@ -189,21 +417,88 @@ metrics = [sm.metrics.IOUScore(threshold=0.5), sm.metrics.FScore(threshold=0.5)]
 
 # compile keras model with defined optimozer, loss and metrics
 #model.compile(optimizer= optim, loss=total_loss, metrics=metrics)
-model.compile(optimizer= optim, loss=[keras_lovasz_softmax, focal_loss], metrics=metrics, loss_weights=[0.9, 0.1])
-
-if(MODEL_WEIGHTS_PATH is not None):
-    model = load_model(MODEL_WEIGHTS_PATH, custom_objects={'keras_lovasz_softmax': keras_lovasz_softmax, 'focal_loss': focal_loss, 'iou_score': sm.metrics.IOUScore(threshold=0.5), 'f1-score': sm.metrics.FScore(threshold=0.5)})
-    model.trainable = True
-
-history = model.fit(
-        get_dataset_optimized(train_filenames, BATCH_SIZE, SHUFFLE_SIZE, EPOCHS, augment=False), 
-        steps_per_epoch=STEPS_PER_EPOCH, 
-        epochs=EPOCHS, 
-        callbacks=callbacks, 
-        validation_data=get_dataset_optimized(val_filenames, BATCH_SIZE, 0, EPOCHS, augment=False), 
-        validation_steps=VAL_STEPS_PER_EPOCH,
-        initial_epoch=27
-    )
+model.compile(optimizer= optim, loss=[keras_lovasz_softmax, focal_loss], metrics=metrics, loss_weights=[0.9, 0.1],
+              steps_per_execution=STEPS_PER_EXECUTION)
+
+with STRATEGY.scope():
+    if(MODEL_WEIGHTS_PATH is not None):
+        model = load_model(MODEL_WEIGHTS_PATH, custom_objects={'keras_lovasz_softmax': keras_lovasz_softmax, 'focal_loss': focal_loss, 'iou_score': sm.metrics.IOUScore(threshold=0.5), 'f1-score': sm.metrics.FScore(threshold=0.5), **sm.get_custom_objects()})
+        # models saved before input_preprocessing existed expect normalized float images
+        IN_MODEL_PREPROCESSING = 'input_preprocessing' in [layer.name for layer in model.layers]
+        model.trainable = True
+        if PRECISION != FLOAT32 and model_policy(model) != PRECISION:
+            # layers keep the dtype they were saved with, the optimizer moments start over
+            model = cast_model(model, PRECISION, custom_objects=sm.get_custom_objects())
+            model.compile(optimizer=optim, loss=[keras_lovasz_softmax, focal_loss], metrics=metrics, loss_weights=[0.9, 0.1],
+                          steps_per_execution=STEPS_PER_EXECUTION)
+        if RECOMPUTE:
+            sm.enable_recompute(model) # not saved with the model
+
+hard_example_sampler = None
+if HARD_EXAMPLES:
+    if NUM_WORKERS > 1: # every worker would draw from the losses of its own batches, their batch streams would differ
+        raise ValueError("HARD_EXAMPLES needs a single worker, the workers do not share their record losses")
+    print(f"PreTrain: Sampling hard examples with {HARD_EXAMPLE_PARAMS}")
+    # per slice loss with the weights of the compiled losses
+    hard_example_sampler = HardExampleSampler(per_sample_loss(lambda y, p: 0.9 * keras_lovasz_softmax(y, p) + 0.1 * focal_loss(y, p)),
+                                              seed=SEED, **HARD_EXAMPLE_PARAMS)
+    callbacks.append(HardExampleCallback(hard_example_sampler)) # before the resume callback, the new weights are saved with the epoch
+if ACCUM_STEPS > 1 or JIT_COMPILE or hard_example_sampler is not None:
+    print(f"PreTrain: {ACCUM_STEPS} micro-batch(es) per update, effective batch {TRAIN_BATCH_SIZE}, XLA {JIT_COMPILE}")
+    attach_train_step(model, ACCUM_STEPS, JIT_COMPILE, sampler=hard_example_sampler) # kept by the fine tune compile
+
+# model, optimizer, seed and pipeline position are saved together in MODEL_SAVE_PATH/<run>/resume
+# every worker saves, only the checkpoints of the chief are kept
+resume_state = ResumeState(f'{MODEL_SAVE_PATH}/{date_name}', model, SEED,
+                           extra=None if hard_example_sampler is None else hard_example_sampler.trackables(),
+                           write_dir=None if is_chief() else write_directory(f'{MODEL_SAVE_PATH}/{date_name}/resume'))
+resume_callback = ResumeCallback(resume_state, RESUME_SAVE_STEPS)
+callbacks.append(resume_callback)
+start_epoch, start_step = INITIAL_EPOCH, 0
+if RESUME is not None:
+    start_epoch, start_step = resume_state.restore()
+    SEED = int(resume_state.seed)
+tf.random.set_seed(SEED) # the saved seed, shuffles combine it with their op seeds, crops and augmentation use step seeds
+
+def fit_epochs(initial_epoch, epochs, start_step=0):
+    """Trains from initial_epoch to epochs, a run resumed mid-epoch first finishes the rest of that epoch"""
+    head_crop = CANVAS_SIZES if HEAD_CROP else None
+    def train_dataset(epoch, step):
+        return distribute_batches(STRATEGY, lambda worker: get_dataset_optimized(
+            train_filenames, TRAIN_BATCH_SIZE, SHUFFLE_SIZE, epochs, augment=False, group_weights=GROUP_WEIGHTS, cache=TRAIN_CACHE,
+            start_epoch=epoch, skip_steps=step, seed=SEED, patch_size=PATCH_SIZE, head_crop=head_crop, sampler=hard_example_sampler,
+            worker=worker))
+    val_dataset = distribute_batches(STRATEGY, lambda worker: get_dataset_optimized(
+        val_filenames, BATCH_SIZE, 0, epochs, augment=False, cache=VAL_CACHE, head_crop=head_crop, worker=worker))
+    verbose = 1 if is_chief() else 2 # one line per epoch from the other workers
+    history = None
+    if start_step > 0 and initial_epoch < epochs:
+        resume_callback.skip_steps(start_step)
+        history = model.fit(
+            train_dataset(initial_epoch, start_step),
+            steps_per_epoch=STEPS_PER_EPOCH - start_step,
+            epochs=initial_epoch + 1,
+            callbacks=callbacks,
+            validation_data=val_dataset,
+            validation_steps=VAL_STEPS_PER_EPOCH,
+            initial_epoch=initial_epoch,
+            verbose=verbose
+        )
+        initial_epoch += 1
+    if initial_epoch < epochs:
+        history = model.fit(
+            train_dataset(initial_epoch, 0),
+            steps_per_epoch=STEPS_PER_EPOCH,
+            epochs=epochs,
+            callbacks=callbacks,
+            validation_data=val_dataset,
+            validation_steps=VAL_STEPS_PER_EPOCH,
+            initial_epoch=initial_epoch,
+            verbose=verbose
+        )
+    return history
+
+history = fit_epochs(start_epoch, EPOCHS, start_step)
 
 if "fine_tune" in FLAGS:
     set_trainable = False
@@ -216,17 +511,14 @@ if "fine_tune" in FLAGS:
         else:
             layer.trainable = False
 
-    model.compile(optimizer= optim, loss=[keras_lovasz_softmax, focal_loss], metrics=metrics, loss_weights=[0.9, 0.1])
+    model.compile(optimizer= optim, loss=[keras_lovasz_softmax, focal_loss], metrics=metrics, loss_weights=[0.9, 0.1],
+                  steps_per_execution=STEPS_PER_EXECUTION)
 
-    history = model.fit(
-        get_dataset_optimized(train_filenames, BATCH_SIZE, SHUFFLE_SIZE, FINE_TUNE_EPOCH, augment=False), 
-        steps_per_epoch=STEPS_PER_EPOCH, 
-        epochs=FINE_TUNE_EPOCH, 
-        callbacks=callbacks, 
-        validation_data=get_dataset_optimized(val_filenames, BATCH_SIZE, 0, FINE_TUNE_EPOCH, augment=False), 
-        validation_steps=VAL_STEPS_PER_EPOCH,
-        initial_epoch=EPOCHS
-    )
+    # runs resumed inside the fine tune epochs continue there
+    history = fit_epochs(max(start_epoch, EPOCHS), FINE_TUNE_EPOCH, start_step if start_epoch >= EPOCHS else 0)
 
 save_path = f'{MODEL_SAVE_PATH}/{date_name}/final.h5'
-model.save(save_path)
\ No newline at end of file
+if is_chief():
+    model.save(save_path)
+    checkpoint_writer.export(model, f'{MODEL_SAVE_PATH}/{date_name}/best.h5')
+    checkpoint_writer.close()
\ No newline at end of file
@@ -23,6 +23,13 @@ import albumentations as A
 from datetime import datetime
 from keras_unet_collection import losses
 from tensorflow.keras.callbacks import TensorBoard
+from recordbase.augment import augment_batch
+from recordbase.reader import detect_schema, parse_examples_batch, decode_image_batch, decode_label_batch, drop_stale_records
+from recordbase.manifest import load_manifest
+from recordbase.arrays import ArrayBase, array_dataset
+from recordbase.splits import load_split
+from recordbase.loader import SharedMemoryLoader
+from recordbase.schema import onehot_lookup_table, lookup
 from tensorflow.keras.models import load_model
 import cv2
 import hetorex
@@ -41,13 +48,21 @@ RECORD_ENCODING_TYPE = "ZLIB" # none if no encoding is used
 # Pipeline parameters
 BUFFER_SIZE = None # set buffer size to default value, change if you have bottleneck
 SHUFFLE_SIZE = 256 # because dataset is too large huge shuffle sizes may cause problems with ram
+AUGMENT_BACKEND = "tf" # tf: in-graph recordbase.augment, albumentations: aug_fn in tf.numpy_function
+AUGMENT_PARAMS = {"rotate_limit": 40, "flip": True} # same transforms as aug_fn
 BATCH_SIZE = 2 # Highly dependent on d-gpu and system ram
 STEPS_PER_EPOCH = 5949//BATCH_SIZE # 4646 IMPORTANT this value should be equal to file_amount/batch_size because we can't find file_amount from tf.Dataset you should note it yourself
 VAL_STEPS_PER_EPOCH = 1274//BATCH_SIZE # 995 same as steps per epoch
+SPLIT_MANIFEST = None # './data/dataset1/splits.json' written by split_dataset.py, used instead of the png split directories
+ARRAY_BASE_PATH = None # directory written by create_arrays.py, used instead of the png directories if set
+ARRAY_PIPELINE = "sequence" # sequence: Dataloder with albumentations, tf.data: range indexed array_dataset
+LOADER_WORKERS = 4 # processes building the sequence batches in shared memory, 0 builds them in the training thread
+LOADER_PREFETCH = 8 # batches the loader workers run ahead
 MODEL_WEIGHTS_PATH = None#'./models/14_09-22_55/best.h5' # if not none model will be contiune training with these weights
 # every shard is 200 files with 36 files on last shard
 # Model Constants
 BACKBONE = 'efficientnetb3'
+IN_MODEL_PREPROCESSING = True # models normalize uint8 images themselves (input_preprocessing), pipeline ships uint8
 # unlabelled 0, iskemik 1, hemorajik 2
 CLASSES = ['iskemik', 'kanama']
 LR = 0.0001
@@ -117,39 +132,40 @@ def preprocessing_fn(image, mask):
     image, mask = aug["image"].astype("float32"), aug["mask"].astype("float32")
     return image, mask 
 
-def parse_examples_batch(examples):
-    feature_description = {
-        'image/raw_image' : tf.io.FixedLenFeature([], tf.string),
-        'label/raw' : tf.io.FixedLenFeature([], tf.string)
-    }
-    samples = tf.io.parse_example(examples, feature_description)
-    return samples
-
-def prepare_sample(features):
-    image = tf.vectorized_map(lambda x: tf.io.parse_tensor(x, out_type = tf.uint8), features["image/raw_image"])
-    label = tf.vectorized_map(lambda x: tf.io.parse_tensor(x, out_type = tf.float32), features["label/raw"])
+def prepare_sample(features, schema):
+    image = decode_image_batch(features, schema)
+    label = decode_label_batch(features, schema)
+    if IN_MODEL_PREPROCESSING: # uint8 images, the model applies the backbone preprocessing
+        return image, label
     image, label = tf.vectorized_map(lambda x: tf.numpy_function(func=preprocessing_fn, inp=x, Tout=(tf.float32, tf.float32)), [image, label])
     return image, label
 
-def prepare_sample_aug(features):
-    image = tf.vectorized_map(lambda x: tf.io.parse_tensor(x, out_type = tf.uint8), features["image/raw_image"])
-    label = tf.vectorized_map(lambda x: tf.io.parse_tensor(x, out_type = tf.float32), features["label/raw"]) # this was float64
-    image, label = tf.vectorized_map(lambda x: tf.numpy_function(func=aug_fn, inp=x, Tout=(tf.uint8, tf.float32)), [image, label])
+def prepare_sample_aug(features, schema):
+    image = decode_image_batch(features, schema)
+    label = decode_label_batch(features, schema) # float32 one-hot for both label formats
+    if AUGMENT_BACKEND == "tf":
+        image, label = augment_batch(image, label, **AUGMENT_PARAMS)
+    else:
+        image, label = tf.vectorized_map(lambda x: tf.numpy_function(func=aug_fn, inp=x, Tout=(tf.uint8, tf.float32)), [image, label])
+    if IN_MODEL_PREPROCESSING: # uint8 images, the model applies the backbone preprocessing
+        return image, label
     image, label = tf.vectorized_map(lambda x: tf.numpy_function(func=preprocessing_fn, inp=x, Tout=(tf.float32, tf.float32)), [image, label])
     return image, label
 
 def get_dataset_optimized(filenames, batch_size, shuffle_size, augment=True):
+    schema = detect_schema(filenames[0], RECORD_ENCODING_TYPE) # legacy one-hot or uint8 class map records
     record_dataset = tf.data.TFRecordDataset(filenames, compression_type=RECORD_ENCODING_TYPE, num_parallel_reads=AUTOTUNE)
+    record_dataset = drop_stale_records(record_dataset, load_manifest(filenames)["stale_hashes"]) # records replaced by incremental builds
     if shuffle_size > 0:
         record_dataset = record_dataset.shuffle(shuffle_size)
     record_dataset = (record_dataset
                     .repeat(EPOCHS)
                     .batch(batch_size=batch_size)
-                    .map(map_func=parse_examples_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE))
+                    .map(map_func=lambda x: parse_examples_batch(x, schema), num_parallel_calls=tf.data.experimental.AUTOTUNE))
     if augment:
-        record_dataset = record_dataset.map(map_func=prepare_sample_aug, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        record_dataset = record_dataset.map(map_func=lambda x: prepare_sample_aug(x, schema), num_parallel_calls=tf.data.experimental.AUTOTUNE)
     else:
-        record_dataset = record_dataset.map(map_func=prepare_sample, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        record_dataset = record_dataset.map(map_func=lambda x: prepare_sample(x, schema), num_parallel_calls=tf.data.experimental.AUTOTUNE)
     return record_dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
 n_classes = 1 if len(CLASSES) == 1 else (len(CLASSES) + 1)  # case for binary and multiclass segmentation
@@ -180,6 +196,7 @@ class Dataset:
     Args:
         images_dir (str): path to images folder
         masks_dir (str): path to segmentation masks folder
+        pairs (list): (image path, mask path) tuples of a split manifest, used instead of images_dir and masks_dir
         class_values (list): values of classes to extract from segmentation mask
         augmentation (albumentations.Compose): data transfromation pipeline 
             (e.g. flip, scale, etc.)
@@ -197,32 +214,33 @@ class Dataset:
             classes=None, 
             augmentation=None, 
             preprocessing=None,
+            pairs=None,
     ):
-        self.ids = os.listdir(images_dir)
-        self.images_fps = [os.path.join(images_dir, image_id) for image_id in self.ids]
-        self.masks_fps = [os.path.join(masks_dir, image_id) for image_id in self.ids]
+        if pairs is not None:
+            self.ids = [os.path.basename(image_fp) for image_fp, _ in pairs]
+            self.images_fps = [image_fp for image_fp, _ in pairs]
+            self.masks_fps = [mask_fp for _, mask_fp in pairs]
+        else:
+            self.ids = os.listdir(images_dir)
+            self.images_fps = [os.path.join(images_dir, image_id) for image_id in self.ids]
+            self.masks_fps = [os.path.join(masks_dir, image_id) for image_id in self.ids]
         
         # convert str names to class values on masks
         self.class_values = [self.CLASSES.index(cls.lower()) for cls in classes]
+        # label png value -> float32 one-hot row, background included
+        self.onehot_table = onehot_lookup_table(self.class_values, np.float32)
         
         self.augmentation = augmentation
         self.preprocessing = preprocessing
     
     def __getitem__(self, i):
-        
-        # read data
-        image = cv2.imread(self.images_fps[i])
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        mask = cv2.imread(self.masks_fps[i], 0)
-        
-        # extract certain classes from mask (e.g. cars)
-        masks = [(mask == v) for v in self.class_values]
-        mask = np.stack(masks, axis=-1).astype('float')
-        
-        # add background if mask is not binary
-        if mask.shape[-1] != 1:
-            background = 1 - mask.sum(axis=-1, keepdims=True)
-            mask = np.concatenate((mask, background), axis=-1)
+        return self.load(i)
+
+    def load(self, i, image_out=None, mask_out=None):
+        """Reads sample i, image_out and mask_out are preallocated rows of a batch the sample is written into"""
+        # read data, color conversion and one-hot lookup write into the batch rows when given
+        image = cv2.cvtColor(cv2.imread(self.images_fps[i]), cv2.COLOR_BGR2RGB, dst=image_out)
+        mask = lookup(self.onehot_table, cv2.imread(self.masks_fps[i], 0), out=mask_out)
         
         # apply augmentations
         if self.augmentation:
@@ -234,12 +252,77 @@ class Dataset:
             sample = self.preprocessing(image=image, mask=mask)
             image, mask = sample['image'], sample['mask']
             
-        return image, mask
+        return _write_rows(image, mask, image_out, mask_out)
         
     def __len__(self):
         return len(self.ids)
     
     
+class ArrayDataset:
+    """Same as Dataset but reads an array base written by create_arrays.py through np.memmap
+
+    Args:
+        base (ArrayBase): memory mapped array base
+        augmentation (albumentations.Compose): data transfromation pipeline
+        preprocessing (albumentations.Compose): data preprocessing
+    """
+
+    def __init__(self, base, augmentation=None, preprocessing=None):
+        self.base = base
+        self.augmentation = augmentation
+        self.preprocessing = preprocessing
+
+    def __getitem__(self, i):
+        return self.load(i)
+
+    def load(self, i, image_out=None, mask_out=None):
+        """Same as Dataset.load"""
+        # zero-copy slices, only the augmentation creates new arrays
+        image, class_map = self.base[i]
+        mask = self.base.onehot(class_map, out=mask_out)
+        if image.shape[-1] == 1:
+            if self.augmentation or self.preprocessing or image_out is None:
+                image = np.repeat(image, 3, axis=-1)
+            else:
+                image = np.broadcast_to(image, image_out.shape) # view, broadcast while it is copied into the batch
+
+        if self.augmentation:
+            sample = self.augmentation(image=image, mask=mask)
+            image, mask = sample['image'], sample['mask']
+
+        if self.preprocessing:
+            sample = self.preprocessing(image=image, mask=mask)
+            image, mask = sample['image'], sample['mask']
+
+        return _write_rows(image, mask, image_out, mask_out)
+
+    def __len__(self):
+        return len(self.base)
+
+
+def _write_rows(image, mask, image_out, mask_out):
+    """Copies transformed samples into their batch rows, samples already written there are not copied"""
+    if image_out is not None and image is not image_out:
+        np.copyto(image_out, image)
+        image = image_out
+    if mask_out is not None and mask is not mask_out:
+        np.copyto(mask_out, mask)
+        mask = mask_out
+    return image, mask
+
+
+def prepare_arrays(image, label, augment):
+    """array_dataset counterpart of prepare_sample and prepare_sample_aug"""
+    if augment and AUGMENT_BACKEND == "tf":
+        image, label = augment_batch(image, label, **AUGMENT_PARAMS)
+    elif augment:
+        image, label = tf.vectorized_map(lambda x: tf.numpy_function(func=aug_fn, inp=x, Tout=(tf.uint8, tf.float32)), [image, label])
+    if IN_MODEL_PREPROCESSING:
+        return image, label
+    image, label = tf.vectorized_map(lambda x: tf.numpy_function(func=preprocessing_fn, inp=x, Tout=(tf.float32, tf.float32)), [image, label])
+    return image, label
+
+
 class Dataloder(keras.utils.Sequence):
     """Load data from dataset and form batches
     
@@ -254,6 +337,7 @@ class Dataloder(keras.utils.Sequence):
         self.batch_size = batch_size
         self.shuffle = shuffle
         self.indexes = np.arange(len(dataset))
+        self.fields = None # (shape, dtype) of the image and the mask
 
         self.on_epoch_end()
 
@@ -261,15 +345,15 @@ class Dataloder(keras.utils.Sequence):
         # collect batch data
         start = i * self.batch_size
         stop = (i + 1) * self.batch_size
-        data = []
-        for j in range(start, stop):
-            data.append(self.dataset[j])
-        
-        # transpose list of lists
-        batch = [np.stack(samples, axis=0) for samples in zip(*data)]
+        if self.fields is None:
+            self.fields = [(value.shape, value.dtype) for value in self.dataset[self.indexes[start]]]
+        # samples are written straight into the batch, a new one every call since keras may still hold the last
+        batch = tuple(np.empty((self.batch_size,) + shape, dtype=dtype) for shape, dtype in self.fields)
+        for row, j in enumerate(range(start, stop)):
+            self.dataset.load(self.indexes[j], *[values[row] for values in batch])
         
         # newer version of tf/keras want batch to be in tuple rather than list
-        return tuple(batch)
+        return batch
     
     def __len__(self):
         """Denotes the number of batches per epoch"""
@@ -285,37 +369,62 @@ y_train_dir = './data/dataset1/train_label/'
 x_valid_dir = './data/dataset1/val/'
 y_valid_dir = './data/dataset1/val_label/'
 preprocess_input = sm.get_preprocessing(BACKBONE)
+dataset_preprocessing = None if IN_MODEL_PREPROCESSING else get_preprocessing(preprocess_input)
+
+if ARRAY_BASE_PATH is None:
+    # Dataset for train images
+    train_dataset = Dataset(
+        x_train_dir, 
+        y_train_dir, 
+        classes=CLASSES, 
+        augmentation=get_training_augmentation(),
+        preprocessing=dataset_preprocessing,
+        pairs=None if SPLIT_MANIFEST is None else load_split(SPLIT_MANIFEST, TRAIN_DIR),
+    )
 
-# Dataset for train images
-train_dataset = Dataset(
-    x_train_dir, 
-    y_train_dir, 
-    classes=CLASSES, 
-    augmentation=get_training_augmentation(),
-    preprocessing=get_preprocessing(preprocess_input),
-)
-
-# Dataset for validation images
-valid_dataset = Dataset(
-    x_valid_dir, 
-    y_valid_dir, 
-    classes=CLASSES, 
-    augmentation=None,
-    preprocessing=get_preprocessing(preprocess_input),
-)
-
-train_dataloader = Dataloder(train_dataset, batch_size=BATCH_SIZE, shuffle=True)
-valid_dataloader = Dataloder(valid_dataset, batch_size=1, shuffle=False)
-
-# check shapes for errors
-assert train_dataloader[0][0].shape == (BATCH_SIZE, 512, 512, 3)
-assert train_dataloader[0][1].shape == (BATCH_SIZE, 512, 512, 3)
+    # Dataset for validation images
+    valid_dataset = Dataset(
+        x_valid_dir, 
+        y_valid_dir, 
+        classes=CLASSES, 
+        augmentation=None,
+        preprocessing=dataset_preprocessing,
+        pairs=None if SPLIT_MANIFEST is None else load_split(SPLIT_MANIFEST, VAL_DIR),
+    )
+else:
+    train_base = ArrayBase(ARRAY_BASE_PATH, TRAIN_DIR)
+    valid_base = ArrayBase(ARRAY_BASE_PATH, VAL_DIR)
+    train_dataset = ArrayDataset(train_base, augmentation=get_training_augmentation(), preprocessing=dataset_preprocessing)
+    valid_dataset = ArrayDataset(valid_base, augmentation=None, preprocessing=dataset_preprocessing)
+
+if ARRAY_BASE_PATH is not None and ARRAY_PIPELINE == "tf.data":
+    # every epoch is a full permutation of the base, no shuffle buffer needed
+    train_dataloader = (array_dataset(train_base, BATCH_SIZE, shuffle=True, epochs=None, drop_remainder=True)
+                        .map(lambda x, y: prepare_arrays(x, y, augment=True), num_parallel_calls=AUTOTUNE)
+                        .prefetch(AUTOTUNE))
+    valid_dataloader = (array_dataset(valid_base, 1, shuffle=False, epochs=None)
+                        .map(lambda x, y: prepare_arrays(x, y, augment=False), num_parallel_calls=AUTOTUNE)
+                        .prefetch(AUTOTUNE))
+    train_steps, valid_steps = len(train_base) // BATCH_SIZE, len(valid_base)
+elif LOADER_WORKERS > 0:
+    train_dataloader = SharedMemoryLoader(train_dataset, batch_size=BATCH_SIZE, shuffle=True, workers=LOADER_WORKERS, prefetch=LOADER_PREFETCH)
+    valid_dataloader = SharedMemoryLoader(valid_dataset, batch_size=1, shuffle=False, workers=LOADER_WORKERS, prefetch=LOADER_PREFETCH)
+    train_steps, valid_steps = len(train_dataloader), len(valid_dataloader)
+else:
+    train_dataloader = Dataloder(train_dataset, batch_size=BATCH_SIZE, shuffle=True)
+    valid_dataloader = Dataloder(valid_dataset, batch_size=1, shuffle=False)
+    train_steps, valid_steps = len(train_dataloader), len(valid_dataloader)
+
+if not isinstance(train_dataloader, tf.data.Dataset):
+    # check shapes for errors
+    assert train_dataloader[0][0].shape == (BATCH_SIZE, 512, 512, 3)
+    assert train_dataloader[0][1].shape == (BATCH_SIZE, 512, 512, 3)
 
 
 # ------ End ------
 
 #create model
-model = sm.Unet(BACKBONE, classes=n_classes, activation=activation, encoder_freeze=False)
+model = sm.Unet(BACKBONE, classes=n_classes, activation=activation, encoder_freeze=False, input_preprocessing=IN_MODEL_PREPROCESSING)
 
 # define optomizer
 optim = keras.optimizers.Adam(LR)
@@ -343,17 +452,18 @@ metrics = [sm.metrics.IOUScore(), sm.metrics.FScore()]
 model.compile(optim, total_loss, metrics)
 
 if(MODEL_WEIGHTS_PATH is not None):
-    model = load_model(MODEL_WEIGHTS_PATH, custom_objects={'dice_loss_plus_1focal_loss': total_loss,'iou_score': sm.metrics.IOUScore(), 'f1-score': sm.metrics.FScore()})
+    model = load_model(MODEL_WEIGHTS_PATH, custom_objects={'dice_loss_plus_1focal_loss': total_loss,'iou_score': sm.metrics.IOUScore(), 'f1-score': sm.metrics.FScore(), **sm.get_custom_objects()})
     for layer in model.layers[:]:
         layer.trainable = True
 
 history = model.fit(
         train_dataloader, 
-        steps_per_epoch=len(train_dataloader), 
+        steps_per_epoch=train_steps, 
         epochs=EPOCHS, 
         callbacks=callbacks, 
-        validation_data=len(valid_dataloader), 
-        validation_steps=VAL_STEPS_PER_EPOCH,
+        validation_data=valid_dataloader, 
+        validation_steps=valid_steps,
+        shuffle=False, # the loaders shuffle samples every epoch, keras would also shuffle the batch order and defeat prefetching
         #initial_epoch=5
     )
 